@@ -0,0 +1,406 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from datetime import datetime
+from typing import Callable, Optional
+
+# 画面を出さずに動かす(指定があればそれに従う)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from PyQt6.QtCore import QEvent, QEventLoop, Qt, QT_VERSION_STR
+from PyQt6.QtGui import QKeyEvent
+from PyQt6.QtWidgets import QApplication, QHBoxLayout, QWidget
+
+from composer import EMITTED, MISSED, ComposerTable
+from event_log import EMIT, END, KEY, MISTAKE, PROMPT, START, EventLog, Events
+from fuzz import SyntheticTypist
+from heatmap import HeatmapStats
+from matcher import ROMAJI, create_matcher
+from prompt_store import DEFAULT_PROMPT_PATH, Prompt, PromptStore
+from prompt_widget import SEPARATOR_KANA, PromptWidget
+from rule_cache import load_cached
+from storage import MODE_1HOUR, SessionRecord, SessionStore
+from timer import NS_PER_SECOND, TimerController, display_refresh_interval_ms
+import tracing
+from weakness import WeaknessTracker
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# ホットパスのベンチマーク
+# 合成した1時間分の打鍵列を、変換器(照合)、お題ウィジェットの描画、タイマー、記録の保存に流し、
+# 1打鍵(1件)ごとの所要時間の分布、メモリの確保量、最大RSSをJSONに書き出す。
+# 計測は2回に分け、1回目は時間だけを、2回目は短い打鍵列でtracemallocを使ってメモリの確保量を測る
+# (tracemallocを入れたままだと時間が何倍にもなるため)。--compareで前の結果と比べる
+
+DEFAULT_OUTPUT_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "cache", "bench"))
+STAGES = ("composer", "widget", "timer", "storage")
+# これより遅くなったら比較で目印を付ける
+REGRESSION_RATIO = 1.10
+
+
+class Context:
+    # 各段で共有するもの(お題、ルール表、合成した計測)
+    def __init__(self, args, prompts: PromptStore, table: ComposerTable):
+        self.seed = args.seed
+        self.duration_ns = int(args.minutes * 60 * NS_PER_SECOND)
+        self.alloc_keys = args.alloc_keys
+        self.timer_runs = args.timer_runs
+        self.timer_seconds = args.timer_seconds
+        self.sessions = args.sessions
+        self.prompts = prompts
+        self.table = table
+        self.directory = ""
+        # composerの段で作った計測 (イベント列, 打ったお題)。storageの段で保存する
+        self.session: Optional[tuple[Events, list[Prompt]]] = None
+
+
+def _expected(matcher, pos: int) -> str:
+    # 計画どおりなら次に打つキー
+    keys, _ = matcher.plan(pos)
+    return keys[len(matcher.preedit):][:1]
+
+
+def _summary(values: array) -> dict:
+    # 所要時間(ns)の分布をマイクロ秒で
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    n = len(ordered)
+
+    def at(q: float) -> float:
+        return round(ordered[min(n - 1, int(q * n))] / 1000, 2)
+
+    return {"count": n, "mean": round(sum(ordered) / n / 1000, 2),
+            "p50": at(0.50), "p90": at(0.90), "p99": at(0.99), "max": round(ordered[-1] / 1000, 2)}
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト、Linuxはキロバイト
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+# ---- 各段 ----
+# どれも (指標名 -> 所要時間(ns)の配列, 打鍵などの件数) を返す。smallなら短く済ませる(メモリの計測用)
+
+def bench_composer(ctx: Context, small: bool) -> tuple[dict[str, array], int]:
+    # 照合(変換器と打鍵列の計画)に1打鍵ずつ流し、ウィジェットと同じイベント列を作る
+    matcher = create_matcher(ROMAJI, ctx.table)
+    typist = SyntheticTypist(ctx.seed)
+    prompts = ctx.prompts
+    prompts.set_seed(ctx.seed)
+    limit = ctx.alloc_keys if small else None
+    perf = time.perf_counter_ns
+    latencies = array("q")
+    events = Events()
+    typed: dict[int, Prompt] = {}
+
+    def show(prompt: Prompt, separator: bool) -> str:
+        typed.setdefault(prompt.id, prompt)
+        events.append(t, PROMPT, int(separator), prompt.id)
+        kana = SEPARATOR_KANA + prompt.kana if separator else prompt.kana
+        matcher.set_target("", kana, [])
+        matcher.reset()
+        return kana
+
+    t = 0
+    pos = 0
+    events.append(0, START, 0, 0)
+    prompt = prompts.sample()
+    kana = show(prompt, False)
+    while t < ctx.duration_ns and (limit is None or len(latencies) < limit):
+        interval, key = typist.next(_expected(matcher, pos))
+        t += interval
+        start = perf()
+        result, new_pos = matcher.feed(pos, key)
+        if result & MISSED:
+            events.append(t, MISTAKE, ord(key), pos)
+        else:
+            events.append(t, KEY, ord(key), pos)
+            if result & EMITTED:
+                events.append(t, EMIT, new_pos - pos, new_pos)
+            pos = new_pos
+        latencies.append(perf() - start)
+        if pos >= len(kana):
+            prompt = prompts.sample(exclude=prompt.id)
+            kana = show(prompt, True)
+            pos = 0
+    events.append(max(t, ctx.duration_ns) if limit is None else t, END, 0, pos)
+    if not small:
+        ctx.session = (events, list(typed.values()))
+    return {"feed": latencies}, len(latencies)
+
+
+def bench_widget(ctx: Context, small: bool) -> tuple[dict[str, array], int]:
+    # お題ウィジェットにキーイベントを送り、描画が済むまで(イベントループを1回回す)の時間
+    app = QApplication.instance()
+    typist = SyntheticTypist(ctx.seed)
+    ctx.prompts.set_seed(ctx.seed)
+    limit = ctx.alloc_keys if small else None
+    perf = time.perf_counter_ns
+    latencies = array("q")
+    window = QWidget()
+    layout = QHBoxLayout(window)
+    widget = PromptWidget(ctx.prompts, ctx.table)
+    layout.addWidget(widget)
+    layout.addWidget(widget.pace_graph)
+    window.show()
+    app.processEvents()
+    # 1時間の計測
+    widget.duration_selector.setCurrentIndex(1)
+    widget.on_s_pressed()
+    # 速さのグラフは実時間で進むので、打鍵列を一気に流すと数秒分しか埋まらない。実際の計測の途中と
+    # 同じ描画の手間になるように、合成した打鍵列の長さ分の速さ(かな1文字 = 2打鍵とする)で埋めておく
+    filler = SyntheticTypist(ctx.seed + 1)
+    t = 0
+    while t < ctx.duration_ns:
+        t += filler.interval_ns() + filler.interval_ns()
+        widget.pace_graph.add_kana(t)
+    app.processEvents()
+    t = 0
+    while t < ctx.duration_ns and (limit is None or len(latencies) < limit):
+        interval, key = typist.next(_expected(widget._matcher, widget._kana_pos))
+        t += interval
+        event = QKeyEvent(QEvent.Type.KeyPress, Qt.Key.Key_unknown, Qt.KeyboardModifier.NoModifier, key)
+        start = perf()
+        app.sendEvent(widget, event)
+        app.processEvents()
+        latencies.append(perf() - start)
+    widget.on_escape_pressed()
+    window.close()
+    window.deleteLater()
+    app.processEvents()
+    return {"key": latencies}, len(latencies)
+
+
+def bench_timer(ctx: Context, small: bool) -> tuple[dict[str, array], int]:
+    # 締め切りからの遅れと、表示更新の間隔のずれ
+    interval_ns = display_refresh_interval_ms() * 1_000_000
+    runs = 2 if small else ctx.timer_runs
+    perf = time.perf_counter_ns
+    late = array("q")
+    jitter = array("q")
+    loop = QEventLoop()
+    for _ in range(runs):
+        last: list[Optional[int]] = [None]
+
+        def tick(remaining_ns: int):
+            now = perf()
+            if last[0] is not None and remaining_ns > 0:
+                jitter.append(abs(now - last[0] - interval_ns))
+            last[0] = now
+
+        def finished():
+            late.append(max(0, perf() - timer.deadline_ns))
+            loop.quit()
+
+        timer = TimerController(None, tick, finished, display_refresh_interval_ms())
+        timer.start(ctx.timer_seconds)
+        loop.exec()
+        timer.deleteLater()
+    return {"deadline_late": late, "tick_jitter": jitter}, runs
+
+
+def bench_storage(ctx: Context, small: bool) -> tuple[dict[str, array], int]:
+    # イベントの記録(1件ごと)、解析、保存(集計の更新を含む書き込みの完了まで)、ランキングの読み出し
+    if ctx.session is None:
+        bench_composer(ctx, False)
+    events, prompts = ctx.session
+    if small:
+        events = Events(*(column[:ctx.alloc_keys] for column in (events.t_ns, events.kind, events.code, events.index)))
+    perf = time.perf_counter_ns
+    record_latencies = array("q")
+    analyze_latencies = array("q")
+    commit_latencies = array("q")
+    query_latencies = array("q")
+    with tempfile.TemporaryDirectory(dir=ctx.directory or None) as directory:
+        log = EventLog(spool_dir=directory)
+        log.start(events.t_ns[0], events.index[0])
+        for t_ns, kind, code, index in events:
+            if kind == START or kind == END:
+                continue
+            start = perf()
+            log.record(kind, code, index, t_ns)
+            record_latencies.append(perf() - start)
+        log.stop(events.t_ns[-1], events.index[-1])
+
+        store = SessionStore(os.path.join(directory, "records.sqlite3"))
+        weakness = WeaknessTracker(store.conn)
+        store.add_observer(weakness)
+        store.add_observer(HeatmapStats(store.conn))
+        for _ in range(1 if small else ctx.sessions):
+            start = perf()
+            record = SessionRecord.from_events(events, MODE_1HOUR, prompts=prompts)
+            analyze_latencies.append(perf() - start)
+            done = threading.Event()
+            start = perf()
+            store.submit(record, lambda _: done.set())
+            done.wait()
+            commit_latencies.append(perf() - start)
+            start = perf()
+            store.top_sessions(MODE_1HOUR)
+            store.best_session(MODE_1HOUR)
+            query_latencies.append(perf() - start)
+        store.close()
+    return {"record": record_latencies, "analyze": analyze_latencies,
+            "commit": commit_latencies, "query": query_latencies}, len(events)
+
+
+BENCHES: dict[str, Callable[[Context, bool], tuple[dict[str, array], int]]] = {
+    "composer": bench_composer,
+    "widget": bench_widget,
+    "timer": bench_timer,
+    "storage": bench_storage,
+}
+
+
+def run_stage(name: str, ctx: Context, measure_alloc: bool) -> dict:
+    bench = BENCHES[name]
+    gc.collect()
+    before = [generation["collections"] for generation in gc.get_stats()]
+    start = time.perf_counter()
+    with tracing.span(f"bench.{name}", "bench"):
+        metrics, units = bench(ctx, False)
+    wall = time.perf_counter() - start
+    after = [generation["collections"] for generation in gc.get_stats()]
+    result = {
+        "units": units,
+        "wall_s": round(wall, 3),
+        "latency_us": {metric: _summary(values) for metric, values in metrics.items()},
+        "gc_collections": [b - a for a, b in zip(before, after)],
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    if measure_alloc:
+        gc.collect()
+        # メモリの計測中はトレースしない(記録そのものが確保になる)
+        with tracing.suspended():
+            tracemalloc.start()
+            base, _ = tracemalloc.get_traced_memory()
+            _, alloc_units = bench(ctx, True)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        result["alloc"] = {
+            "units": alloc_units,
+            "peak_bytes": peak - base,
+            "retained_bytes": current - base,
+            "retained_per_unit": round((current - base) / alloc_units, 1) if alloc_units else None,
+        }
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(old: dict, new: dict) -> list[str]:
+    # 段・指標ごとのp50/p99/maxの比。REGRESSION_RATIOより遅くなったものに!を付ける
+    lines = [f"{old.get('revision') or '?'} -> {new.get('revision') or '?'}"]
+    for key in ("minutes", "seed", "timer_seconds"):
+        if old.get("args", {}).get(key) != new["args"].get(key):
+            lines.append(f"  (条件が違います: {key} {old.get('args', {}).get(key)} -> {new['args'].get(key)})")
+    for stage, result in new["stages"].items():
+        previous = old.get("stages", {}).get(stage)
+        if previous is None:
+            continue
+        for metric, summary in result["latency_us"].items():
+            before = previous.get("latency_us", {}).get(metric)
+            if not before or not before.get("count") or not summary.get("count"):
+                continue
+            cells = []
+            for q in ("p50", "p99", "max"):
+                ratio = summary[q] / before[q] if before[q] else 1.0
+                mark = "!" if ratio > REGRESSION_RATIO else " "
+                cells.append(f"{q} {before[q]:9.2f} -> {summary[q]:9.2f} ({ratio:5.2f}x){mark}")
+            lines.append(f"  {stage + '.' + metric:20} " + "  ".join(cells))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="変換器・描画・タイマー・保存のベンチマーク(画面は出さない)")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"実行する段(カンマ区切り: {', '.join(STAGES)})")
+    parser.add_argument("--minutes", type=float, default=60.0, help="合成する打鍵列の長さ(分)")
+    parser.add_argument("--seed", type=int, default=1, help="打鍵列の乱数の種")
+    parser.add_argument("--alloc-keys", type=int, default=3000, help="メモリの確保量を測る打鍵数(0で測らない)")
+    parser.add_argument("--timer-runs", type=int, default=10, help="タイマーを動かす回数")
+    parser.add_argument("--timer-seconds", type=float, default=0.5, help="タイマー1回の長さ(秒)")
+    parser.add_argument("--sessions", type=int, default=3, help="保存する計測の数")
+    parser.add_argument("--output", help="結果のJSONの出力先(省略時はcache/benchに日時とコミットの名前で)")
+    parser.add_argument("--compare", help="比べる前の結果のJSON")
+    parser.add_argument("--trace", metavar="PATH", help="1回目(時間の計測)のトレースをChromeのトレース形式でPATHに書き出す")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in BENCHES]
+    if unknown:
+        parser.error(f"未知の段です: {', '.join(unknown)}")
+
+    app = QApplication([])
+    with tempfile.TemporaryDirectory() as directory:
+        prompts = PromptStore(os.path.join(directory, "prompts.sqlite3"))
+        prompts.sync_json(DEFAULT_PROMPT_PATH)
+        ctx = Context(args, prompts, load_cached())
+        ctx.directory = directory
+        results = {}
+        if args.trace:
+            tracing.enable(args.trace)
+        for stage in stages:
+            print(f"{stage} ...", end="", flush=True)
+            results[stage] = run_stage(stage, ctx, args.alloc_keys > 0)
+            summary = next(iter(results[stage]["latency_us"].values()))
+            print(f" {results[stage]['units']} units, {results[stage]['wall_s']} s,"
+                  f" p50 {summary.get('p50')} us, p99 {summary.get('p99')} us, max {summary.get('max')} us")
+        prompts.close()
+    app.quit()
+
+    revision = git_revision()
+    report = {
+        "revision": revision,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "qt": QT_VERSION_STR,
+        "platform": platform.platform(),
+        "qpa": os.environ.get("QT_QPA_PLATFORM"),
+        "args": vars(args),
+        "stages": results,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    output = args.output
+    if not output:
+        os.makedirs(DEFAULT_OUTPUT_DIR, exist_ok=True)
+        output = os.path.join(DEFAULT_OUTPUT_DIR, f"bench-{time.strftime('%Y%m%d-%H%M%S')}-{revision or 'unknown'}.json")
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"-> {output} (peak RSS {report['peak_rss_kb']} KB)")
+    trace_path = tracing.export()
+    if trace_path:
+        print(f"-> {trace_path} (trace)")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            for line in compare(json.load(file), report):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
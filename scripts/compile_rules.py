@@ -0,0 +1,32 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from composer import DEFAULT_RULES_PATH, ComposerTable, load_rules
+from rule_cache import DEFAULT_CACHE_DIR, cache_path_for, save_table, source_digest
+
+
+# ルール表(JSON / MozcのTSV)をコンパイルしてバイナリキャッシュを作る
+# 起動時にもキャッシュが古ければ自動で作り直されるので、これは事前に作っておきたいとき用
+def main():
+    parser = argparse.ArgumentParser(description="ローマ字/かなルール表をコンパイルしてキャッシュする")
+    parser.add_argument("sources", nargs="*", default=[DEFAULT_RULES_PATH], help="ルール表のパス")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="キャッシュの出力先")
+    args = parser.parse_args()
+
+    for source in args.sources:
+        start = time.perf_counter()
+        table = ComposerTable.from_rules(load_rules(source))
+        with open(source, "rb") as file:
+            digest = source_digest(file.read())
+        path = cache_path_for(source, args.cache_dir)
+        save_table(table, path, digest)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{source} -> {path} ({table.state_count} states, {elapsed:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
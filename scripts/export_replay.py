@@ -0,0 +1,372 @@
+import argparse
+import math
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+# 画面を持たない環境でも描けるように(import PyQt6より前に)
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from replay import Replay
+from storage import DEFAULT_DB_PATH, SessionStore
+
+NS_PER_SECOND = 1_000_000_000
+
+# リプレイの書き出し
+#
+# 保存した計測のリプレイを画面に出さずに描き、連番PNG・無圧縮AVI・APNG(アニメーションPNG)にする。
+# 描画はアプリと同じPromptWidgetにReplayPlayerで打鍵を流し込んで行う(表示は再生と同じになる。
+# 入力方式と変換の有無はリプレイに記録したものに従う)。
+# 書き出すフレームを区間に分けて複数プロセスで描く。各プロセスは区間の先頭へシークし
+# (キーフレームからそのお題の分だけを入れ直すので一瞬)、そこからフレームごとに進める。
+# AVIとAPNGは区間ごとの一時ファイルをこのプロセスで順につなぐ。APNGでは同じ絵が続くフレームを
+# 1枚にまとめて表示時間を延ばす(打鍵の無い間はずっと同じ絵なので小さくなる)
+
+FORMATS = ("png", "avi", "apng")
+DEFAULT_SIZE = (960, 240)
+# 1区間のフレーム数の上限(プロセスの間で仕事が偏らないように細かめに分ける)
+MAX_CHUNK_FRAMES = 600
+# AVI(RIFF)の大きさの上限
+AVI_LIMIT = (1 << 32) - (1 << 20)
+
+_app = None
+_widget = None
+_player = None
+_settings: tuple = ()
+
+
+def _init_worker(replay: Replay, size: tuple[int, int], fps: float, fmt: str, out_dir: str):
+    # 描画用のウィジェットをプロセスごとに1つ作る
+    global _app, _widget, _player, _settings
+    from PyQt6.QtGui import QFont
+    from PyQt6.QtWidgets import QApplication
+    from main import FONT_PATH, FONT_SIZE, _register_font
+    from prompt_widget import PromptWidget
+    from replay import ReplayPlayer
+    from rule_cache import load_cached
+
+    _app = QApplication.instance() or QApplication([])
+    family = _register_font(FONT_PATH)
+    if family:
+        _app.setFont(QFont(family, FONT_SIZE))
+    _widget = PromptWidget(rule_table=load_cached())
+    _widget.setFixedSize(*size)
+    _widget.show()
+    _player = ReplayPlayer(_widget, replay)
+    _settings = (fps, fmt, out_dir, replay.duration_ns)
+
+
+def _frame_time(frame: int, fps: float, duration_ns: int) -> int:
+    return min(duration_ns, round(frame * NS_PER_SECOND / fps))
+
+
+def _grab():
+    _app.processEvents()
+    return _widget.grab().toImage()
+
+
+def _rgb_rows(image) -> bytes:
+    # PNGの画像データ(行ごとにフィルタ0を付けたRGB)
+    from PyQt6.QtGui import QImage
+    image = image.convertToFormat(QImage.Format.Format_RGB888)
+    width, height = image.width(), image.height()
+    stride = image.bytesPerLine()
+    data = image.constBits().asstring(image.sizeInBytes())
+    row = width * 3
+    return b"".join(b"\x00" + data[y * stride:y * stride + row] for y in range(height))
+
+
+def _dib(image) -> bytes:
+    # AVIのフレーム(下の行から、BGR、行は4バイト境界まで詰める。QImageの行の詰め方と同じ)
+    from PyQt6.QtGui import QImage
+    image = image.convertToFormat(QImage.Format.Format_BGR888).mirrored(False, True)
+    return image.constBits().asstring(image.sizeInBytes())
+
+
+def render_range(start: int, end: int) -> str:
+    # フレーム[start, end)を描き、書き出したファイル(連番PNGなら出力先のディレクトリ)を返す
+    fps, fmt, out_dir, duration_ns = _settings
+    _player.seek(_frame_time(start, fps, duration_ns))
+    if fmt == "png":
+        for frame in range(start, end):
+            _player.advance_to(_frame_time(frame, fps, duration_ns))
+            _grab().save(os.path.join(out_dir, f"frame_{frame:06d}.png"), "PNG")
+        return out_dir
+    path = os.path.join(out_dir, f"chunk_{start:08d}.{fmt}")
+    with open(path, "wb") as file:
+        previous = None
+        repeat = 0
+
+        def put():
+            if previous is not None:
+                file.write(struct.pack("<II", repeat, len(previous)))
+                file.write(previous)
+
+        for frame in range(start, end):
+            _player.advance_to(_frame_time(frame, fps, duration_ns))
+            image = _grab()
+            if fmt == "avi":
+                file.write(_dib(image))
+                continue
+            # APNG: 同じ絵が続けば数えるだけ(zlibは同じ入力なら同じ出力になる)
+            data = zlib.compress(_rgb_rows(image), 6)
+            if data == previous:
+                repeat += 1
+            else:
+                put()
+                previous, repeat = data, 1
+        put()
+    return path
+
+
+class _Inline:
+    # --jobs 0 のときはこのプロセスで描く
+    def __init__(self, *args):
+        _init_worker(*args)
+
+    def submit(self, fn, *args):
+        result = fn(*args)
+
+        class _Done:
+            def result(self):
+                return result
+        return _Done()
+
+    def shutdown(self):
+        pass
+
+
+# ---- 書き出し ----
+
+class AviWriter:
+    # 無圧縮(24bit DIB)のAVI。フレームの大きさはすべて同じ
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        self.file = open(path, "wb")
+        self.width = width
+        self.height = height
+        self.frame_size = ((width * 3 + 3) & ~3) * height
+        self.frames = 0
+        self._index = bytearray()
+        rate, scale = round(fps * 1000), 1000
+        avih = struct.pack("<10I16x", round(1_000_000 / fps), math.ceil(self.frame_size * fps), 0, 0x10,
+                           0, 0, 1, self.frame_size, width, height)
+        strh = struct.pack("<4s4sIHHIIIIIIIIhhhh", b"vids", b"DIB ", 0, 0, 0, 0, scale, rate, 0, 0,
+                           self.frame_size, 0xFFFFFFFF, 0, 0, 0, width, height)
+        strf = struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0, self.frame_size, 0, 0, 0, 0)
+        strl = b"strl" + self._chunk(b"strh", strh) + self._chunk(b"strf", strf)
+        hdrl = b"hdrl" + self._chunk(b"avih", avih) + self._chunk(b"LIST", strl)
+        self.file.write(b"RIFF\0\0\0\0AVI ")
+        self._avih_at = self.file.tell() + 8 + 4 + 8
+        self._strh_at = self._avih_at + len(avih) + 8 + 4 + 8
+        self.file.write(self._chunk(b"LIST", hdrl))
+        self._movi_at = self.file.tell()
+        self.file.write(b"LIST\0\0\0\0movi")
+
+    @staticmethod
+    def _chunk(fourcc: bytes, data: bytes) -> bytes:
+        return fourcc + struct.pack("<I", len(data)) + data + (b"\0" if len(data) & 1 else b"")
+
+    def write_frame(self, data: bytes):
+        # idx1の位置はmoviのfourccからの距離
+        offset = self.file.tell() - (self._movi_at + 8)
+        self._index += struct.pack("<4sIII", b"00db", 0x10, offset, len(data))
+        self.file.write(self._chunk(b"00db", data))
+        self.frames += 1
+
+    def close(self):
+        file = self.file
+        movi_end = file.tell()
+        file.write(self._chunk(b"idx1", bytes(self._index)))
+        end = file.tell()
+        file.seek(4)
+        file.write(struct.pack("<I", end - 8))
+        file.seek(self._movi_at + 4)
+        file.write(struct.pack("<I", movi_end - self._movi_at - 8))
+        # avihのdwTotalFrames、strhのdwLength
+        file.seek(self._avih_at + 16)
+        file.write(struct.pack("<I", self.frames))
+        file.seek(self._strh_at + 32)
+        file.write(struct.pack("<I", self.frames))
+        file.close()
+
+
+class ApngWriter:
+    # アニメーションPNG。フレームごとに表示時間(フレーム数)を持てる
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        self.file = open(path, "wb")
+        self.width = width
+        self.height = height
+        # 表示時間は repeat/fps 秒(分母は16bitなので整数に丸める)
+        self.fps = max(1, min(0xFFFF, round(fps)))
+        self.frames = 0
+        self._sequence = 0
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        self._actl_at = self.file.tell()
+        self._chunk(b"acTL", struct.pack(">II", 0, 0))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.file.write(struct.pack(">I", len(data)) + kind + data
+                        + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def write_frame(self, data: bytes, repeat: int = 1):
+        # dataはzlibで圧縮した画像データ。repeatフレーム分表示する
+        while repeat > 0:
+            delay = min(repeat, 0xFFFF)
+            repeat -= delay
+            self._chunk(b"fcTL", struct.pack(">IIIIIHHBB", self._sequence, self.width, self.height, 0, 0,
+                                             delay, self.fps, 0, 0))
+            self._sequence += 1
+            if self.frames == 0:
+                self._chunk(b"IDAT", data)
+            else:
+                self._chunk(b"fdAT", struct.pack(">I", self._sequence) + data)
+                self._sequence += 1
+            self.frames += 1
+
+    def close(self):
+        self._chunk(b"IEND", b"")
+        self.file.seek(self._actl_at)
+        self._chunk(b"acTL", struct.pack(">II", self.frames, 0))
+        self.file.close()
+
+
+def _join_avi(chunks: list[str], path: str, size: tuple[int, int], fps: float) -> int:
+    writer = AviWriter(path, *size, fps)
+    for chunk in chunks:
+        with open(chunk, "rb") as file:
+            while data := file.read(writer.frame_size):
+                writer.write_frame(data)
+        os.remove(chunk)
+    writer.close()
+    return writer.frames
+
+
+def _join_apng(chunks: list[str], path: str, size: tuple[int, int], fps: float) -> int:
+    # 区間の境目をまたいで同じ絵が続く分もまとめる
+    writer = ApngWriter(path, *size, fps)
+    previous: Optional[bytes] = None
+    repeat = 0
+    for chunk in chunks:
+        with open(chunk, "rb") as file:
+            while header := file.read(8):
+                count, length = struct.unpack("<II", header)
+                data = file.read(length)
+                if data == previous:
+                    repeat += count
+                    continue
+                if previous is not None:
+                    writer.write_frame(previous, repeat)
+                previous, repeat = data, count
+        os.remove(chunk)
+    if previous is not None:
+        writer.write_frame(previous, repeat)
+    writer.close()
+    return writer.frames
+
+
+def _parse_size(value: str) -> tuple[int, int]:
+    try:
+        width, height = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("大きさは 幅x高さ で指定してください(例: 960x240)")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("大きさは正の数で指定してください")
+    return width, height
+
+
+def main():
+    parser = argparse.ArgumentParser(description="計測のリプレイを画面に出さずに描き、動画・連番画像に書き出す")
+    parser.add_argument("session", nargs="?", type=int, help="計測のid(省略時は最新の計測)")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="計測記録のデータベース")
+    parser.add_argument("--format", choices=FORMATS, default="png", help="連番PNG / 無圧縮AVI / APNG")
+    parser.add_argument("--output", help="書き出し先(連番PNGならディレクトリ。省略時は replay-<id> に拡張子を付けたもの)")
+    parser.add_argument("--fps", type=float, default=30.0, help="1秒当たりのフレーム数")
+    parser.add_argument("--size", type=_parse_size, default=DEFAULT_SIZE, help="フレームの大きさ(幅x高さ)")
+    parser.add_argument("--start", type=float, default=0.0, help="書き出しを始める位置(秒)")
+    parser.add_argument("--end", type=float, default=None, help="書き出しを終える位置(秒。省略時は最後まで)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="描画のプロセス数(0ならこのプロセスで描く)")
+    args = parser.parse_args()
+    if args.fps <= 0:
+        parser.error("--fps は正の数で指定してください")
+
+    store = SessionStore(args.db)
+    try:
+        session_id = args.session
+        if session_id is None:
+            latest = store.history(limit=1)
+            if not latest:
+                print("計測の記録がありません", file=sys.stderr)
+                sys.exit(1)
+            session_id = latest[0].id
+        replay = store.load_replay(session_id)
+    finally:
+        store.close()
+    if replay is None:
+        print(f"計測 {session_id} のリプレイがありません", file=sys.stderr)
+        sys.exit(1)
+
+    duration = replay.duration_ns / NS_PER_SECOND
+    end = min(duration, args.end) if args.end is not None else duration
+    first = max(0, math.ceil(args.start * args.fps))
+    last = math.floor(end * args.fps) + 1
+    if first >= last:
+        print(f"書き出す範囲がありません(計測の長さは {duration:.1f} 秒)", file=sys.stderr)
+        sys.exit(1)
+    width, height = args.size
+    if args.format == "avi":
+        frame_size = ((width * 3 + 3) & ~3) * height
+        if (last - first) * (frame_size + 24) > AVI_LIMIT:
+            print("無圧縮AVIの大きさの上限(4GB)を超えます。--fps か --size を下げるか、"
+                  "--format apng / png を使ってください", file=sys.stderr)
+            sys.exit(1)
+    extension = {"png": "", "avi": ".avi", "apng": ".png"}[args.format]
+    output = args.output or f"replay-{session_id}{extension}"
+
+    if args.format == "png":
+        os.makedirs(output, exist_ok=True)
+        work_dir = output
+    else:
+        directory = os.path.dirname(os.path.abspath(output))
+        os.makedirs(directory, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix="export-", dir=directory)
+
+    start_time = time.perf_counter()
+    jobs = max(0, args.jobs)
+    chunk_frames = max(1, min(MAX_CHUNK_FRAMES, math.ceil((last - first) / max(1, jobs * 4))))
+    ranges = [(start, min(last, start + chunk_frames)) for start in range(first, last, chunk_frames)]
+    initargs = (replay, args.size, args.fps, args.format, work_dir)
+    if jobs > 0:
+        pool = ProcessPoolExecutor(min(jobs, len(ranges)), initializer=_init_worker, initargs=initargs)
+    else:
+        pool = _Inline(*initargs)
+    try:
+        futures = [pool.submit(render_range, start, stop) for start, stop in ranges]
+        chunks = [future.result() for future in futures]
+        pool.shutdown()
+        if args.format == "avi":
+            written = _join_avi(chunks, output, args.size, args.fps)
+        elif args.format == "apng":
+            written = _join_apng(chunks, output, args.size, args.fps)
+        else:
+            written = last - first
+    finally:
+        if work_dir != output:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    elapsed = time.perf_counter() - start_time
+    span = (last - first) / args.fps
+    print(f"計測 {session_id}: {last - first} フレーム({span:.1f} 秒分)を {output} に書き出しました"
+          f"({written} 枚, {elapsed:.1f} 秒, 実時間の {elapsed / span:.2f} 倍)")
+
+
+if __name__ == "__main__":
+    main()
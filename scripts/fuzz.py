@@ -0,0 +1,282 @@
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+from typing import Callable
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from composer import DEFAULT_RULES_PATH, EMITTED, KEY_BASE, KEY_COUNT, MISSED, Composer, ComposerTable
+from conversion import ConversionDiff
+from matcher import KANA_RULES_PATH, ComposerMatcher
+from pace_graph import Downsampler
+from planner import INF
+from prompt_store import DEFAULT_PROMPT_PATH
+from rule_cache import cache_path_for, load_cached, load_table, source_digest
+
+NS_PER_MS = 1_000_000
+
+# 打鍵列の生成と、ファズによる不変条件の検査
+#
+# SyntheticTypistは「次に打つべきキー」を受け取って、人が打ったような打鍵を1つずつ作る
+# (間隔は対数正規分布、ときどきミス打鍵と手を止める間が入る)。noiseを上げるとお題を無視した
+# でたらめな打鍵が混ざり、1にすると完全にでたらめになる。ベンチマーク(bench.py)の打鍵列も
+# これで作る。このスクリプト自体は、でたらめな打鍵・編集を変換器や照合に流し、
+# 内部の状態が崩れないか(結果が素直な実装と一致するか)を調べる
+
+# 打てるキー(composerの列と同じ範囲)
+KEYS = "".join(chr(KEY_BASE + i) for i in range(KEY_COUNT))
+
+
+class SyntheticTypist:
+    def __init__(self, seed: int = 0, interval_ms: float = 150.0, spread: float = 0.45,
+                 mistake_rate: float = 0.03, pause_rate: float = 0.002, pause_ms: float = 2000.0,
+                 noise: float = 0.0):
+        self.random = random.Random(seed)
+        # 打鍵間隔の中央値と、対数での広がり
+        self._mu = math.log(max(1.0, interval_ms))
+        self._sigma = spread
+        self.mistake_rate = mistake_rate
+        self.pause_rate = pause_rate
+        self.pause_ms = pause_ms
+        self.noise = noise
+
+    def interval_ns(self) -> int:
+        rng = self.random
+        interval = rng.lognormvariate(self._mu, self._sigma)
+        if rng.random() < self.pause_rate:
+            interval += rng.expovariate(1.0 / self.pause_ms)
+        return int(interval * NS_PER_MS)
+
+    def key(self, expected: str = "") -> str:
+        # expectedは次に打つべきキー(分からなければ空)
+        rng = self.random
+        if not expected or rng.random() < self.noise:
+            return rng.choice(KEYS)
+        if rng.random() < self.mistake_rate:
+            key = rng.choice(KEYS)
+            return key if key != expected else rng.choice(KEYS)
+        return expected
+
+    def next(self, expected: str = "") -> tuple[int, str]:
+        # (前の打鍵からの間隔, キー)
+        return self.interval_ns(), self.key(expected)
+
+
+def load_kana_samples(path: str = DEFAULT_PROMPT_PATH) -> list[str]:
+    import json
+    try:
+        with open(path, encoding="utf-8") as file:
+            return [p["kana"] for p in json.load(file) if isinstance(p, dict) and p.get("kana")]
+    except (OSError, ValueError):
+        return []
+
+
+# ---- 検査 ----
+# どれも失敗すればAssertionErrorを投げる。メッセージには再現に要る情報を入れる
+
+def check_composer(table: ComposerTable, rng: random.Random, length: int):
+    # 1打鍵ずつ流した結果が、まとめて変換した結果と一致するか。状態は表の範囲に収まるか
+    keys = "".join(rng.choice(KEYS) for _ in range(length))
+    composer = Composer(table)
+    out = ""
+    misses = 0
+    for i, key in enumerate(keys):
+        result = composer.feed(key)
+        assert 0 <= composer.state < table.state_count, f"state out of range after {keys[:i + 1]!r}"
+        if result & EMITTED:
+            erased = composer.erased
+            assert erased <= len(out), f"erased {erased} > {len(out)} after {keys[:i + 1]!r}"
+            out = out[:len(out) - erased] + composer.emitted
+        if result & MISSED:
+            misses += 1
+    result = composer.flush()
+    if result & EMITTED:
+        out = out[:len(out) - composer.erased] + composer.emitted
+    if result & MISSED:
+        misses += 1
+    expected = Composer(table).convert(keys)
+    assert (out, misses) == expected, f"convert mismatch for {keys!r}: {(out, misses)} != {expected}"
+
+
+def check_matcher(table: ComposerTable, kana: str, typist: SyntheticTypist, max_keys: int):
+    # 照合の位置は戻らず、確定したかなはお題どおりで、どこからでも計画どおりに打てば打ち切れるか
+    matcher = ComposerMatcher(table)
+    planner = matcher.planner
+    matcher.set_target("", kana, [])
+    assert planner.cost(0) < INF, f"{kana!r} is not typable"
+    pos = 0
+    typed = ""
+    for _ in range(max_keys):
+        if pos >= len(kana):
+            return
+        keys, _ = matcher.plan(pos)
+        key = typist.key(keys[len(matcher.preedit):][:1])
+        typed += key
+        result, new_pos = matcher.feed(pos, key)
+        if result & MISSED:
+            assert new_pos == pos, f"missed key moved position: {typed!r}"
+            continue
+        assert pos <= new_pos <= len(kana), f"position {pos} -> {new_pos} for {typed!r}"
+        if result & EMITTED:
+            # お題の最後で強制確定したときは、その前に確定した分と合わせてkana[pos:new_pos]になる
+            emitted = matcher.composer.emitted
+            assert kana[pos:new_pos] == emitted or (new_pos == len(kana) and kana[pos:new_pos].endswith(emitted)), \
+                f"emitted {emitted!r} != {kana[pos:new_pos]!r} for {typed!r}"
+        assert planner.cost(new_pos, matcher.composer.state) < INF, f"accepted a dead end: {typed!r}"
+        pos = new_pos
+    # 残りを計画どおりに打ち切る
+    keys, _ = matcher.plan(pos)
+    for key in keys[len(matcher.preedit):]:
+        result, pos = matcher.feed(pos, key)
+        assert not result & MISSED, f"plan key {key!r} missed after {typed!r}"
+    assert pos == len(kana), f"plan stopped at {pos}/{len(kana)} after {typed!r}"
+
+
+def check_typing(table: ComposerTable, kana: str, keys: str):
+    # 決まった打鍵列でお題を最後まで打ち切れるか(最後のかなが保留のまま終わる場合も含む)
+    matcher = ComposerMatcher(table)
+    matcher.set_target("", kana, [])
+    assert matcher.typable("", kana), f"{kana!r} is not typable"
+    pos = 0
+    for i, key in enumerate(keys):
+        result, pos = matcher.feed(pos, key)
+        assert not result & MISSED, f"key {key!r} missed after {keys[:i]!r} for {kana!r}"
+    assert pos == len(kana) and matcher.clean, f"{keys!r} stopped at {pos}/{len(kana)} for {kana!r}"
+
+
+# 決まった打鍵列で打ち切れるはずのお題 (表の名前, かな, 打鍵列)
+TYPING_CASES = (
+    ("romaji", "です", "desu"),
+    ("romaji", "みかん", "mikan"),
+    ("kana", "です", "w@r"),
+    ("kana", "かきくけこ", "tgh:b"),
+    ("kana", "ありがとうございます", "3lt@s4b@x@ejr"),
+)
+
+
+def check_typable(matcher: ComposerMatcher, kana: str):
+    # お題集のかなが、この表で最後まで打ち切れるか
+    assert matcher.typable("", kana), f"{kana!r} is not typable"
+
+
+def check_cache(source_path: str, rng: random.Random):
+    # 途中で切れた・壊れたキャッシュは読み込みで捨て、コンパイルし直して書き直すか
+    with tempfile.TemporaryDirectory() as cache_dir:
+        table = load_cached(source_path, cache_dir)
+        path = cache_path_for(source_path, cache_dir)
+        with open(path, "rb") as file:
+            data = file.read()
+        with open(source_path, "rb") as file:
+            digest = source_digest(file.read())
+        cut = rng.randrange(len(data))
+        with open(path, "wb") as file:
+            file.write(data[:cut])
+        assert load_table(path, digest) is None, f"loaded a cache truncated at {cut}/{len(data)}"
+        reloaded = load_cached(source_path, cache_dir)
+        assert reloaded.state_input == table.state_input, f"recompiled table differs after truncation at {cut}"
+        with open(path, "rb") as file:
+            assert file.read() == data, f"cache not rewritten after truncation at {cut}"
+        # 中身を書き換えただけのものは読めても読めなくてもよいが、例外で落ちてはいけない
+        corrupt = bytearray(data)
+        for _ in range(4):
+            corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+        with open(path, "wb") as file:
+            file.write(corrupt)
+        load_table(path, digest)
+
+
+def check_conversion(target: str, rng: random.Random, edits: int):
+    # 編集ごとの照合が、入力全体を先頭から比べ直した結果と一致するか
+    diff = ConversionDiff(target)
+    text = ""
+    alphabet = target[:8] + "x"
+    for _ in range(edits):
+        if rng.random() < 0.6:
+            start, removed = len(text), 0
+            inserted = target[len(text):len(text) + rng.randint(1, 2)] if rng.random() < 0.9 else "x"
+        else:
+            start = rng.randint(0, len(text))
+            removed = rng.randint(0, min(3, len(text) - start))
+            inserted = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 2)))
+        text = text[:start] + inserted + text[start + removed:]
+        diff.apply(start, removed, inserted)
+        match = 0
+        while match < min(len(text), len(target)) and text[match] == target[match]:
+            match += 1
+        assert diff.text == text and diff.matched == match, \
+            f"diff {diff.matched} != {match} after edit ({start}, {removed}, {inserted!r})"
+
+
+def check_downsampler(rng: random.Random, samples: int):
+    # まとめ直しても件数・合計・最小・最大が崩れないか
+    series = Downsampler(buckets=rng.choice((2, 4, 16, 256)), width_ns=rng.randint(1, 1000))
+    t = 0
+    total = 0.0
+    low, high = math.inf, -math.inf
+    for _ in range(samples):
+        t += rng.randint(0, 5000)
+        value = rng.uniform(0.0, 20.0)
+        series.add(t, value)
+        total += value
+        low, high = min(low, value), max(high, value)
+    assert sum(series.counts) == samples, "lost samples"
+    assert math.isclose(sum(series.sums), total, rel_tol=1e-9), "sum drifted"
+    used = [i for i in range(series.buckets) if series.counts[i]]
+    assert min(series.mins[i] for i in used) == low and max(series.maxs[i] for i in used) == high, "min/max lost"
+    assert used[-1] == series.last, "last bucket mismatch"
+
+
+def run(iterations: int, seed: int, log: Callable[[str], None] = print) -> int:
+    # 各検査をiterations回ずつ行い、失敗の数を返す
+    rng = random.Random(seed)
+    tables = [("romaji", load_cached()), ("kana", load_cached(KANA_RULES_PATH))]
+    samples = load_kana_samples() or ["てすと"]
+    failures = 0
+
+    def attempt(name: str, check: Callable[[], None], case_seed: int):
+        nonlocal failures
+        try:
+            check()
+        except AssertionError as e:
+            failures += 1
+            log(f"FAIL {name} (seed {case_seed}): {e}")
+
+    for name, table in tables:
+        matcher = ComposerMatcher(table)
+        for kana in samples:
+            attempt(f"corpus/{name}", lambda: check_typable(matcher, kana), seed)
+    for name, source_path in (("romaji", DEFAULT_RULES_PATH), ("kana", KANA_RULES_PATH)):
+        attempt(f"cache/{name}", lambda: check_cache(source_path, random.Random(seed)), seed)
+    by_name = dict(tables)
+    for name, kana, keys in TYPING_CASES:
+        attempt(f"typing/{name}", lambda: check_typing(by_name[name], kana, keys), seed)
+    for i in range(iterations):
+        case_seed = rng.randrange(1 << 30)
+        case = random.Random(case_seed)
+        for name, table in tables:
+            attempt(f"composer/{name}", lambda: check_composer(table, case, case.randint(1, 64)), case_seed)
+            kana = case.choice(samples)
+            kana = kana[case.randrange(len(kana)):]
+            typist = SyntheticTypist(case_seed, mistake_rate=0.1, noise=case.choice((0.0, 0.2, 1.0)))
+            attempt(f"matcher/{name}", lambda: check_matcher(table, kana, typist, 4 * len(kana) + 8), case_seed)
+        attempt("conversion", lambda: check_conversion(case.choice(samples), case, 200), case_seed)
+        attempt("downsampler", lambda: check_downsampler(case, case.randint(1, 2000)), case_seed)
+    log(f"{iterations} iterations, {failures} failures")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="変換器・照合などにでたらめな入力を流して不変条件を調べる")
+    parser.add_argument("iterations", nargs="?", type=int, default=200, help="検査の回数")
+    parser.add_argument("--seed", type=int, default=None, help="乱数の種(省略時は毎回変える)")
+    args = parser.parse_args()
+    seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+    print(f"seed {seed}")
+    sys.exit(1 if run(args.iterations, seed) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from composer import DEFAULT_RULES_PATH
+from planner import KeystrokePlanner
+from prompt_store import DEFAULT_DB_PATH, PromptStore, text_hash
+from rule_cache import load_cached
+
+# お題の一括取り込み
+# 大きなJSON/JSONL/TSVを少しずつ読み、textのハッシュで重複を除き、kanaが入力ルールで
+# 打ち切れるかと長さが妥当かを複数プロセスで検査して、通ったものをまとめて書き込む
+
+CHUNK_SIZE = 2000
+_READ_SIZE = 1 << 16
+
+# 1件分: (取り込み元での番号, id, text, kana)
+Record = tuple[int, Optional[str], str, str]
+
+
+def _record(number: int, item) -> Optional[Record]:
+    if not isinstance(item, dict):
+        return None
+    source_id = item.get("id")
+    return (number, str(source_id) if source_id is not None else None,
+            str(item.get("text") or ""), str(item.get("kana") or ""))
+
+
+def iter_json_array(file) -> Iterator[Record]:
+    # トップレベルの配列を要素ごとに読む(全体は読み込まない)
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    number = 0
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = file.read(_READ_SIZE)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer):
+            if eof or not fill():
+                return
+            continue
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("JSONの先頭が配列ではありません")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # 要素の途中でバッファが切れている
+            if eof or not fill():
+                raise
+            continue
+        pos = end
+        record = _record(number, item)
+        if record is not None:
+            yield record
+        number += 1
+
+
+def iter_jsonl(file) -> Iterator[Record]:
+    for number, line in enumerate(file):
+        line = line.strip()
+        if not line:
+            continue
+        record = _record(number, json.loads(line))
+        if record is not None:
+            yield record
+
+
+def iter_tsv(file) -> Iterator[Record]:
+    # text<TAB>kana[<TAB>id]。先頭行が見出し(text, kana)なら読み飛ばす
+    for number, line in enumerate(file):
+        fields = line.rstrip("\r\n").split("\t")
+        if len(fields) < 2 or (number == 0 and fields[0] == "text" and fields[1] == "kana"):
+            continue
+        yield number, fields[2] if len(fields) > 2 and fields[2] else None, fields[0], fields[1]
+
+
+READERS = {"json": iter_json_array, "jsonl": iter_jsonl, "tsv": iter_tsv}
+
+
+def detect_format(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if ext in (".tsv", ".txt"):
+        return "tsv"
+    return "json"
+
+
+# ---- 検査(ワーカープロセス) ----
+
+_planner: Optional[KeystrokePlanner] = None
+
+
+def _init_worker(rules_path: str):
+    global _planner
+    _planner = KeystrokePlanner(load_cached(rules_path))
+
+
+def validate(record: Record, min_ratio: float, max_ratio: float, max_length: int) -> Optional[str]:
+    # 取り込めないならその理由
+    _, _, text, kana = record
+    if not text or not kana:
+        return "empty"
+    if len(text) > max_length:
+        return "too_long"
+    ratio = len(kana) / len(text)
+    if ratio < min_ratio or ratio > max_ratio:
+        return "kana_length"
+    typed = _planner.typable_prefix(kana)
+    if typed < len(kana):
+        return f"untypable@{typed}"
+    return None
+
+
+def validate_chunk(records: list[Record], min_ratio: float, max_ratio: float,
+                   max_length: int) -> list[Optional[str]]:
+    return [validate(record, min_ratio, max_ratio, max_length) for record in records]
+
+
+class _Inline:
+    # --jobs 0 のときはこのプロセスで検査する
+    def __init__(self, rules_path: str):
+        _init_worker(rules_path)
+
+    def submit(self, fn, *args):
+        result = fn(*args)
+
+        class _Done:
+            def result(self):
+                return result
+        return _Done()
+
+    def shutdown(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="お題をまとめて取り込む(JSON配列 / JSONL / TSV)")
+    parser.add_argument("sources", nargs="+", help="取り込むファイル")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="お題の保存先")
+    parser.add_argument("--rules", default=DEFAULT_RULES_PATH, help="kanaの検査に使う入力ルール表")
+    parser.add_argument("--format", choices=sorted(READERS), help="ファイル形式(省略時は拡張子で判断)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="検査のプロセス数(0ならこのプロセスで行う)")
+    parser.add_argument("--min-ratio", type=float, default=0.8, help="kanaの文字数/textの文字数の下限")
+    parser.add_argument("--max-ratio", type=float, default=4.0, help="kanaの文字数/textの文字数の上限")
+    parser.add_argument("--max-length", type=int, default=400, help="textの文字数の上限")
+    parser.add_argument("--report", default="import_rejects.jsonl", help="取り込まなかったお題の一覧の出力先")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    store = PromptStore(args.db)
+    seen = store.text_hashes()
+    if args.jobs > 0:
+        pool = ProcessPoolExecutor(args.jobs, initializer=_init_worker, initargs=(args.rules,))
+    else:
+        pool = _Inline(args.rules)
+    limits = (args.min_ratio, args.max_ratio, args.max_length)
+    reasons: Counter = Counter()
+    added = 0
+
+    with open(args.report, "w", encoding="utf-8") as report:
+        def reject(source: str, record: Record, reason: str):
+            reasons[reason.split("@")[0]] += 1
+            number, source_id, text, kana = record
+            report.write(json.dumps({"source": source, "record": number, "id": source_id, "text": text,
+                                     "kana": kana, "reason": reason}, ensure_ascii=False) + "\n")
+
+        for path in args.sources:
+            source = os.path.basename(path)
+            reader = READERS[args.format or detect_format(path)]
+            # 検査中のチャンクは最大 jobs*2 個まで(読み込みが検査より先に進みすぎないように)
+            pending: deque = deque()
+
+            def collect():
+                nonlocal added
+                chunk, future = pending.popleft()
+                accepted = []
+                for record, reason in zip(chunk, future.result()):
+                    if reason is None:
+                        accepted.append(record[1:])
+                    else:
+                        reject(source, record, reason)
+                # 1チャンク = 1トランザクション
+                added += store.add_many(source, accepted, batch_size=CHUNK_SIZE)
+
+            with open(path, "r", encoding="utf-8") as file:
+                chunk: list[Record] = []
+                for record in reader(file):
+                    digest = text_hash(record[2])
+                    if digest in seen:
+                        reject(source, record, "duplicate")
+                        continue
+                    seen.add(digest)
+                    chunk.append(record)
+                    if len(chunk) >= CHUNK_SIZE:
+                        pending.append((chunk, pool.submit(validate_chunk, chunk, *limits)))
+                        chunk = []
+                        while len(pending) > max(1, args.jobs) * 2:
+                            collect()
+                if chunk:
+                    pending.append((chunk, pool.submit(validate_chunk, chunk, *limits)))
+                while pending:
+                    collect()
+    pool.shutdown()
+    store.close()
+
+    elapsed = time.perf_counter() - start
+    rejected = sum(reasons.values())
+    print(f"取り込み {added} 件, 除外 {rejected} 件 ({elapsed:.1f} 秒)")
+    for reason, count in reasons.most_common():
+        print(f"  {reason}: {count}")
+    if rejected:
+        print(f"除外したお題の一覧: {args.report}")
+
+
+if __name__ == "__main__":
+    main()
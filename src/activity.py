@@ -0,0 +1,194 @@
+import contextlib
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+# 日別・月別の活動の集計(起動回数、計測回数、打鍵数、練習した時間、スコアの最高と平均)
+#
+# カレンダーや推移のグラフを開くたびに全部の計測をGROUP BYし直さないように、
+# 日(YYYY-MM-DD)・月(YYYY-MM)ごとの行にまとめて持っておく(日付はローカル時刻で区切る)。
+# 行は計測モード・入力方式・変換の有無ごとに分け(漢直はミスを数えないのでスコアを混ぜない)、
+# 起動回数はモード "" の行に数える。
+# 集計済みの計測・起動の最後のidを覚えておき、それより後の分だけを足す。記録の書き込みと
+# 同じトランザクションで足し、起動時にも残りを足すので、集計の無かった頃の記録も最初の起動で入る。
+# 元の記録(sessions, launches)から作り直せる(rebuild)。集計の形を変えたらVERSIONを上げれば
+# 次の起動で作り直す
+
+VERSION = 2
+PERIODS = ("day", "month")
+_BUCKET = {"day": "date(started_at, 'unixepoch', 'localtime')",
+           "month": "strftime('%Y-%m', started_at, 'unixepoch', 'localtime')"}
+_LAUNCH_BUCKET = {period: bucket.replace("started_at", "launched_at") for period, bucket in _BUCKET.items()}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS launches (
+    id INTEGER PRIMARY KEY,
+    launched_at REAL NOT NULL        -- 起動時刻(UNIX秒)
+);
+CREATE TABLE IF NOT EXISTS activity_state (
+    name TEXT PRIMARY KEY,           -- "version" / "sessions" / "launches"(集計済みの最後のid)
+    value INTEGER NOT NULL
+);
+"""
+
+_ACTIVITY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity (
+    period TEXT NOT NULL,            -- "day" / "month"
+    bucket TEXT NOT NULL,            -- YYYY-MM-DD / YYYY-MM
+    mode TEXT NOT NULL,              -- 計測モード(起動回数の行は "")
+    input_method TEXT NOT NULL,      -- 入力方式(起動回数の行は "")
+    conversion INTEGER NOT NULL,     -- 変換ありか(起動回数の行は0)
+    launches INTEGER NOT NULL DEFAULT 0,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    keystrokes INTEGER NOT NULL DEFAULT 0,
+    kana_count INTEGER NOT NULL DEFAULT 0,
+    mistakes INTEGER NOT NULL DEFAULT 0,
+    typed_ns INTEGER NOT NULL DEFAULT 0,   -- 計測した時間の合計
+    score_max INTEGER NOT NULL DEFAULT 0,
+    score_sum INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, bucket, mode, input_method, conversion)
+) WITHOUT ROWID;
+"""
+
+_FOLD_SESSIONS = """
+INSERT INTO activity (period, bucket, mode, input_method, conversion, sessions, keystrokes, kana_count, mistakes,
+                      typed_ns, score_max, score_sum)
+SELECT ?, {bucket}, mode, input_method, conversion, COUNT(*), SUM(keystrokes), SUM(kana_count), SUM(mistakes),
+       SUM(duration_ns), MAX(score), SUM(score)
+FROM sessions WHERE id > ? GROUP BY 2, 3, 4, 5
+ON CONFLICT (period, bucket, mode, input_method, conversion) DO UPDATE SET
+    sessions = sessions + excluded.sessions,
+    keystrokes = keystrokes + excluded.keystrokes,
+    kana_count = kana_count + excluded.kana_count,
+    mistakes = mistakes + excluded.mistakes,
+    typed_ns = typed_ns + excluded.typed_ns,
+    score_max = MAX(score_max, excluded.score_max),
+    score_sum = score_sum + excluded.score_sum
+"""
+
+_FOLD_LAUNCHES = """
+INSERT INTO activity (period, bucket, mode, input_method, conversion, launches)
+SELECT ?, {bucket}, '', '', 0, COUNT(*) FROM launches WHERE id > ? GROUP BY 2
+ON CONFLICT (period, bucket, mode, input_method, conversion) DO UPDATE SET launches = launches + excluded.launches
+"""
+
+
+@dataclass
+class ActivitySummary:
+    # 1日(1か月)分
+    bucket: str
+    launches: int
+    sessions: int
+    keystrokes: int
+    kana_count: int
+    mistakes: int
+    typed_ns: int
+    score_max: int
+    score_sum: int
+
+    @property
+    def score_mean(self) -> float:
+        return self.score_sum / self.sessions if self.sessions else 0.0
+
+
+@contextlib.contextmanager
+def _immediate(conn: sqlite3.Connection):
+    # 書き込みスレッドと並んでも、集計済みのidを読んでから足し終えるまでを割り込ませない
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+class ActivityRollup:
+    # SessionStoreが持つ。書き込みは渡されたconnで行い、読み出しは作ったときのconn(UIスレッド)で行う
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+        conn.executescript(_SCHEMA)
+        with _immediate(conn):
+            if self._state(conn, "version") != VERSION:
+                # 集計の形が変わった: 表ごと作り直して元の記録から集計し直す
+                conn.execute("DROP TABLE IF EXISTS activity")
+                conn.execute(_ACTIVITY_SCHEMA)
+                self._clear(conn)
+            self.catch_up(conn)
+
+    @staticmethod
+    def _state(conn: sqlite3.Connection, name: str) -> Optional[int]:
+        row = conn.execute("SELECT value FROM activity_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def _clear(conn: sqlite3.Connection):
+        conn.execute("DELETE FROM activity")
+        conn.execute("DELETE FROM activity_state")
+        conn.execute("INSERT INTO activity_state VALUES ('version', ?)", (VERSION,))
+
+    def catch_up(self, conn: sqlite3.Connection):
+        # まだ集計していない計測・起動を足す(connはトランザクション中であること)
+        for table, fold, buckets in (("sessions", _FOLD_SESSIONS, _BUCKET), ("launches", _FOLD_LAUNCHES, _LAUNCH_BUCKET)):
+            done = self._state(conn, table) or 0
+            last = conn.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0]
+            if last is None or last <= done:
+                continue
+            for period in PERIODS:
+                conn.execute(fold.format(bucket=buckets[period]), (period, done))
+            conn.execute("INSERT OR REPLACE INTO activity_state VALUES (?, ?)", (table, last))
+
+    def record_launch(self, conn: Optional[sqlite3.Connection] = None, launched_at: Optional[float] = None):
+        conn = conn or self._conn
+        with _immediate(conn):
+            conn.execute("INSERT INTO launches (launched_at) VALUES (?)",
+                         (launched_at if launched_at is not None else time.time(),))
+            self.catch_up(conn)
+
+    def rebuild(self, conn: Optional[sqlite3.Connection] = None):
+        # 元の記録から作り直す(タイムゾーンを変えたときなど)
+        conn = conn or self._conn
+        with _immediate(conn):
+            self._clear(conn)
+            self.catch_up(conn)
+
+    # ---- 問い合わせ(UIスレッド) ----
+
+    def summaries(self, period: str, start: Optional[str] = None, end: Optional[str] = None,
+                  mode: Optional[str] = None, input_method: Optional[str] = None,
+                  conversion: Optional[bool] = None) -> list[ActivitySummary]:
+        # start <= bucket <= end の日(月)を古い順に。mode・input_method・conversionを省略するとその合計
+        # (起動回数はこれらによらない)
+        where, params = ["period = ?"], [period]
+        if start is not None:
+            where.append("bucket >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("bucket <= ?")
+            params.append(end)
+        if mode is not None:
+            where.append("mode IN ('', ?)")
+            params.append(mode)
+        if input_method is not None:
+            where.append("input_method IN ('', ?)")
+            params.append(input_method)
+        if conversion is not None:
+            where.append("(mode = '' OR conversion = ?)")
+            params.append(int(conversion))
+        rows = self._conn.execute(
+            "SELECT bucket, SUM(launches), SUM(sessions), SUM(keystrokes), SUM(kana_count), SUM(mistakes),"
+            f" SUM(typed_ns), MAX(score_max), SUM(score_sum) FROM activity WHERE {' AND '.join(where)}"
+            " GROUP BY bucket ORDER BY bucket", params).fetchall()
+        return [ActivitySummary(*row) for row in rows]
+
+    def days(self, start: Optional[str] = None, end: Optional[str] = None, mode: Optional[str] = None,
+             input_method: Optional[str] = None, conversion: Optional[bool] = None) -> list[ActivitySummary]:
+        return self.summaries("day", start, end, mode, input_method, conversion)
+
+    def months(self, start: Optional[str] = None, end: Optional[str] = None, mode: Optional[str] = None,
+               input_method: Optional[str] = None, conversion: Optional[bool] = None) -> list[ActivitySummary]:
+        return self.summaries("month", start, end, mode, input_method, conversion)
@@ -0,0 +1,135 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Optional
+
+from event_log import EMIT, END, KEY, MISTAKE, START, Events
+from scoring import raw_score
+
+NS_PER_SECOND = 1_000_000_000
+
+# 10秒ごとのラップ
+LAP_NS = 10 * NS_PER_SECOND
+# 加速・減速を見るかなの単位
+SPAN_CHARS = 5
+
+
+def _diff(values) -> array:
+    return array("i", [b - a for a, b in zip(values, values[1:])])
+
+
+@dataclass
+class SessionAnalysis:
+    # 1回の計測の解析結果(時刻はすべて計測開始からのns)
+    duration_ns: int = 0
+    kana_count: int = 0
+    mistakes: int = 0
+    keystrokes: int = 0
+    lap_ns: int = LAP_NS
+    span_chars: int = SPAN_CHARS
+    kana_t: array = field(default_factory=lambda: array("q"))         # i文字目のかなが確定した時刻
+    mistake_t: array = field(default_factory=lambda: array("q"))      # ミスした時刻
+    lap_kana: array = field(default_factory=lambda: array("i"))       # ラップごとの確定かな数
+    lap_mistakes: array = field(default_factory=lambda: array("i"))   # ラップごとのミス数
+    span_ns: array = field(default_factory=lambda: array("q"))        # span_chars文字ごとの所要時間
+    best_lap: Optional[int] = None
+    worst_lap: Optional[int] = None
+
+    @property
+    def score(self) -> int:
+        return raw_score(self.kana_count, self.mistakes)
+
+    @property
+    def lap_count(self) -> int:
+        return len(self.lap_kana)
+
+    def lap_score(self, lap: int) -> int:
+        return self.lap_kana[lap] - self.lap_mistakes[lap]
+
+    def lap_length_ns(self, lap: int) -> int:
+        # 最後のラップは途中で終わることがある
+        return min(self.lap_ns, self.duration_ns - lap * self.lap_ns)
+
+    def lap_pace(self, lap: int) -> float:
+        # そのラップの1秒あたりのスコア
+        length = self.lap_length_ns(lap)
+        return self.lap_score(lap) * NS_PER_SECOND / length if length > 0 else 0.0
+
+    def projected_score(self, lap: Optional[int]) -> int:
+        # そのラップのペースで最後まで打ち続けたときのスコア
+        if lap is None:
+            return 0
+        return max(0, int(self.lap_pace(lap) * self.duration_ns / NS_PER_SECOND))
+
+    @property
+    def best_projected(self) -> int:
+        return self.projected_score(self.best_lap)
+
+    @property
+    def worst_projected(self) -> int:
+        return self.projected_score(self.worst_lap)
+
+    def score_at(self, t_ns: int) -> int:
+        # 時刻t_nsまでのスコア
+        return raw_score(bisect_right(self.kana_t, t_ns), bisect_right(self.mistake_t, t_ns))
+
+    def score_curve(self, step_ns: int = NS_PER_SECOND) -> array:
+        # step_nsごとの累積スコア(先頭は0秒時点)
+        times = range(0, self.duration_ns + step_ns, step_ns)
+        kana = [bisect_right(self.kana_t, t) for t in times]
+        mistakes = [bisect_right(self.mistake_t, t) for t in times]
+        return array("i", [raw_score(k, m) for k, m in zip(kana, mistakes)])
+
+    def span_ratio(self, span: int) -> float:
+        # そのspanの速さの全体平均に対する比(1より大きければ加速)
+        if not self.kana_count or not self.span_ns[span]:
+            return 0.0
+        average = self.kana_t[-1] / self.kana_count * self.span_chars
+        return average / self.span_ns[span]
+
+
+def analyze(events: Events, lap_ns: int = LAP_NS, span_chars: int = SPAN_CHARS) -> SessionAnalysis:
+    # イベント列を1回なめて時刻の列を作り、あとは累積和と時刻での区切りだけで集計する
+    result = SessionAnalysis(lap_ns=lap_ns, span_chars=span_chars)
+    if not len(events):
+        return result
+    t0 = events.t_ns[0]
+    end = None
+    kana_t = result.kana_t
+    mistake_t = result.mistake_t
+    keystrokes = 0
+    for t_ns, kind, code, _ in events:
+        if kind == EMIT:
+            kana_t.extend([t_ns - t0] * code)
+        elif kind == KEY:
+            keystrokes += 1
+        elif kind == MISTAKE:
+            mistake_t.append(t_ns - t0)
+        elif kind == START:
+            t0 = t_ns
+        elif kind == END:
+            end = t_ns - t0
+    if end is None:
+        end = events.t_ns[-1] - t0
+    result.duration_ns = end
+    result.kana_count = len(kana_t)
+    result.mistakes = len(mistake_t)
+    result.keystrokes = keystrokes
+
+    # ラップ: 区切り時刻までの累積数の差
+    laps = max(1, -(-end // lap_ns))
+    edges = [k * lap_ns for k in range(laps)] + [end + 1]
+    result.lap_kana = _diff([bisect_left(kana_t, t) for t in edges])
+    result.lap_mistakes = _diff([bisect_left(mistake_t, t) for t in edges])
+
+    # 最速・最遅ラップ(途中で終わった最後のラップは、それしか無いとき以外は比べない)
+    full = laps - 1 if laps > 1 and end % lap_ns else laps
+    scores = [result.lap_score(lap) for lap in range(full)]
+    result.best_lap = max(range(full), key=scores.__getitem__)
+    result.worst_lap = min(range(full), key=scores.__getitem__)
+
+    # span_chars文字ごとの所要時間
+    boundaries = [0] + [kana_t[i - 1] for i in range(span_chars, len(kana_t) + 1, span_chars)]
+    result.span_ns = array("q", [b - a for a, b in zip(boundaries, boundaries[1:])])
+    return result
+
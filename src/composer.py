@@ -0,0 +1,321 @@
+import json
+import os
+from array import array
+from dataclasses import dataclass, replace
+from typing import Iterable, Optional
+
+from utils.trie import Trie, TrieNode
+
+# ルールのアクション(設計.md 3章)
+COMMIT = "COMMIT"                    # マッチした時点で確定
+CONDITIONAL = "CONDITIONAL"          # より長いマッチがあり得る間は保留、続かなければ確定
+PARTIAL_REWRITE = "PARTIAL_REWRITE"  # 直前に確定したかなを消して置き換える
+ACTIONS = (COMMIT, CONDITIONAL, PARTIAL_REWRITE)
+
+# feed()/flush()の結果(ビットフラグ)
+PENDING = 0  # バッファに積んだだけ
+EMITTED = 1  # かなを確定した(emitted/erasedに内容がある)
+MISSED = 2   # 受理できないキー。状態は変えない(EMITTEDと同時に立つことがある)
+
+# 受け付けるキーは印字可能ASCII(0x20-0x7e)
+KEY_BASE = 0x20
+KEY_COUNT = 0x7f - KEY_BASE
+# 遷移表の最後の列はflush(強制確定)用
+END_COLUMN = KEY_COUNT
+COLUMNS = KEY_COUNT + 1
+
+DEFAULT_RULES_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), "rules", "romaji_rules.json"))
+
+
+@dataclass(frozen=True)
+class Rule:
+    input: str
+    output: str
+    action: str = ""   # 空なら、より長いルールの接頭辞かどうかで COMMIT / CONDITIONAL を決める
+    next: str = ""     # 確定後にバッファへ戻す打鍵列(kk -> っ + k など)
+    rewrite: int = 0   # PARTIAL_REWRITE で消す直前のかなの文字数
+
+
+def parse_json_rules(data: Iterable[dict]) -> list[Rule]:
+    # 設計.md 付録の形式: {"input", "output", "action", "consume"}
+    # consumeは入力から消費する文字数で、残りは次のバッファになる。nextで直接指定してもよい
+    rules = []
+    for entry in data:
+        key = entry["input"]
+        if "next" in entry:
+            pending = entry["next"]
+        else:
+            pending = key[int(entry.get("consume", len(key))):]
+        rules.append(Rule(key,
+                          entry.get("output", ""),
+                          entry.get("action", ""),
+                          pending,
+                          int(entry.get("consume_prev", 0))))
+    return rules
+
+
+def parse_mozc_rules(lines: Iterable[str]) -> list[Rule]:
+    # Mozcのローマ字テーブル形式: 入力<TAB>出力[<TAB>次の入力]
+    rules = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line or line.startswith("#"):
+            continue
+        cols = line.split("\t")
+        if len(cols) < 2:
+            raise ValueError(f"Mozc形式のルールとして解釈できません: {line!r}")
+        rules.append(Rule(cols[0], cols[1], "", cols[2] if len(cols) > 2 else ""))
+    return rules
+
+
+def parse_rules(path: str, text: str) -> list[Rule]:
+    # 拡張子が.jsonならJSON、それ以外はMozcのTSVとして読む
+    if path.lower().endswith(".json"):
+        return parse_json_rules(json.loads(text))
+    return parse_mozc_rules(text.splitlines())
+
+
+def load_rules(path: str) -> list[Rule]:
+    with open(path, "r", encoding="utf-8") as file:
+        return parse_rules(path, file.read())
+
+
+def _key_column(ch: str) -> int:
+    col = ord(ch) - KEY_BASE
+    if col < 0 or col >= KEY_COUNT:
+        raise ValueError(f"印字可能なASCII以外のキーはルールに使えません: {ch!r}")
+    return col
+
+
+def _combine(a: tuple[int, str], b: tuple[int, str]) -> tuple[int, str]:
+    # 確定内容 (消す文字数, 追加する文字列) を2つ続けて適用したものにまとめる
+    back_a, text_a = a
+    back_b, text_b = b
+    if back_b <= len(text_a):
+        return back_a, text_a[:len(text_a) - back_b] + text_b
+    return back_a + back_b - len(text_a), text_b
+
+
+_NO_EMIT = (0, "")
+
+
+class _Compiler:
+    # ルールのTrieから「状態 x キー -> (次状態, 確定内容, ミス)」の表を作る
+    # 最長一致・保留・nの確定・促音の残りバッファなどはすべてここで展開しておき、
+    # 実行時は1打鍵につき表を1回引くだけにする
+    def __init__(self, rules: Iterable[Rule]):
+        self.trie: Trie[Rule] = Trie()
+        for rule in rules:
+            if not rule.input:
+                raise ValueError("入力が空のルールは登録できません")
+            for ch in rule.input + rule.next:
+                _key_column(ch)
+            if rule.action and rule.action not in ACTIONS:
+                raise ValueError(f"ルール{rule.input!r}: 不明なアクション {rule.action!r}")
+            self.trie.insert(rule.input, rule)
+
+        self.nodes: list[TrieNode[Rule]] = []
+        self.keys: list[str] = []
+        self.ids: dict[int, int] = {}
+        for key, node in self.trie.nodes_bfs():
+            self.ids[id(node)] = len(self.nodes)
+            self.nodes.append(node)
+            self.keys.append(key)
+            rule = node.value
+            if rule is not None and not rule.action:
+                node.value = replace(rule, action=CONDITIONAL if node.children else COMMIT)
+
+        self._memo: dict[tuple[int, int], tuple[int, tuple[int, str], bool]] = {}
+        self._active: set[tuple[int, int]] = set()
+
+    def _has_fallback(self, rule: Optional[Rule]) -> bool:
+        return rule is not None and bool(rule.output or rule.rewrite)
+
+    def _commit(self, rule: Rule) -> tuple[int, tuple[int, str]]:
+        # ルールを確定し、nextの打鍵列を根から流し込んだ状態を返す
+        emit = (rule.rewrite, rule.output)
+        state = 0
+        for ch in rule.next:
+            state, e, miss = self.resolve(state, _key_column(ch))
+            if miss:
+                raise ValueError(f"ルール{rule.input!r}: 次の入力 {rule.next!r} がどのルールにもつながりません")
+            emit = _combine(emit, e)
+        return state, emit
+
+    def resolve(self, state: int, col: int) -> tuple[int, tuple[int, str], bool]:
+        memo_key = (state, col)
+        cached = self._memo.get(memo_key)
+        if cached is not None:
+            return cached
+        if memo_key in self._active:
+            raise ValueError(f"ルールの次の入力が循環しています: {self.keys[state]!r}")
+        self._active.add(memo_key)
+        try:
+            if col == END_COLUMN:
+                result = self._resolve_end(state)
+            else:
+                result = self._resolve_key(state, col)
+        finally:
+            self._active.discard(memo_key)
+        self._memo[memo_key] = result
+        return result
+
+    def _resolve_key(self, state: int, col: int) -> tuple[int, tuple[int, str], bool]:
+        node = self.nodes[state]
+        child = node.children.get(chr(KEY_BASE + col))
+        if child is not None:
+            rule = child.value
+            # 続きがあり得る間は保留
+            if rule is None or (rule.action == CONDITIONAL and child.children):
+                return self.ids[id(child)], _NO_EMIT, False
+            next_state, emit = self._commit(rule)
+            return next_state, emit, False
+        # 続かないので、保留中のルールがあれば確定してからキーを処理し直す(撥音のnなど)
+        rule = node.value
+        if state == 0 or not self._has_fallback(rule):
+            return state, _NO_EMIT, True
+        next_state, emit = self._commit(rule)
+        final_state, emit2, miss = self.resolve(next_state, col)
+        return final_state, _combine(emit, emit2), miss
+
+    def _resolve_end(self, state: int) -> tuple[int, tuple[int, str], bool]:
+        # 強制確定。確定できない打鍵は捨ててミス扱いにする
+        if state == 0:
+            return 0, _NO_EMIT, False
+        rule = self.nodes[state].value
+        if not self._has_fallback(rule):
+            return 0, _NO_EMIT, True
+        next_state, emit = self._commit(rule)
+        final_state, emit2, miss = self.resolve(next_state, END_COLUMN)
+        return final_state, _combine(emit, emit2), miss
+
+    def compile(self) -> "ComposerTable":
+        size = len(self.nodes) * COLUMNS
+        next_state = array("i", bytes(4 * size))
+        emit_ids = array("i", bytes(4 * size))
+        results = array("B", bytes(size))
+        emit_index: dict[tuple[int, str], int] = {_NO_EMIT: 0}
+        emit_back = [0]
+        emit_text = [""]
+        for state in range(len(self.nodes)):
+            base = state * COLUMNS
+            for col in range(COLUMNS):
+                target, emit, miss = self.resolve(state, col)
+                eid = emit_index.get(emit)
+                if eid is None:
+                    eid = len(emit_text)
+                    emit_index[emit] = eid
+                    emit_back.append(emit[0])
+                    emit_text.append(emit[1])
+                next_state[base + col] = target
+                emit_ids[base + col] = eid
+                results[base + col] = (EMITTED if eid else PENDING) | (MISSED if miss else 0)
+
+        previews = []
+        for node in self.nodes:
+            rule = node.value
+            previews.append(rule.output if rule is not None and rule.action == CONDITIONAL else "")
+        return ComposerTable(next_state, emit_ids, results,
+                             emit_text, array("i", emit_back),
+                             list(self.keys), previews)
+
+
+class ComposerTable:
+    # コンパイル済みの遷移表。状態0が空バッファ
+    # next_state/emit_ids/results は 状態 * COLUMNS + キー列 で引く平坦な配列
+    def __init__(self, next_state, emit_ids, results,
+                 emit_text: list[str], emit_back,
+                 state_input: list[str], state_preview: list[str]):
+        self.next_state = next_state
+        self.emit_ids = emit_ids
+        self.results = results
+        self.emit_text = emit_text
+        self.emit_back = emit_back
+        self.state_input = state_input
+        self.state_preview = state_preview
+
+    @property
+    def state_count(self) -> int:
+        return len(self.state_input)
+
+    @classmethod
+    def from_rules(cls, rules: Iterable[Rule]) -> "ComposerTable":
+        return _Compiler(rules).compile()
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_RULES_PATH) -> "ComposerTable":
+        return cls.from_rules(load_rules(path))
+
+
+class Composer:
+    # 打鍵 -> 確定かな の状態機械。1打鍵ごとに遷移表を1回引くだけで、バッファの再走査もしない
+    def __init__(self, table: Optional[ComposerTable] = None):
+        if table is None:
+            table = ComposerTable.load()
+        self.table = table
+        # ホットパスで属性を辿らないように配列を直接持っておく
+        self._next_state = table.next_state
+        self._emit_ids = table.emit_ids
+        self._results = table.results
+        self._state = 0
+        self._emit = 0
+
+    def reset(self):
+        self._state = 0
+        self._emit = 0
+
+    def feed(self, key: str) -> int:
+        if len(key) != 1:
+            self._emit = 0
+            return MISSED
+        col = ord(key) - KEY_BASE
+        if col < 0 or col >= KEY_COUNT:
+            self._emit = 0
+            return MISSED
+        index = self._state * COLUMNS + col
+        self._state = self._next_state[index]
+        self._emit = self._emit_ids[index]
+        return self._results[index]
+
+    def flush(self) -> int:
+        # 保留中のバッファを強制確定する(お題の区切りなど)
+        index = self._state * COLUMNS + END_COLUMN
+        self._state = self._next_state[index]
+        self._emit = self._emit_ids[index]
+        return self._results[index]
+
+    @property
+    def state(self) -> int:
+        return self._state
+
+    @property
+    def emitted(self) -> str:
+        # 直前のfeed()/flush()で確定したかな
+        return self.table.emit_text[self._emit]
+
+    @property
+    def erased(self) -> int:
+        # 直前のfeed()/flush()で取り消した確定済みかなの文字数(PARTIAL_REWRITE)
+        return self.table.emit_back[self._emit]
+
+    @property
+    def preedit(self) -> str:
+        # 未確定の打鍵列
+        return self.table.state_input[self._state]
+
+    @property
+    def preview(self) -> str:
+        # 今確定したら出てくるかな(仮確定表示用)
+        return self.table.state_preview[self._state]
+
+    def convert(self, keys: str, flush: bool = True) -> tuple[str, int]:
+        # 打鍵列をまとめて変換して (かな, ミス数) を返す。検証やテスト用でホットパスではない
+        out = ""
+        misses = 0
+        for i in range(len(keys) + (1 if flush else 0)):
+            result = self.feed(keys[i]) if i < len(keys) else self.flush()
+            if result & EMITTED:
+                out = out[:max(0, len(out) - self.erased)] + self.emitted
+            if result & MISSED:
+                misses += 1
+        return out, misses
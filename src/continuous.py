@@ -0,0 +1,134 @@
+from array import array
+from typing import Iterator, Optional
+
+from event_log import KEY, MISTAKE, PROMPT
+
+NS_PER_SECOND = 1_000_000_000
+
+# 連続打鍵モード(計測中でなくても打ち続けられ、打ち続けている途中から計測が始まる)
+#
+# 計測していない間の打鍵は、直近の一定件数だけを持つリングバッファ(PreRoll)に入れておく。
+# 前の計測の終了からSTART_KEYS打鍵以上打っていて、直近START_KEYS打鍵がWINDOW_NS以内に
+# 収まっている(一定以上の速さで打ち続けている)と分かった時点で、その最初の打鍵の時刻に
+# さかのぼって計測を始める。IDLE_NS打鍵が無ければ最後の打鍵の時刻で計測を終える。
+# どちらも固定長の配列だけで済むので、アプリを開いたままにしても使うメモリは増えない
+
+# 計測を始めるのに必要な打鍵数
+START_KEYS = 20
+# START_KEYS打鍵をこの時間内に打っていれば打ち続けているとみなす(20打鍵/5秒 = 4打鍵/秒)
+WINDOW_NS = 5 * NS_PER_SECOND
+# これだけ打鍵が無ければ手を止めたとみなして計測を終える
+IDLE_NS = 3 * NS_PER_SECOND
+# さかのぼって計測に入れられるイベントの数
+PREROLL_CAPACITY = 1024
+
+
+class RateDetector:
+    # 直近keys打鍵の時刻のリングと、前の計測の終了からの打鍵数
+    def __init__(self, keys: int = START_KEYS, window_ns: int = WINDOW_NS, idle_ns: int = IDLE_NS):
+        self.keys = max(1, keys)
+        self.window_ns = window_ns
+        self.idle_ns = idle_ns
+        self._times = array("q", bytes(8 * self.keys))
+        self._head = 0
+        self._since_end = 0
+        self._last_ns: Optional[int] = None
+
+    def feed(self, t_ns: int):
+        self._times[self._head] = t_ns
+        self._head = (self._head + 1) % self.keys
+        self._since_end += 1
+        self._last_ns = t_ns
+
+    def reset(self):
+        # 計測の終了時に呼ぶ。次の計測は、ここからまたkeys打鍵してから
+        self._since_end = 0
+
+    @property
+    def last_ns(self) -> Optional[int]:
+        return self._last_ns
+
+    @property
+    def keys_since_end(self) -> int:
+        return self._since_end
+
+    def burst_start(self) -> int:
+        # 直近keys打鍵の最初の時刻
+        return self._times[self._head]
+
+    def ready(self) -> bool:
+        # 計測を始めてよいか(前の計測の終了からkeys打鍵以上、かつ直近keys打鍵がwindow_ns以内)
+        if self._since_end < self.keys:
+            return False
+        return self._last_ns - self.burst_start() <= self.window_ns
+
+    def rate(self, t_ns: int) -> float:
+        # t_nsまでのwindow_nsに打った打鍵数から求めた1秒あたりの打鍵数
+        since = t_ns - self.window_ns
+        count = sum(1 for t in self._times if t > since)
+        return count * NS_PER_SECOND / self.window_ns
+
+    def is_idle(self, t_ns: int) -> bool:
+        return self._last_ns is None or t_ns - self._last_ns >= self.idle_ns
+
+
+class PreRoll:
+    # 計測していない間のイベントを直近capacity件だけ持つリングバッファ
+    # 計測をさかのぼって始めるとき、開始時刻に表示していたお題と、そのときのかな位置が分かるように、
+    # 押し出したPROMPTを覚えておき、打鍵ごとに変換器が何も保留していなかったかを持つ
+    def __init__(self, capacity: int = PREROLL_CAPACITY):
+        self._capacity = capacity
+        self._t_ns = array("q", bytes(8 * capacity))
+        self._kind = array("B", bytes(capacity))
+        self._code = array("H", bytes(2 * capacity))
+        self._index = array("i", bytes(4 * capacity))
+        self._clean = array("B", bytes(capacity))
+        self._head = 0
+        self._size = 0
+        # リングより前に表示したお題 (id, お題の前にスペースがあるか)
+        self._base_prompt: Optional[tuple[int, int]] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self, prompt: Optional[tuple[int, int]] = None):
+        # promptは今表示しているお題 (id, お題の前にスペースがあるか)
+        self._head = 0
+        self._size = 0
+        self._base_prompt = prompt
+
+    def record(self, t_ns: int, kind: int, code: int = 0, index: int = 0, clean: bool = False):
+        # cleanは、打鍵の前に変換器が何も保留していなかったか(そこからなら計測を始められる)
+        slot = (self._head + self._size) % self._capacity
+        if self._size == self._capacity:
+            if self._kind[slot] == PROMPT:
+                self._base_prompt = (self._index[slot], self._code[slot])
+            self._head = (self._head + 1) % self._capacity
+        else:
+            self._size += 1
+        self._t_ns[slot] = t_ns
+        self._kind[slot] = kind
+        self._code[slot] = code
+        self._index[slot] = index
+        self._clean[slot] = clean
+
+    def _slot(self, i: int) -> int:
+        return (self._head + i) % self._capacity
+
+    def start_point(self, t_ns: int) -> Optional[tuple[int, int, int, Optional[tuple[int, int]]]]:
+        # t_ns以降で最初に計測を始められる打鍵の (リング内の位置, 時刻, かな位置, そのときのお題)
+        prompt = self._base_prompt
+        for i in range(self._size):
+            slot = self._slot(i)
+            kind = self._kind[slot]
+            if kind == PROMPT:
+                prompt = (self._index[slot], self._code[slot])
+            elif (kind == KEY or kind == MISTAKE) and self._t_ns[slot] >= t_ns and self._clean[slot]:
+                return i, self._t_ns[slot], self._index[slot], prompt
+        return None
+
+    def events_from(self, i: int) -> Iterator[tuple[int, int, int, int]]:
+        # リング内の位置i以降の (時刻, 種類, code, index)
+        for j in range(i, self._size):
+            slot = self._slot(j)
+            yield self._t_ns[slot], self._kind[slot], self._code[slot], self._index[slot]
@@ -0,0 +1,170 @@
+from typing import Optional
+
+from PyQt6.QtCore import QObject, QEvent, Qt
+from PyQt6.QtGui import QInputMethodEvent, QKeyEvent
+from PyQt6.QtWidgets import QLineEdit
+
+# 変換ありモードの照合
+#
+# IMEで確定した文字列とお題のtextを比べる。入力欄の文字列を毎回先頭から比べ直すのではなく、
+# 「どこを何文字消して何を入れたか」(編集)だけを受け取り、最後に一致していた所(食い違いの位置)
+# より前が変わったときだけそこまで戻って比べ直す。編集はQInputMethodEventの確定文字列と
+# 置き換え範囲、Backspace/Deleteなどのキーから入力欄が処理する前に求めておく
+
+
+class ConversionDiff:
+    # 確定済みの入力とお題の一致している長さ(正しい接頭辞)を編集ごとに更新する
+    def __init__(self, target: str = ""):
+        self.set_target(target)
+
+    def set_target(self, target: str):
+        self._target = target
+        self._committed: list[str] = []
+        self._match = 0
+        self._preedit = ""
+        # 編集が分からず全体を比べ直した回数
+        self.resyncs = 0
+
+    @property
+    def target(self) -> str:
+        return self._target
+
+    @property
+    def text(self) -> str:
+        return "".join(self._committed)
+
+    def __len__(self) -> int:
+        return len(self._committed)
+
+    @property
+    def matched(self) -> int:
+        # 先頭から一致している文字数
+        return self._match
+
+    @property
+    def error_start(self) -> Optional[int]:
+        # 最初の誤りの位置(誤りが無ければNone)
+        return self._match if len(self._committed) > self._match else None
+
+    @property
+    def error_end(self) -> int:
+        # 誤りは最後の入力までとする
+        return max(self._match, len(self._committed))
+
+    @property
+    def complete(self) -> bool:
+        return self._match == len(self._target) == len(self._committed)
+
+    @property
+    def preedit(self) -> str:
+        # 変換中の文字列(まだ確定していないので照合には使わない)
+        return self._preedit
+
+    def set_preedit(self, preedit: str):
+        self._preedit = preedit
+
+    def apply(self, start: int, removed: int, inserted: str) -> int:
+        # committed[start:start+removed] を inserted に置き換えて、一致している長さを返す
+        committed = self._committed
+        start = max(0, min(start, len(committed)))
+        committed[start:start + removed] = inserted
+        match = min(self._match, start)
+        target = self._target
+        end = min(len(committed), len(target))
+        while match < end and committed[match] == target[match]:
+            match += 1
+        self._match = match
+        return match
+
+    def resync(self, text: str) -> int:
+        # 編集が分からない変更(貼り付け・元に戻すなど)は全体を比べ直す
+        self.resyncs += 1
+        self._committed = []
+        self._match = 0
+        return self.apply(0, 0, text)
+
+
+class LineEditDiffer(QObject):
+    # QLineEditへの入力を、入力欄が処理する前に編集(開始位置, 消す文字数, 入れる文字列)にして
+    # ConversionDiffに渡す。入力欄が変わった後(textChanged)に長さが合わなければ全体を比べ直す
+    def __init__(self, edit: QLineEdit, diff: ConversionDiff, changed=None):
+        super().__init__(edit)
+        self.edit = edit
+        self.diff = diff
+        # changed(diff)は入力欄の内容が変わるたびに呼ばれる
+        self._changed = changed
+        self._pending: Optional[tuple[int, int, str]] = None
+        edit.installEventFilter(self)
+        edit.textChanged.connect(self._on_text_changed)
+
+    def _selection(self) -> tuple[int, int]:
+        edit = self.edit
+        if edit.hasSelectedText():
+            return edit.selectionStart(), len(edit.selectedText())
+        return edit.cursorPosition(), 0
+
+    def eventFilter(self, obj, event) -> bool:
+        if obj is not self.edit:
+            return False
+        kind = event.type()
+        if kind == QEvent.Type.InputMethod:
+            self._on_input_method(event)
+        elif kind == QEvent.Type.KeyPress:
+            self._on_key_press(event)
+        return False
+
+    def _on_input_method(self, event: QInputMethodEvent):
+        start, removed = self._selection()
+        commit = event.commitString()
+        if not removed and event.replacementLength():
+            start += event.replacementStart()
+            removed = event.replacementLength()
+        if commit or removed:
+            self._pending = (start, removed, commit)
+        self.diff.set_preedit(event.preeditString())
+        if not commit and not removed and self._changed is not None:
+            # 変換中の文字列だけが変わった
+            self._changed(self.diff)
+
+    def _on_key_press(self, event: QKeyEvent):
+        start, removed = self._selection()
+        key = event.key()
+        if key == Qt.Key.Key_Backspace:
+            if not removed and start > 0:
+                start, removed = start - 1, 1
+            self._pending = (start, removed, "") if removed else None
+        elif key == Qt.Key.Key_Delete:
+            if not removed and start < len(self.edit.text()):
+                removed = 1
+            self._pending = (start, removed, "") if removed else None
+        elif event.text() and event.text().isprintable() and not event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+            self._pending = (start, removed, event.text())
+        else:
+            self._pending = None
+
+    def _on_text_changed(self, text: str):
+        pending, self._pending = self._pending, None
+        diff = self.diff
+        if pending is not None and len(diff) - pending[1] + len(pending[2]) == len(text):
+            diff.apply(*pending)
+        elif diff.text != text:
+            diff.resync(text)
+        if self._changed is not None:
+            self._changed(diff)
+
+    def reset(self, target: str):
+        # 次の行へ: 入力欄を空にして照合する相手を変える
+        self._pending = None
+        self.diff.set_target(target)
+        self.edit.blockSignals(True)
+        self.edit.setText("")
+        self.edit.blockSignals(False)
+
+    def show_text(self, text: str):
+        # 入力欄の内容を差し替える(リプレイ用。changedは呼ばない)
+        self._pending = None
+        self.edit.blockSignals(True)
+        self.edit.setText(text)
+        self.edit.blockSignals(False)
+        if self.diff.text != text:
+            self.diff.resync(text)
@@ -0,0 +1,219 @@
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from typing import Iterator, Optional
+
+import tracing
+
+# イベントの種類(設計.md 6章のリプレイ形式に対応)
+START = 0    # 計測開始。index = お題のかな位置
+KEY = 1      # 受理した打鍵。code = キー(文字コード)、index = 打鍵前のかな位置
+EMIT = 2     # かなの確定。code = 確定した文字数、index = 確定後のかな位置
+MISTAKE = 3  # ミス打鍵。code = キー(文字コード)、index = その時のかな位置
+PROMPT = 4   # 次のお題へ。code = 0、index = お題のid
+END = 5      # 計測終了。時刻は締め切り
+
+KIND_NAMES = {START: "start", KEY: "key", EMIT: "emit", MISTAKE: "mistake", PROMPT: "prompt", END: "end"}
+
+# 1件16バイトの固定長レコード: 時刻(ns), 種類, (詰め物), コード, かな位置
+RECORD = struct.Struct("<qBxHi")
+
+DEFAULT_CAPACITY = 1 << 16
+DEFAULT_SPOOL_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "cache", "events"))
+# 書き出し先のファイルは記録の保存が済めば消す。保存前に落ちたときの分はこの数だけ新しい順に残す
+MAX_SPOOLS = 16
+
+
+class Events:
+    # 記録済みイベントの列(種類ごとではなく列ごとの配列で持つ)
+    def __init__(self, t_ns=None, kind=None, code=None, index=None):
+        self.t_ns = t_ns if t_ns is not None else array("q")
+        self.kind = kind if kind is not None else array("B")
+        self.code = code if code is not None else array("H")
+        self.index = index if index is not None else array("i")
+
+    def __len__(self) -> int:
+        return len(self.t_ns)
+
+    def append(self, t_ns: int, kind: int, code: int = 0, index: int = 0):
+        self.t_ns.append(t_ns)
+        self.kind.append(kind)
+        self.code.append(code)
+        self.index.append(index)
+
+    def __iter__(self) -> Iterator[tuple[int, int, int, int]]:
+        return zip(self.t_ns, self.kind, self.code, self.index)
+
+    @classmethod
+    def from_bytes(cls, data) -> "Events":
+        events = cls()
+        for record in RECORD.iter_unpack(data):
+            events.append(*record)
+        return events
+
+    def to_bytes(self) -> bytes:
+        out = bytearray(RECORD.size * len(self))
+        for i, record in enumerate(self):
+            RECORD.pack_into(out, i * RECORD.size, *record)
+        return bytes(out)
+
+
+class EventLog:
+    # 打鍵イベントの記録
+    # UIスレッド(書き手1つ)は事前に確保したリングバッファに固定長レコードを書き込むだけで、
+    # ファイルへの書き出しは別スレッド(読み手1つ)が行う。書き手はhead、読み手はtailだけを
+    # 進めるのでロックは要らない。バッファが一杯になった分は捨てて数える
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, spool_dir: Optional[str] = DEFAULT_SPOOL_DIR,
+                 flush_interval: float = 1.0):
+        self._capacity = capacity
+        self._buffer = bytearray(RECORD.size * capacity)
+        self._view = memoryview(self._buffer)
+        self._pack_into = RECORD.pack_into
+        self._head = 0
+        self._tail = 0
+        self._dropped = 0
+        self._spool_dir = spool_dir
+        self._flush_interval = flush_interval
+        self._recording = False
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stop_requested = False
+        # 書き出し済みのレコード(終了時にEventsへ戻す。ファイルを読み直さない)
+        self._drained = bytearray()
+        self._spool = None
+        self.spool_path: Optional[str] = None
+
+    @property
+    def recording(self) -> bool:
+        return self._recording
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    def start(self, t_ns: Optional[int] = None, index: int = 0):
+        if self._recording:
+            self.stop()
+        self._head = 0
+        self._tail = 0
+        self._dropped = 0
+        self._drained = bytearray()
+        self._stop_requested = False
+        self._wake.clear()
+        self._spool = None
+        self.spool_path = None
+        if self._spool_dir:
+            try:
+                os.makedirs(self._spool_dir, exist_ok=True)
+                prune_spools(self._spool_dir, MAX_SPOOLS - 1)
+                # 同じ秒に始めても別のファイルになるように
+                fd, self.spool_path = tempfile.mkstemp(
+                    prefix=f"session-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-", suffix=".bin", dir=self._spool_dir)
+                self._spool = os.fdopen(fd, "wb")
+            except OSError as e:
+                print(f"イベントの書き出し先を開けませんでした: {e}", file=sys.stderr)
+                self._spool = None
+                self.spool_path = None
+        self._recording = True
+        self._thread = threading.Thread(target=self._drain_loop, name="event-log-drain", daemon=True)
+        self._thread.start()
+        self.record(START, 0, index, t_ns)
+
+    def record(self, kind: int, code: int = 0, index: int = 0, t_ns: Optional[int] = None):
+        # UIスレッドから呼ぶ。リングバッファに1件書くだけ
+        if not self._recording:
+            return
+        head = self._head
+        if head - self._tail >= self._capacity:
+            self._dropped += 1
+            return
+        if t_ns is None:
+            t_ns = time.perf_counter_ns()
+        self._pack_into(self._view, (head % self._capacity) * RECORD.size, t_ns, kind, code, index)
+        self._head = head + 1
+
+    def stop(self, t_ns: Optional[int] = None, index: int = 0) -> Events:
+        # END を書いて残りを書き出し、記録した全イベントを返す
+        if not self._recording:
+            return Events.from_bytes(self._drained)
+        self.record(END, 0, index, t_ns)
+        self._recording = False
+        self._stop_requested = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self._dropped:
+            print(f"イベントバッファが一杯になり {self._dropped} 件を記録できませんでした", file=sys.stderr)
+        return Events.from_bytes(self._drained)
+
+    def _drain_loop(self):
+        while True:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            self._drain()
+            if self._stop_requested:
+                self._drain()
+                return
+
+    def _drain(self):
+        head = self._head
+        tail = self._tail
+        if head == tail:
+            return
+        tracing.counter("event_log.buffered", head - tail, "storage")
+        with tracing.span("event_log.drain", "storage", {"records": head - tail}):
+            self._drain_range(head, tail)
+
+    def _drain_range(self, head: int, tail: int):
+        size = RECORD.size
+        start = (tail % self._capacity) * size
+        end = (head % self._capacity) * size
+        if start < end:
+            chunk = bytes(self._view[start:end])
+        else:
+            # 末尾で折り返している
+            chunk = bytes(self._view[start:]) + bytes(self._view[:end])
+        self._drained += chunk
+        if self._spool is not None:
+            try:
+                self._spool.write(chunk)
+                self._spool.flush()
+            except OSError as e:
+                print(f"イベントの書き出しに失敗しました: {e}", file=sys.stderr)
+                # 書き出しはやめるが、ファイルは閉じてから手放す(閉じるときの失敗は無視する)
+                spool, self._spool = self._spool, None
+                try:
+                    spool.close()
+                except OSError:
+                    pass
+        self._tail = head
+
+
+def remove_spool(path: Optional[str]):
+    # 記録を保存し終えた計測の書き出し先を消す(書き込みスレッドから呼んでもよい)
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def prune_spools(directory: str, keep: int = MAX_SPOOLS):
+    # 消されずに残った書き出し先(保存の前に落ちた計測)を新しい順にkeep個だけ残す
+    try:
+        entries = [entry for entry in os.scandir(directory)
+                   if entry.name.startswith("session-") and entry.name.endswith(".bin")]
+    except OSError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[max(0, keep):]:
+        remove_spool(entry.path)
@@ -0,0 +1,309 @@
+import sqlite3
+import threading
+from array import array
+from typing import Iterable, Optional
+
+from composer import KEY_BASE, KEY_COUNT
+from event_log import EMIT, KEY, MISTAKE, PROMPT, START, Events
+from prompt_store import Prompt
+
+# かなごと・キーの組(直前のキー -> 次のキー)ごとの打鍵の速さのヒートマップ
+#
+# どちらも大きさ固定の配列で持つ: セルごとの回数・合計時間・ミス数と、時間のヒストグラム。
+# 1回の計測分は触ったセルだけの小さな差分にまとめてから足すので、保存済みの集計に
+# 何百時間分のイベントを足しても読み直しは要らず、起動時は配列をそのまま読むだけで済む
+
+# ヒストグラムのビン: 8ms単位で0, 8, 16, 24, 32, 48, 64, 96, 128, ... (半オクターブ刻み、最後は3秒前後)
+HIST_BINS = 18
+_BIN_UNIT_NS = 8_000_000
+# これより長い間隔は打鍵の速さではない(考え込んだ・手を止めた)ので数えない
+IDLE_NS = 3_000_000_000
+
+# かなのセル: ひらがなのブロック(U+3040-U+309F)、記号など、それ以外
+_HIRAGANA_BASE = 0x3040
+_HIRAGANA_COUNT = 0x60
+KANA_EXTRA = " ー、。・！？「」『』〜ヴヵヶ…‥←↑→↓"
+KANA_CELLS = _HIRAGANA_COUNT + len(KANA_EXTRA) + 1
+_KANA_OTHER = KANA_CELLS - 1
+_EXTRA_INDEX = {ch: _HIRAGANA_COUNT + i for i, ch in enumerate(KANA_EXTRA)}
+
+# キーの組のセル: 直前のキー * KEY_COUNT + 次のキー
+PAIR_CELLS = KEY_COUNT * KEY_COUNT
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS heatmaps (
+    name TEXT PRIMARY KEY,       -- "kana" / "pair"
+    cells INTEGER NOT NULL,
+    bins INTEGER NOT NULL,
+    counts BLOB NOT NULL,        -- uint32 * cells
+    total_ns BLOB NOT NULL,      -- int64 * cells
+    misses BLOB NOT NULL,        -- uint32 * cells
+    hist BLOB NOT NULL           -- uint32 * cells * bins
+);
+"""
+
+
+def latency_bin(latency_ns: int) -> int:
+    units = latency_ns // _BIN_UNIT_NS
+    if units < 4:
+        return max(0, units)
+    bits = units.bit_length()
+    return min(HIST_BINS - 1, 2 * bits - 2 + ((units >> (bits - 2)) & 1))
+
+
+def bin_lower_ms(bin_index: int) -> int:
+    # ビンの下端(ms)
+    if bin_index < 4:
+        return bin_index * _BIN_UNIT_NS // 1_000_000
+    bits = (bin_index + 2) // 2
+    units = (1 << (bits - 1)) | ((bin_index & 1) << (bits - 2))
+    return units * _BIN_UNIT_NS // 1_000_000
+
+
+def kana_cell(kana: str) -> int:
+    code = ord(kana) - _HIRAGANA_BASE
+    if 0 <= code < _HIRAGANA_COUNT:
+        return code
+    return _EXTRA_INDEX.get(kana, _KANA_OTHER)
+
+
+def kana_of_cell(cell: int) -> str:
+    if cell < _HIRAGANA_COUNT:
+        return chr(_HIRAGANA_BASE + cell)
+    if cell < _KANA_OTHER:
+        return KANA_EXTRA[cell - _HIRAGANA_COUNT]
+    return "?"
+
+
+def pair_cell(prev_key: int, key: int) -> Optional[int]:
+    a = prev_key - KEY_BASE
+    b = key - KEY_BASE
+    if 0 <= a < KEY_COUNT and 0 <= b < KEY_COUNT:
+        return a * KEY_COUNT + b
+    return None
+
+
+def keys_of_cell(cell: int) -> tuple[str, str]:
+    return chr(KEY_BASE + cell // KEY_COUNT), chr(KEY_BASE + cell % KEY_COUNT)
+
+
+class Heatmap:
+    # 大きさ固定のセルごとの回数・合計時間・ミス数・時間のヒストグラム
+    def __init__(self, cells: int, bins: int = HIST_BINS):
+        self.cells = cells
+        self.bins = bins
+        self.counts = array("I", bytes(4 * cells))
+        self.total_ns = array("q", bytes(8 * cells))
+        self.misses = array("I", bytes(4 * cells))
+        self.hist = array("I", bytes(4 * cells * bins))
+
+    def add(self, cell: int, latency_ns: int):
+        self.counts[cell] += 1
+        self.total_ns[cell] += latency_ns
+        self.hist[cell * self.bins + latency_bin(latency_ns)] += 1
+
+    def add_miss(self, cell: int):
+        self.misses[cell] += 1
+
+    def merge(self, other: "Heatmap"):
+        # 同じ形のヒートマップを足し込む(差分ならそのセルだけ)
+        if isinstance(other, HeatmapDelta):
+            other.apply_to(self)
+            return
+        if other.cells != self.cells or other.bins != self.bins:
+            raise ValueError("ヒートマップの大きさが違います")
+        for name in ("counts", "total_ns", "misses", "hist"):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            for i, value in enumerate(theirs):
+                if value:
+                    mine[i] += value
+
+    def mean_ms(self, cell: int) -> Optional[float]:
+        count = self.counts[cell]
+        return self.total_ns[cell] / count / 1e6 if count else None
+
+    def miss_rate(self, cell: int) -> float:
+        count = self.counts[cell]
+        return self.misses[cell] / count if count else 0.0
+
+    def histogram(self, cell: int) -> array:
+        base = cell * self.bins
+        return self.hist[base:base + self.bins]
+
+    def quantile_ms(self, cell: int, q: float) -> Optional[float]:
+        # ヒストグラムからの分位点(ビンの下端)
+        hist = self.histogram(cell)
+        total = sum(hist)
+        if not total:
+            return None
+        target = q * total
+        running = 0
+        for bin_index, count in enumerate(hist):
+            running += count
+            if running >= target:
+                return float(bin_lower_ms(bin_index))
+        return float(bin_lower_ms(self.bins - 1))
+
+    def used_cells(self) -> list[int]:
+        return [cell for cell, count in enumerate(self.counts) if count]
+
+    def copy(self) -> "Heatmap":
+        heatmap = Heatmap(0, self.bins)
+        heatmap.cells = self.cells
+        heatmap.counts = array("I", self.counts)
+        heatmap.total_ns = array("q", self.total_ns)
+        heatmap.misses = array("I", self.misses)
+        heatmap.hist = array("I", self.hist)
+        return heatmap
+
+    # ---- 保存 ----
+
+    def to_row(self, name: str) -> tuple:
+        return (name, self.cells, self.bins, self.counts.tobytes(), self.total_ns.tobytes(),
+                self.misses.tobytes(), self.hist.tobytes())
+
+    @classmethod
+    def from_row(cls, row) -> "Heatmap":
+        _, cells, bins, counts, total_ns, misses, hist = row
+        heatmap = cls(cells, bins)
+        heatmap.counts = array("I", counts)
+        heatmap.total_ns = array("q", total_ns)
+        heatmap.misses = array("I", misses)
+        heatmap.hist = array("I", hist)
+        return heatmap
+
+
+class HeatmapDelta:
+    # 1回の計測分の差分(触ったセルだけ)
+    def __init__(self, bins: int = HIST_BINS):
+        self.bins = bins
+        self.cells: dict[int, list] = {}  # セル -> [回数, 合計時間, ミス数, {ビン: 回数}]
+
+    def _entry(self, cell: int) -> list:
+        entry = self.cells.get(cell)
+        if entry is None:
+            entry = self.cells[cell] = [0, 0, 0, {}]
+        return entry
+
+    def add(self, cell: int, latency_ns: int):
+        entry = self._entry(cell)
+        entry[0] += 1
+        entry[1] += latency_ns
+        bin_index = latency_bin(latency_ns)
+        entry[3][bin_index] = entry[3].get(bin_index, 0) + 1
+
+    def add_miss(self, cell: int):
+        self._entry(cell)[2] += 1
+
+    def apply_to(self, heatmap: Heatmap):
+        bins = heatmap.bins
+        for cell, (count, total, misses, hist) in self.cells.items():
+            heatmap.counts[cell] += count
+            heatmap.total_ns[cell] += total
+            heatmap.misses[cell] += misses
+            base = cell * bins
+            for bin_index, value in hist.items():
+                heatmap.hist[base + bin_index] += value
+
+
+def session_deltas(events: Events, prompts: dict[int, Prompt]) -> tuple[HeatmapDelta, HeatmapDelta]:
+    # 1回の計測のイベント列から、かなごと・キーの組ごとの差分を作る
+    # かな: 前のかなの確定(お題の始めならお題の表示)からそのかなの確定まで。
+    #       きゃ のようにまとめて確定したときは時間を等分する
+    # キーの組: 直前に受理したキーから次に受理したキーまで。ミスは直前のキーとミスしたキーの組に数える
+    kana_delta = HeatmapDelta()
+    pair_delta = HeatmapDelta()
+    kana = ""
+    last_emit: Optional[int] = None
+    last_key: Optional[int] = None
+    last_key_t = 0
+    for t_ns, kind, code, index in events:
+        if kind == KEY:
+            if last_key is not None:
+                latency = t_ns - last_key_t
+                cell = pair_cell(last_key, code)
+                if cell is not None and latency < IDLE_NS:
+                    pair_delta.add(cell, latency)
+            last_key, last_key_t = code, t_ns
+        elif kind == EMIT:
+            if last_emit is not None and code > 0:
+                latency = (t_ns - last_emit) // code
+                if latency < IDLE_NS:
+                    for ch in kana[max(0, index - code):index]:
+                        kana_delta.add(kana_cell(ch), latency)
+            last_emit = t_ns
+        elif kind == MISTAKE:
+            if 0 <= index < len(kana):
+                kana_delta.add_miss(kana_cell(kana[index]))
+            if last_key is not None:
+                cell = pair_cell(last_key, code)
+                if cell is not None:
+                    pair_delta.add_miss(cell)
+        elif kind == PROMPT:
+            prompt = prompts.get(index)
+            kana = ((" " if code else "") + prompt.kana) if prompt is not None else ""
+            last_emit = t_ns
+        elif kind == START:
+            last_emit = t_ns
+            last_key = None
+    return kana_delta, pair_delta
+
+
+class HeatmapStats:
+    # 生涯のヒートマップ。SessionStoreの書き込みと同じトランザクションで、写しに足して表を更新し(on_commit)、
+    # コミットできてから写しと差し替える(after_commit)。ヒートマップを書き換えるのは書き込みスレッドだけ
+    def __init__(self, conn: sqlite3.Connection):
+        self._lock = threading.Lock()
+        self._staged: Optional[tuple[Heatmap, Heatmap]] = None  # コミット待ちの (かな, キーの組)
+        conn.executescript(_SCHEMA)
+        self.kana = Heatmap(KANA_CELLS)
+        self.pairs = Heatmap(PAIR_CELLS)
+        for row in conn.execute("SELECT name, cells, bins, counts, total_ns, misses, hist FROM heatmaps"):
+            heatmap = Heatmap.from_row(row)
+            if row[0] == "kana" and heatmap.cells == KANA_CELLS and heatmap.bins == HIST_BINS:
+                self.kana = heatmap
+            elif row[0] == "pair" and heatmap.cells == PAIR_CELLS and heatmap.bins == HIST_BINS:
+                self.pairs = heatmap
+
+    def on_commit(self, conn: sqlite3.Connection, events: Optional[Events], prompts: Iterable[Prompt]):
+        # 書き込みスレッドから呼ばれる(connはトランザクション中)
+        if events is None:
+            return
+        kana_delta, pair_delta = session_deltas(events, {prompt.id: prompt for prompt in prompts})
+        if self._staged is None:
+            self._staged = (self.kana.copy(), self.pairs.copy())
+        kana, pairs = self._staged
+        kana_delta.apply_to(kana)
+        pair_delta.apply_to(pairs)
+        conn.executemany("INSERT OR REPLACE INTO heatmaps VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [kana.to_row("kana"), pairs.to_row("pair")])
+
+    def after_commit(self):
+        # 書き込みスレッドから呼ばれる(コミットできたら写しと差し替える)
+        if self._staged is not None:
+            with self._lock:
+                self.kana, self.pairs = self._staged
+            self._staged = None
+
+    def after_rollback(self):
+        # 書き込みスレッドから呼ばれる(ロールバックした分の写しは捨てる)
+        self._staged = None
+
+    # ---- 問い合わせ(UIスレッド) ----
+
+    def kana_table(self) -> list[tuple[str, int, float, float, float]]:
+        # (かな, 回数, 平均ms, 90%点ms, ミス率) を遅い順に
+        with self._lock:
+            return self._table(self.kana, kana_of_cell)
+
+    def pair_table(self) -> list[tuple[tuple[str, str], int, float, float, float]]:
+        # ((直前のキー, 次のキー), 回数, 平均ms, 90%点ms, ミス率) を遅い順に
+        with self._lock:
+            return self._table(self.pairs, keys_of_cell)
+
+    @staticmethod
+    def _table(heatmap: Heatmap, label) -> list:
+        rows = [(label(cell), heatmap.counts[cell], heatmap.mean_ms(cell), heatmap.quantile_ms(cell, 0.9),
+                 heatmap.miss_rate(cell)) for cell in heatmap.used_cells()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
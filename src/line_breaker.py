@@ -0,0 +1,121 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+from typing import Iterable
+
+from PyQt6.QtGui import QFont, QFontMetricsF
+
+# お題の改行位置
+#
+# 文字数ではなく表示したときの幅で区切る(半角の多いお題が短い行にならないように)。
+# 幅は文字ごとの送り幅の和で求め、送り幅はフォントごとの表に持っておく。QFontMetricsFを引くのは
+# そのフォントで初めて出てきた文字だけなので、フォントを変えた後にお題を並べ直しても文字ごとには測らない。
+# textとkanaは文字の対応(text_bounds)で同じ所で区切り、両方が行の幅に収まる最も長い所を取る
+
+# 1行の幅の基準にする文字(1行当たりの文字数 x この文字の幅 を行の幅とする)
+REFERENCE_CHAR = "あ"
+# 表を持っておくフォントの数
+CACHED_FONTS = 4
+# 幅の比較の誤差
+_EPSILON = 0.01
+
+
+def _common_chars() -> str:
+    # よく出る文字(ASCII、ひらがな、カタカナ、全角の記号)。表を作るときにまとめて測る
+    ranges = ((0x20, 0x7f), (0x3000, 0x3040), (0x3041, 0x3097), (0x30a0, 0x3100), (0xff01, 0xff5f))
+    return "".join(chr(code) for start, end in ranges for code in range(start, end))
+
+
+_COMMON_CHARS = _common_chars()
+
+
+class GlyphAdvanceCache:
+    # 1つのフォント(ファミリ・サイズ・太さなど)での文字ごとの送り幅
+    def __init__(self, font: QFont):
+        self.key = font.key()
+        self._metrics = QFontMetricsF(font)
+        self._advances: dict[str, float] = {}
+        self.measure(_COMMON_CHARS)
+
+    def __len__(self) -> int:
+        return len(self._advances)
+
+    def measure(self, chars: Iterable[str]):
+        # まだ測っていない文字を測る
+        metrics = self._metrics
+        advances = self._advances
+        for ch in chars:
+            if ch not in advances:
+                advances[ch] = metrics.horizontalAdvance(ch)
+
+    def advance(self, ch: str) -> float:
+        advance = self._advances.get(ch)
+        if advance is None:
+            self.measure(ch)
+            advance = self._advances[ch]
+        return advance
+
+    def prefix(self, text: str) -> list[float]:
+        # text[:i]の幅(長さlen(text)+1)
+        advances = self._advances
+        if not advances.keys() >= set(text):
+            self.measure(text)
+        return list(accumulate(map(advances.__getitem__, text), initial=0.0))
+
+
+_caches: "OrderedDict[str, GlyphAdvanceCache]" = OrderedDict()
+
+
+def advance_cache(font: QFont) -> GlyphAdvanceCache:
+    # フォントごとの表(最近使ったCACHED_FONTS個だけ持つ)。フォントを変えると別の表になる
+    key = font.key()
+    cache = _caches.get(key)
+    if cache is None:
+        cache = _caches[key] = GlyphAdvanceCache(font)
+        while len(_caches) > CACHED_FONTS:
+            _caches.popitem(last=False)
+    else:
+        _caches.move_to_end(key)
+    return cache
+
+
+def break_lines(text_x: list[float], kana_x: list[float], text_bounds: list[int],
+                width: float) -> list[tuple[int, int, int, int]]:
+    # 行ごとの (textの開始, textの終了, kanaの開始, kanaの終了)
+    # text_x, kana_xはtext, kanaの先頭からの幅(prefix)。text_boundsはtextの文字の境界 -> kanaの位置
+    text_len = len(text_x) - 1
+    kana_len = len(kana_x) - 1
+    limit = width + _EPSILON
+    if text_len == 0:
+        # textが無ければkanaだけで区切る
+        lines = []
+        start = 0
+        while start < kana_len:
+            end = max(start + 1, bisect_right(kana_x, kana_x[start] + limit, start + 1) - 1)
+            lines.append((0, 0, start, end))
+            start = end
+        return lines or [(0, 0, 0, 0)]
+    lines = []
+    start = 0
+    while start < text_len:
+        # textが収まる最も長い所
+        end = bisect_right(text_x, text_x[start] + limit, start + 1) - 1
+        # その中でkanaも収まる最も長い所(kanaの幅はtextの位置について単調に増える)
+        kana_limit = kana_x[text_bounds[start]] + limit
+        lo, hi = start, end
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if kana_x[text_bounds[mid]] <= kana_limit:
+                lo = mid
+            else:
+                hi = mid - 1
+        # 1文字も収まらなくても1文字は置く
+        end = max(start + 1, lo)
+        lines.append((start, end, text_bounds[start], text_bounds[end]))
+        start = end
+    # kanaの頭と終わりは必ずどこかの行に入れる
+    first = lines[0]
+    lines[0] = (first[0], first[1], 0, first[3])
+    last = lines[-1]
+    lines[-1] = (last[0], last[1], last[2], kana_len)
+    return lines
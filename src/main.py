@@ -1,20 +1,50 @@
-from PyQt6.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QCheckBox, QSizePolicy
+import time
+# 起動の計測はimportより前から
+_STARTED_AT = time.perf_counter()
+
+import argparse
+import sys
+from PyQt6.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QCheckBox, QComboBox, QSizePolicy
 from PyQt6.QtGui import QFontDatabase, QFont, QFontMetrics
+from PyQt6.QtCore import QTimer
 import os
 from prompt_widget import PromptWidget
-from settings import SettingsWindow
+from matcher import METHODS, METHOD_NAMES
+from startup import StagedStartup, StartupProfile
+import tracing
+
+FONT_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "assets", "NotoSansJP-Regular.ttf"))
+FONT_SIZE = 20
+# 最初の描画を待つ上限
+FIRST_PAINT_TIMEOUT_MS = 500
+
+
+def _register_font(path: str) -> str | None:
+    # 別スレッドから呼ぶ(QFontDatabaseへの登録はスレッドセーフ)。登録したフォントのファミリ名を返す
+    if not os.path.exists(path):
+        return None
+    font_id = QFontDatabase.addApplicationFont(path)
+    if font_id == -1:
+        return None
+    families = QFontDatabase.applicationFontFamilies(font_id)
+    return families[0] if families else None
+
 
 def main():
-    app = QApplication([])
+    parser = argparse.ArgumentParser(description="atw")
+    parser.add_argument("--profile-startup", action="store_true", help="起動の段ごとの所要時間を出す")
+    parser.add_argument("--rebuild-activity", action="store_true", help="日別・月別の集計を記録から作り直す")
+    parser.add_argument("--trace", metavar="PATH", help=f"トレースを記録して終了時にPATHへ書き出す(環境変数{tracing.ENV_VAR}でもよい)")
+    args, _ = parser.parse_known_args()
+    if args.trace:
+        tracing.enable(args.trace)
+    else:
+        tracing.enable_from_env()
+    profile = StartupProfile(args.profile_startup, _STARTED_AT)
+    profile.mark("imports")
 
-    # フォント読み込み
-    font_path = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "assets", "NotoSansJP-Regular.ttf"))
-    if os.path.exists(font_path):
-        font_id = QFontDatabase.addApplicationFont(font_path)
-        if font_id != -1:
-            font_family = QFontDatabase.applicationFontFamilies(font_id)
-            if font_family:
-                app.setFont(QFont(font_family[0], 20))
+    app = QApplication([])
+    profile.mark("QApplication")
 
     # ウィンドウ初期化
     window = QWidget()
@@ -38,7 +68,6 @@ def main():
 
     # 相互排他かつ「すでにONのものをクリックしてもOFFにしない」ハンドラ
     def on_convert(checked: bool):
-        print(f"on_convert called with checked = {checked}")
         # 択一で常にどちらかがONにしたいので、OFFにしようとしたら元に戻す
         if not checked:
             convert_checkbox_on.blockSignals(True)
@@ -54,7 +83,6 @@ def main():
             prompt_widget.conversion_enabled = True
 
     def off_convert(checked: bool):
-        print(f"off_convert called with checked = {checked}")
         # 択一で常にどちらかがONにしたいので、OFFにしようとしたら元に戻す
         if not checked:
             convert_checkbox_off.blockSignals(True)
@@ -72,6 +100,64 @@ def main():
     convert_checkbox_on.toggled.connect(on_convert)
     convert_checkbox_off.toggled.connect(off_convert)
 
+    # 表示モード切替チェックボックス(改行表示 / 流れる文字、どちらか一方は必ずON)
+    line_mode_checkbox = QCheckBox("改行表示")
+    flow_mode_checkbox = QCheckBox("流れる文字")
+    line_mode_checkbox.setChecked(True)
+    flow_mode_checkbox.setChecked(False)
+    left_controls.insertWidget(2, line_mode_checkbox)
+    left_controls.insertWidget(3, flow_mode_checkbox)
+
+    def display_mode_handler(checkbox: QCheckBox):
+        def handler(checked: bool):
+            # 両方OFFにしようとしたら元に戻す
+            if not checked and not line_mode_checkbox.isChecked() and not flow_mode_checkbox.isChecked():
+                checkbox.blockSignals(True)
+                checkbox.setChecked(True)
+                checkbox.blockSignals(False)
+                return
+            if prompt_widget is not None:
+                prompt_widget.line_mode = line_mode_checkbox.isChecked()
+                prompt_widget.flow_mode = flow_mode_checkbox.isChecked()
+        return handler
+
+    line_mode_checkbox.toggled.connect(display_mode_handler(line_mode_checkbox))
+    flow_mode_checkbox.toggled.connect(display_mode_handler(flow_mode_checkbox))
+
+    # 苦手お題だけを出すモード
+    weak_mode_checkbox = QCheckBox("苦手お題")
+    weak_mode_checkbox.setChecked(False)
+    left_controls.insertWidget(4, weak_mode_checkbox)
+
+    def on_weak_mode(checked: bool):
+        if prompt_widget is not None:
+            prompt_widget.weak_mode = checked
+
+    weak_mode_checkbox.toggled.connect(on_weak_mode)
+
+    # 計測中でなくても打ち続けられ、打ち続けていれば途中から計測が始まるモード
+    continuous_checkbox = QCheckBox("連続打鍵")
+    continuous_checkbox.setChecked(False)
+    left_controls.insertWidget(5, continuous_checkbox)
+
+    def on_continuous_mode(checked: bool):
+        if prompt_widget is not None:
+            prompt_widget.continuous_mode = checked
+
+    continuous_checkbox.toggled.connect(on_continuous_mode)
+
+    # 入力方式(ローマ字 / かな / 漢直)。切り替えても表示は作り直さない
+    input_method_selector = QComboBox()
+    for method in METHODS:
+        input_method_selector.addItem(METHOD_NAMES[method], method)
+    left_controls.insertWidget(6, input_method_selector)
+
+    def on_input_method(index: int):
+        if prompt_widget is not None:
+            prompt_widget.input_method = input_method_selector.itemData(index)
+
+    input_method_selector.currentIndexChanged.connect(on_input_method)
+
     # 設定ウィンドウ表示ボタン
     settings_button = QPushButton("設定")
     left_controls.addWidget(settings_button)
@@ -81,10 +167,13 @@ def main():
     exit_button.clicked.connect(app.quit)
     left_controls.addWidget(exit_button)
 
-    # 設定ウィンドウ表示ボタンの動作
-    loaded_family = app.font().family()
-    settings_window = SettingsWindow(app, loaded_family)
+    # 設定ウィンドウは最初に開くときに作る
+    settings_window = None
     def open_settings():
+        nonlocal settings_window
+        if settings_window is None:
+            from settings import SettingsWindow
+            settings_window = SettingsWindow(app, app.font().family())
         settings_window.show()
         settings_window.raise_()
         settings_window.activateWindow()
@@ -93,9 +182,8 @@ def main():
     # 右側のお題表示エリア
     right_area = QVBoxLayout()
 
-    # お題ウィジェット
-    prompt_path = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "prompt.json"))
-    prompt_widget = PromptWidget(prompt_path)
+    # お題ウィジェット(ルール表・お題・記録の保存先は窓を出してから読み込んで差し込む)
+    prompt_widget = PromptWidget()
     # 初期状態をprompt_widgetに反映
     prompt_widget._conversion_enabled = False
     right_area.addWidget(prompt_widget)
@@ -104,17 +192,80 @@ def main():
     root_layout = QHBoxLayout()
     root_layout.addLayout(left_controls)
     root_layout.addLayout(right_area)
+    # 速さのグラフはお題の横に置く
+    root_layout.addWidget(prompt_widget.pace_graph)
     window.setLayout(root_layout)
 
+    profile.mark("window")
+
+    # 窓を出してから、重いものを1段ずつ読み込む
+    startup = StagedStartup(profile, app)
+
+    def load_font():
+        # 大きなCJKフォントの登録は最初の描画の後に別スレッドで。終わったら差し替える
+        def apply(family: str):
+            app.setFont(QFont(family, FONT_SIZE))
+            if settings_window is not None:
+                settings_window.loaded_family = family
+            window.adjustSize()
+        startup.add_background("font", lambda: _register_font(FONT_PATH), apply)
+
+    def load_rules():
+        # 入力ルール表(コンパイル済みキャッシュがあればそれを使う)
+        from rule_cache import load_cached
+        prompt_widget.set_rule_table(load_cached())
+
+    def load_prompts():
+        # お題(同梱のお題ファイルが変わっていれば取り込み直す)
+        from prompt_store import PromptStore, DEFAULT_PROMPT_PATH
+        prompts = PromptStore()
+        prompts.sync_json(DEFAULT_PROMPT_PATH)
+        app.aboutToQuit.connect(prompts.close)
+        prompt_widget.set_prompts(prompts)
+
+    def load_store():
+        # 計測記録の保存先(書き込みは別スレッド。終了時に書き残しを書いて閉じる)
+        from storage import SessionStore
+        from weakness import WeaknessTracker
+        from heatmap import HeatmapStats
+        store = SessionStore()
+        app.aboutToQuit.connect(store.close)
+        if args.rebuild_activity:
+            store.rebuild_activity()
+        store.record_launch()
+        # 苦手お題の集計(記録の保存と一緒に更新する)
+        weakness = WeaknessTracker(store.conn)
+        store.add_observer(weakness)
+        heatmap = HeatmapStats(store.conn)
+        store.add_observer(heatmap)
+        prompt_widget.set_store(store, weakness)
+        if prompt_widget.weak_mode:
+            # 苦手お題モードが先に選ばれていたら選び直す
+            prompt_widget.weak_mode = True
+
+    load_font()
+    startup.add("rules", load_rules)
+    startup.add("prompts", load_prompts)
+    startup.add("storage", load_store)
+
+    def on_ready():
+        # 起動から全部そろうまで
+        profile.add("ready", profile.origin, time.perf_counter())
+        profile.report()
+
+    startup.finished.connect(on_ready)
+
     # 表示
+    # 読み込みは最初の描画の後から(描画の通知が来ない環境でも少し待てば始める)
+    profile.watch_first_paint(window, startup.start)
     window.show()
-    app.processEvents()
-    try:
-        prompt_widget.updateGeometry()
-    except Exception:
-        pass
     window.adjustSize()
+    QTimer.singleShot(FIRST_PAINT_TIMEOUT_MS, startup.start)
     app.exec()
+    # トレースは記録の保存先を閉じた(書き残しを書いた)後に書き出す
+    path = tracing.export()
+    if path:
+        print(f"トレースを書き出しました: {path}", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,177 @@
+import os
+from typing import Optional
+
+from composer import EMITTED, MISSED, Composer, ComposerTable
+from planner import KeystrokePlanner
+from rule_cache import load_cached
+
+# 入力方式ごとの照合
+#
+# どの方式も「打鍵(または確定した文字)を1つ受け取り、お題のかなの位置をどこまで進めたか」を返す
+# 同じインターフェース(Matcher)を持ち、PromptWidgetは方式を知らずに打鍵を流すだけにする。
+# 方式の切り替えはMatcherの差し替えだけで、ウィジェットは作り直さない。
+# ルール表を使う方式は、表のコンパイル(とキャッシュ)と打鍵列の計画の準備を作成時に1回だけ行う
+
+ROMAJI = "romaji"
+KANA = "kana"
+KANJI_DIRECT = "kanji_direct"
+METHODS = (ROMAJI, KANA, KANJI_DIRECT)
+METHOD_NAMES = {ROMAJI: "ローマ字", KANA: "かな", KANJI_DIRECT: "漢直"}
+
+KANA_RULES_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), "rules", "kana_rules.json"))
+
+
+class Matcher:
+    # 入力方式の共通インターフェース
+    # feed(pos, key) -> (結果, 新しいかな位置)。結果はcomposerと同じビットフラグ
+    # (PENDING: 保留しただけ, EMITTED: かなを確定した, MISSED: お題どおりでないので受理しない)
+    name = ""
+    # ミスを数えるか(漢直は数えない)
+    counts_misses = True
+    # 入力打鍵列(キーガイド)を出せるか
+    plans_strokes = False
+
+    def typable(self, text: str, kana: str) -> bool:
+        # このお題を最後まで打ち切れるか
+        return bool(kana)
+
+    def set_target(self, text: str, kana: str, text_bounds: list[int]):
+        # 表示するお題が変わったときに1回だけ呼ぶ
+        pass
+
+    def reset(self):
+        # お題の最初から打ち直す
+        pass
+
+    def seek(self, kana_pos: int):
+        # 何も保留していない状態でかなの位置kana_posまで打ったことにする(途中から始めた計測のリプレイ用)
+        self.reset()
+
+    def feed(self, pos: int, key: str) -> tuple[int, int]:
+        raise NotImplementedError
+
+    @property
+    def clean(self) -> bool:
+        # 何も保留していないか(ここから計測を始められる)
+        return True
+
+    @property
+    def preedit(self) -> str:
+        # 未確定の打鍵列
+        return ""
+
+    def plan(self, pos: int) -> tuple[str, tuple[int, ...]]:
+        # 入力打鍵列の表示用: 現在の位置からの打鍵列と各かなの打鍵が始まる位置。出せなければ空
+        return "", ()
+
+    def plan_from_start(self) -> tuple[str, tuple[int, ...]]:
+        return "", ()
+
+    def next_keys(self, pos: int, count: int = 2) -> str:
+        # キーガイド用: 現在の位置から次に打つキー。出せなければ空
+        return ""
+
+
+class ComposerMatcher(Matcher):
+    # ルール表(ローマ字・かな配列)で打鍵をかなにする方式
+    plans_strokes = True
+
+    def __init__(self, table: ComposerTable, name: str = ROMAJI):
+        self.name = name
+        self.table = table
+        self.composer = Composer(table)
+        self.planner = KeystrokePlanner(table)
+
+    def typable(self, text: str, kana: str) -> bool:
+        return bool(kana) and self.planner.typable_prefix(kana) == len(kana)
+
+    def set_target(self, text: str, kana: str, text_bounds: list[int]):
+        self.planner.set_kana(kana)
+
+    def reset(self):
+        self.composer.reset()
+
+    def feed(self, pos: int, key: str) -> tuple[int, int]:
+        # お題どおりに打ち切れなくなるキーはミスとして受理しない
+        advanced = self.planner.advance(pos, self.composer.state, key)
+        if advanced is None:
+            return MISSED, pos
+        result = self.composer.feed(key)
+        pos = advanced[0]
+        # お題の最後のかなは続く打鍵を待たずに確定する(かな配列のt -> か など)
+        if self.planner.flush_completes(pos, self.composer.state):
+            self.composer.flush()
+            return EMITTED, len(self.planner.kana)
+        return result & EMITTED, pos
+
+    @property
+    def clean(self) -> bool:
+        return self.composer.state == 0
+
+    @property
+    def preedit(self) -> str:
+        return self.composer.preedit
+
+    def plan(self, pos: int) -> tuple[str, tuple[int, ...]]:
+        return self.planner.plan(pos, self.composer.state)
+
+    def plan_from_start(self) -> tuple[str, tuple[int, ...]]:
+        return self.planner.plan(0, 0)
+
+    def next_keys(self, pos: int, count: int = 2) -> str:
+        return self.planner.next_keys(pos, self.composer.state, count)
+
+
+class KanjiDirectMatcher(Matcher):
+    # 漢直: 確定した文字がお題のtextの次の文字と一致するかだけを見る。ミスは数えない
+    # 位置はほかの方式とそろえてかなの位置で返す(textの文字の境界 -> かなの位置)。
+    # かな1文字に当たるtextの文字(お題の間の_など)はそのかなでもよい
+    name = KANJI_DIRECT
+    counts_misses = False
+
+    def __init__(self):
+        self._text = ""
+        self._kana = ""
+        self._bounds: list[int] = [0]
+        self._text_pos = 0
+
+    def typable(self, text: str, kana: str) -> bool:
+        return bool(text) and bool(kana)
+
+    def set_target(self, text: str, kana: str, text_bounds: list[int]):
+        self._text = text
+        self._kana = kana
+        self._bounds = text_bounds
+        self._text_pos = 0
+
+    def reset(self):
+        self._text_pos = 0
+
+    def feed(self, pos: int, key: str) -> tuple[int, int]:
+        text_pos = self._text_pos
+        if text_pos >= len(self._text):
+            return MISSED, pos
+        start, end = self._bounds[text_pos], self._bounds[text_pos + 1]
+        if key != self._text[text_pos] and not (end - start == 1 and self._kana[start] == key):
+            return MISSED, pos
+        self._text_pos = text_pos + 1
+        return EMITTED, self._bounds[self._text_pos]
+
+    def seek(self, kana_pos: int):
+        # かなの位置に対応するtextの位置へ
+        text_pos = 0
+        while text_pos < len(self._text) and self._bounds[text_pos + 1] <= kana_pos:
+            text_pos += 1
+        self._text_pos = text_pos
+
+
+def create_matcher(method: str, romaji_table: Optional[ComposerTable] = None) -> Matcher:
+    if method == ROMAJI:
+        if romaji_table is None:
+            romaji_table = load_cached()
+        return ComposerMatcher(romaji_table, ROMAJI)
+    if method == KANA:
+        return ComposerMatcher(load_cached(KANA_RULES_PATH), KANA)
+    if method == KANJI_DIRECT:
+        return KanjiDirectMatcher()
+    raise ValueError(f"未知の入力方式です: {method}")
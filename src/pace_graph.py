@@ -0,0 +1,282 @@
+import math
+from array import array
+from collections import deque
+from typing import Optional
+
+from PyQt6.QtWidgets import QWidget, QSizePolicy
+from PyQt6.QtCore import Qt, QSize, QLineF, QPointF, QRect, QRectF, QTimer
+from PyQt6.QtGui import QPainter, QPalette, QColor, QPen, QPolygonF
+
+from analytics import LAP_NS, SPAN_CHARS
+from timer import display_refresh_interval_ms
+import tracing
+
+NS_PER_SECOND = 1_000_000_000
+
+# 打鍵中の速さのグラフ
+#
+# 速さ(直近SPAN_CHARS文字の1秒あたりのかな数)は確定のたびに出るが、1時間分を毎回描き直すのは
+# 無駄なので、固定数のバケツにまとめて持つ(バケツごとの最小・最大・平均)。計測が延びて
+# バケツが足りなくなったら隣り合う2つずつをまとめて幅を倍にする。描くのはバケツの数だけなので、
+# 計測の長さによらず1フレームの手間は一定になる。確定で変わるのは最後のバケツだけなので、
+# 縦軸やバケツの幅が変わらない限りはその範囲だけを描き直す。描き直しは表示の更新間隔にまとめ、
+# 打鍵を受けたフレーム(お題の描画)には載せない。比べる自己ベストはラップごとの確定かな数から作る
+
+DEFAULT_BUCKETS = 256
+# 最初のバケツの幅(256個で64秒。1分の計測ならまとめ直さずに済む)
+DEFAULT_BUCKET_NS = NS_PER_SECOND // 4
+
+_MARGIN = 4
+
+
+class Downsampler:
+    # 時刻の昇順に来る値を、固定数のバケツの最小・最大・合計・件数にまとめる
+    def __init__(self, buckets: int = DEFAULT_BUCKETS, width_ns: int = DEFAULT_BUCKET_NS):
+        self.buckets = max(2, buckets - buckets % 2)
+        self._initial_width = max(1, width_ns)
+        self.reset()
+
+    def reset(self, width_ns: Optional[int] = None):
+        if width_ns is not None:
+            self._initial_width = max(1, width_ns)
+        n = self.buckets
+        self.width_ns = self._initial_width
+        self.mins = array("d", bytes(8 * n))
+        self.maxs = array("d", bytes(8 * n))
+        self.sums = array("d", bytes(8 * n))
+        self.counts = array("I", bytes(4 * n))
+        # 値が入っている最後のバケツ(無ければ-1)
+        self.last = -1
+        # まとめ直した回数(描画側のキャッシュの作り直しに使う)
+        self.generation = 0
+
+    @property
+    def span_ns(self) -> int:
+        return self.buckets * self.width_ns
+
+    def add(self, t_ns: int, value: float) -> int:
+        # 足したバケツを返す
+        bucket = max(0, t_ns) // self.width_ns
+        while bucket >= self.buckets:
+            self._halve()
+            bucket = max(0, t_ns) // self.width_ns
+        if self.counts[bucket]:
+            if value < self.mins[bucket]:
+                self.mins[bucket] = value
+            if value > self.maxs[bucket]:
+                self.maxs[bucket] = value
+        else:
+            self.mins[bucket] = self.maxs[bucket] = value
+        self.sums[bucket] += value
+        self.counts[bucket] += 1
+        if bucket > self.last:
+            self.last = bucket
+        return bucket
+
+    def _halve(self):
+        # 隣り合う2つずつをまとめて前半に詰め、幅を倍にする
+        mins, maxs, sums, counts = self.mins, self.maxs, self.sums, self.counts
+        half = self.buckets // 2
+        for i in range(half):
+            a, b = 2 * i, 2 * i + 1
+            if counts[a] and counts[b]:
+                mins[i] = min(mins[a], mins[b])
+                maxs[i] = max(maxs[a], maxs[b])
+            elif counts[b]:
+                mins[i], maxs[i] = mins[b], maxs[b]
+            else:
+                mins[i], maxs[i] = mins[a], maxs[a]
+            sums[i] = sums[a] + sums[b]
+            counts[i] = counts[a] + counts[b]
+        for i in range(half, self.buckets):
+            mins[i] = maxs[i] = sums[i] = 0.0
+            counts[i] = 0
+        self.width_ns *= 2
+        self.last = self.last // 2 if self.last >= 0 else -1
+        self.generation += 1
+
+    def mean(self, bucket: int) -> Optional[float]:
+        count = self.counts[bucket]
+        return self.sums[bucket] / count if count else None
+
+
+class PaceGraph(QWidget):
+    # 今の計測の速さ(最小-最大の帯と平均の線)と、自己ベストの速さを重ねて描く
+    def __init__(self, buckets: int = DEFAULT_BUCKETS, parent=None):
+        super().__init__(parent)
+        self.series = Downsampler(buckets)
+        self._recent: deque[int] = deque(maxlen=SPAN_CHARS + 1)
+        # 自己ベストのラップごとの速さ(かな/秒)と、それをバケツの区切りに合わせたもの
+        self._reference = array("d")
+        self._reference_lap_ns = LAP_NS
+        self._reference_cache: Optional[array] = None
+        self._reference_key = None
+        self._reference_polygon = None
+        self._y_max = 1.0
+        # 描き直し待ちの範囲
+        self._dirty = QRect()
+        self._repaint_timer = QTimer(self)
+        self._repaint_timer.setSingleShot(True)
+        self._repaint_timer.timeout.connect(self._repaint)
+        self.setAttribute(Qt.WidgetAttribute.WA_OpaquePaintEvent)
+        self.setSizePolicy(QSizePolicy.Policy.Preferred, QSizePolicy.Policy.Expanding)
+
+    def sizeHint(self) -> QSize:
+        return QSize(240, 120)
+
+    def minimumSizeHint(self) -> QSize:
+        return QSize(80, 40)
+
+    # ---- データ ----
+
+    def start(self, reference_laps=None, reference_duration_ns: int = 0, lap_ns: int = LAP_NS):
+        # 計測の開始時に呼ぶ。reference_lapsは自己ベストのラップごとの確定かな数
+        # (最後のラップは途中で終わっていることがあるので、長さはreference_duration_nsから求める)
+        self.series.reset()
+        self._recent.clear()
+        self._recent.append(0)
+        self._reference_lap_ns = lap_ns
+        laps = list(reference_laps or ())
+        lengths = [lap_ns] * len(laps)
+        if laps and reference_duration_ns > 0:
+            lengths[-1] = max(1, min(lap_ns, reference_duration_ns - (len(laps) - 1) * lap_ns))
+        self._reference = array("d", [count * NS_PER_SECOND / length for count, length in zip(laps, lengths)])
+        self._reference_cache = None
+        self._reference_polygon = None
+        self._y_max = max([1.0, *self._reference])
+        self.update()
+
+    def add_kana(self, t_ns: int, count: int = 1):
+        # 計測開始からt_nsにcount文字確定した。直近SPAN_CHARS文字の速さを1件足す
+        recent = self._recent
+        for _ in range(count):
+            recent.append(t_ns)
+        elapsed = t_ns - recent[0]
+        if elapsed <= 0:
+            return
+        pace = (len(recent) - 1) * NS_PER_SECOND / elapsed
+        series = self.series
+        generation = series.generation
+        bucket = series.add(t_ns, pace)
+        if pace > self._y_max or series.generation != generation:
+            # 縦軸かバケツの幅が変わった: 全体を描き直す
+            self._y_max = max(self._y_max, pace)
+            self._schedule(self.rect())
+            return
+        # 変わったのはそのバケツと、前後のバケツとの間の平均の線だけ(ふつうは最後のバケツ)
+        self._schedule(self._bucket_rect(self._previous_bucket(bucket), self._next_bucket(bucket)))
+
+    def _schedule(self, rect: QRect):
+        self._dirty = self._dirty.united(rect)
+        if not self._repaint_timer.isActive():
+            self._repaint_timer.start(display_refresh_interval_ms())
+
+    def _repaint(self):
+        dirty, self._dirty = self._dirty, QRect()
+        self.update(dirty)
+
+    def _previous_bucket(self, bucket: int) -> int:
+        # bucketより前で値が入っている最後のバケツ(無ければbucket)
+        counts = self.series.counts
+        for i in range(bucket - 1, -1, -1):
+            if counts[i]:
+                return i
+        return bucket
+
+    def _next_bucket(self, bucket: int) -> int:
+        # bucketより後で値が入っている最初のバケツ(無ければbucket)
+        counts = self.series.counts
+        for i in range(bucket + 1, self.series.last + 1):
+            if counts[i]:
+                return i
+        return bucket
+
+    def _reference_values(self) -> array:
+        # 自己ベストの速さをバケツの中央の時刻で引いたもの(まとめ直したときだけ作り直す)
+        series = self.series
+        key = (series.generation, series.width_ns, len(self._reference))
+        if self._reference_cache is None or self._reference_key != key:
+            values = array("d")
+            for i in range(series.buckets):
+                lap = ((2 * i + 1) * series.width_ns // 2) // self._reference_lap_ns
+                values.append(self._reference[lap] if lap < len(self._reference) else -1.0)
+            self._reference_cache = values
+            self._reference_key = key
+        return self._reference_cache
+
+    # ---- 描画 ----
+
+    def _area(self) -> QRectF:
+        return QRectF(self.rect()).adjusted(_MARGIN, _MARGIN, -_MARGIN, -_MARGIN)
+
+    def _bucket_rect(self, first: int, last: int) -> QRect:
+        # バケツfirst..lastを描く範囲(線の太さの分だけ広げる)
+        area = self._area()
+        step = area.width() / self.series.buckets
+        left = math.floor(area.left() + first * step) - 2
+        right = math.ceil(area.left() + (last + 1) * step) + 2
+        return QRect(left, 0, right - left, self.height())
+
+    @tracing.traced("PaceGraph.paint", "render")
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        palette = self.palette()
+        clip = event.rect()
+        painter.fillRect(clip, palette.color(QPalette.ColorRole.Base))
+        series = self.series
+        area = self._area()
+        if area.width() <= 0 or area.height() <= 0:
+            return
+        step = area.width() / series.buckets
+        # 描き直す範囲にかかるバケツ(線の端やつなぎ目が範囲にかからないよう数画素広げ、
+        # 平均の線はその前の点から引く)
+        first = max(0, math.floor((clip.left() - _MARGIN - area.left()) / step))
+        last = min(series.buckets - 1, math.ceil((clip.right() + _MARGIN - area.left()) / step))
+        first = self._previous_bucket(first)
+        scale = area.height() / (self._y_max * 1.1)
+        bottom = area.bottom()
+
+        def y_of(value: float) -> float:
+            return bottom - value * scale
+
+        # 自己ベスト
+        reference = self._reference_values()
+        if len(self._reference):
+            # 破線の継ぎ目がずれないように、描き直す範囲によらず線全体を渡す(点の列は作り置く)
+            key = (self._reference_key, area, scale)
+            if self._reference_polygon is None or self._reference_polygon[0] != key:
+                points = [QPointF(area.left() + (i + 0.5) * step, y_of(value))
+                          for i, value in enumerate(reference) if value >= 0]
+                self._reference_polygon = (key, QPolygonF(points))
+            painter.setPen(QPen(palette.color(QPalette.ColorRole.PlaceholderText), 1, Qt.PenStyle.DashLine))
+            painter.drawPolyline(self._reference_polygon[1])
+
+        # 最小-最大の帯
+        band = palette.color(QPalette.ColorRole.Highlight)
+        band.setAlpha(60)
+        painter.setPen(QPen(band, max(1.0, step)))
+        last = min(last, series.last)
+        counts, mins, maxs, sums = series.counts, series.mins, series.maxs, series.sums
+        left = area.left() + 0.5 * step
+        painter.drawLines([QLineF(left + i * step, bottom - maxs[i] * scale, left + i * step, bottom - mins[i] * scale)
+                           for i in range(first, last + 1) if counts[i]])
+
+        # 平均。自己ベストより速ければ緑、遅ければ赤。線分は色ごとにまとめて描く
+        faster, slower, neutral = [], [], []
+        previous = None
+        for i in range(first, last + 1):
+            count = counts[i]
+            if not count:
+                continue
+            mean = sums[i] / count
+            point = QPointF(left + i * step, bottom - mean * scale)
+            if previous is not None:
+                segments = neutral if reference[i] < 0 else faster if mean >= reference[i] else slower
+                segments.append(QLineF(previous, point))
+            previous = point
+        for segments, color in ((neutral, palette.color(QPalette.ColorRole.Text)), (faster, QColor(40, 160, 60)),
+                                (slower, QColor(200, 40, 40))):
+            if segments:
+                painter.setPen(QPen(color, 2))
+                painter.drawLines(segments)
+        painter.end()
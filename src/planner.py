@@ -0,0 +1,336 @@
+from typing import Optional
+
+from composer import COLUMNS, END_COLUMN, KEY_BASE, KEY_COUNT, MISSED, ComposerTable
+
+INF = 1 << 30
+
+# 1回の確定に至るまでの保留打鍵の上限(ルールの入力長より十分長ければよい)
+_MAX_PENDING = 8
+
+
+class KeystrokePlanner:
+    # お題のかなに対する最短打鍵列(入力打鍵列の表示とキーガイド用)を求める
+    #
+    # 位置posと状態stateの組について「そこから最後まで打ち切るのに必要な最小打鍵数」を
+    # お題ごとに末尾から1回だけ計算しておく(set_kana)。打鍵後に必要なのは新しい(pos, state)の
+    # 値を引くことだけなので、si/shiのような別表記を選ばれても以降のガイドがそのまま追従する
+    def __init__(self, table: ComposerTable):
+        self.table = table
+        # 同じ打鍵数の候補はルール表で先に書かれている方を選ぶ(Trieの状態番号は登録順になっている)
+        self._input_ids = {keys: i for i, keys in enumerate(table.state_input)}
+        # 状態ごとの「次に確定するまでの打鍵列」: 確定かな -> [(打鍵列, 確定後の状態)]
+        self._paths: dict[int, dict[str, list[tuple[str, int]]]] = {}
+        self._steps: dict[int, tuple[tuple[int, ...], dict[str, tuple[int, ...]]]] = {}
+        self._max_emit = 1
+        # 確定直後に居得る状態(根と、kkの残りのkなど)
+        self._landing: list[int] = []
+        self._landing_index: dict[int, int] = {}
+        self._landing_steps: dict[str, list[tuple[int, list[tuple[str, int, int]]]]] = {}
+        # お題の最後だけは、保留したまま強制確定して打ち切れる(かな配列のt -> か など)
+        # 状態ごとの「強制確定で確定するかな -> それまでの打鍵列」
+        self._finals: dict[int, dict[str, str]] = {}
+        self._max_final = 0
+        self._collect_landing_states()
+        self._landing_finals = [(li, finals) for li, finals in
+                                enumerate(self._finals_from(state) for state in self._landing) if finals]
+
+        self._kana = ""
+        self._costs: list[list[int]] = []
+        self._choices: list[list[Optional[tuple[int, str, int]]]] = []
+        self._extra: dict[tuple[int, int], tuple[int, Optional[tuple[int, str, int]]]] = {}
+        self._plans: dict[tuple[int, int], tuple[str, tuple[int, ...]]] = {}
+
+    def _paths_from(self, state: int) -> dict[str, list[tuple[str, int]]]:
+        paths = self._paths.get(state)
+        if paths is not None:
+            return paths
+        table = self.table
+        best: dict[tuple[str, int], str] = {}
+        # 保留状態を辿りながら、最初に何かが確定するまでの打鍵列を列挙する
+        stack: list[tuple[int, str, frozenset]] = [(state, "", frozenset((state,)))]
+        while stack:
+            current, keys, seen = stack.pop()
+            base = current * COLUMNS
+            for col in range(KEY_COUNT):
+                index = base + col
+                if table.results[index] & MISSED:
+                    continue
+                target = table.next_state[index]
+                eid = table.emit_ids[index]
+                typed = keys + chr(KEY_BASE + col)
+                if eid == 0:
+                    if target not in seen and len(typed) < _MAX_PENDING:
+                        stack.append((target, typed, seen | {target}))
+                    continue
+                # 確定済みかなを書き換えるルールは打鍵列の計画には使わない
+                if table.emit_back[eid]:
+                    continue
+                text = table.emit_text[eid]
+                prev = best.get((text, target))
+                if prev is None or self._rank(state, typed) < self._rank(state, prev):
+                    best[(text, target)] = typed
+        paths: dict[str, list[tuple[str, int]]] = {}
+        for (text, target), keys in best.items():
+            paths.setdefault(text, []).append((keys, target))
+            self._max_emit = max(self._max_emit, len(text))
+        for options in paths.values():
+            options.sort(key=lambda option: self._rank(state, option[0]))
+        self._paths[state] = paths
+        return paths
+
+    def _finals_from(self, state: int) -> dict[str, str]:
+        finals = self._finals.get(state)
+        if finals is not None:
+            return finals
+        table = self.table
+        finals = {}
+        stack: list[tuple[int, str, frozenset]] = [(state, "", frozenset((state,)))]
+        while stack:
+            current, keys, seen = stack.pop()
+            index = current * COLUMNS + END_COLUMN
+            eid = table.emit_ids[index]
+            if eid and not table.results[index] & MISSED and not table.emit_back[eid]:
+                text = table.emit_text[eid]
+                prev = finals.get(text)
+                if prev is None or self._rank(state, keys) < self._rank(state, prev):
+                    finals[text] = keys
+            base = current * COLUMNS
+            for col in range(KEY_COUNT):
+                index = base + col
+                if table.results[index] & MISSED or table.emit_ids[index]:
+                    continue
+                target = table.next_state[index]
+                if target not in seen and len(keys) + 1 < _MAX_PENDING:
+                    stack.append((target, keys + chr(KEY_BASE + col), seen | {target}))
+        for text in finals:
+            self._max_final = max(self._max_final, len(text))
+        self._finals[state] = finals
+        return finals
+
+    def _rank(self, state: int, keys: str) -> tuple[int, list[int]]:
+        prefix = self.table.state_input[state]
+        order = [self._input_ids.get(prefix + keys[:i + 1], INF) for i in range(len(keys))]
+        return len(keys), order
+
+    def _collect_landing_states(self):
+        queue = [0]
+        self._landing_index[0] = 0
+        while queue:
+            state = queue.pop()
+            self._landing.append(state)
+            for options in self._paths_from(state).values():
+                for _, target in options:
+                    if target not in self._landing_index:
+                        self._landing_index[target] = -1
+                        queue.append(target)
+        self._landing_index = {state: i for i, state in enumerate(self._landing)}
+
+    @property
+    def kana(self) -> str:
+        return self._kana
+
+    def set_kana(self, kana: str):
+        # 末尾から1パスで全位置・全着地状態の最小打鍵数を求める
+        self._kana = kana
+        self._extra = {}
+        self._plans = {}
+        n = len(kana)
+        landing = self._landing
+        width = len(landing)
+        steps = self._landing_steps or self._collect_landing_steps()
+        max_emit = self._max_emit
+        costs: list[list[int]] = [[]] * (n + 1)
+        choices: list[list[Optional[tuple[int, str, int]]]] = [[]] * (n + 1)
+        costs[n] = [0 if state == 0 else INF for state in landing]
+        choices[n] = [None] * width
+        for pos in range(n - 1, -1, -1):
+            # この位置で確定し得るかなごとに、それを確定できる着地状態だけを更新する
+            # (長さの短い順・ルール表の順に比べるので、同じ打鍵数なら_best_stepと同じものを選ぶ)
+            row = [INF] * width
+            choice: list[Optional[tuple[int, str, int]]] = [None] * width
+            for length in range(1, min(max_emit, n - pos) + 1):
+                sources = steps.get(kana[pos:pos + length])
+                if sources is None:
+                    continue
+                rest = costs[pos + length]
+                for li, options in sources:
+                    best = row[li]
+                    for keys, target, target_li in options:
+                        cost = len(keys) + rest[target_li]
+                        if cost < best:
+                            best = cost
+                            choice[li] = (length, keys, target)
+                    row[li] = best
+            if n - pos <= self._max_final:
+                # 残りを強制確定で打ち切る(確定後は状態0でお題の最後に着く)
+                tail = kana[pos:]
+                for li, finals in self._landing_finals:
+                    keys = finals.get(tail)
+                    if keys is not None and len(keys) < row[li]:
+                        row[li] = len(keys)
+                        choice[li] = (n - pos, keys, 0)
+            costs[pos] = row
+            choices[pos] = choice
+        self._costs = costs
+        self._choices = choices
+
+    def _collect_landing_steps(self) -> dict[str, list[tuple[int, list[tuple[str, int, int]]]]]:
+        # 確定かな -> [(着地番号, [(打鍵列, 確定後の状態, その着地番号)])](set_kanaの内側のループ用)
+        index = self._landing_index
+        steps: dict[str, list[tuple[int, list[tuple[str, int, int]]]]] = {}
+        for li, state in enumerate(self._landing):
+            for text, options in self._paths_from(state).items():
+                steps.setdefault(text, []).append((li, [(keys, target, index[target]) for keys, target in options]))
+        self._landing_steps = steps
+        return steps
+
+    def typable_prefix(self, kana: str) -> int:
+        # kanaを先頭からどこまで打てるか(len(kana)なら最後まで打ち切れる)
+        # 打てるかどうかだけを見るので、set_kanaと違って届く(pos, state)だけを前から辿る
+        n = len(kana)
+        reached: list[Optional[set[int]]] = [None] * (n + 1)
+        reached[0] = {0}
+        furthest = 0
+        steps = self._steps
+        for pos in range(n):
+            states = reached[pos]
+            if states is None:
+                continue
+            furthest = pos
+            for state in states:
+                lengths, by_text = steps.get(state) or self._steps_from(state)
+                for length in lengths:
+                    end = pos + length
+                    if end > n:
+                        break
+                    targets = by_text.get(kana[pos:end])
+                    if targets is not None:
+                        if reached[end] is None:
+                            reached[end] = set(targets)
+                        else:
+                            reached[end].update(targets)
+                if n - pos <= self._max_final and kana[pos:] in self._finals_from(state):
+                    return n
+        if reached[n] is not None and 0 in reached[n]:
+            return n
+        return furthest
+
+    def _steps_from(self, state: int) -> tuple[tuple[int, ...], dict[str, tuple[int, ...]]]:
+        # 状態stateから確定できるかなの長さの一覧と、かな -> 確定後の状態
+        by_text = {text: tuple(target for _, target in options) for text, options in self._paths_from(state).items()}
+        steps = (tuple(sorted({len(text) for text in by_text})), by_text)
+        self._steps[state] = steps
+        return steps
+
+    def _best_step(self, pos: int, state: int, costs: list[list[int]]) -> tuple[int, Optional[tuple[int, str, int]]]:
+        kana = self._kana
+        paths = self._paths_from(state)
+        best, choice = INF, None
+        for length in range(1, min(self._max_emit, len(kana) - pos) + 1):
+            options = paths.get(kana[pos:pos + length])
+            if not options:
+                continue
+            rest = costs[pos + length]
+            for keys, target in options:
+                cost = len(keys) + rest[self._landing_index[target]]
+                if cost < best:
+                    best, choice = cost, (length, keys, target)
+        finals = self._finals_from(state)
+        if len(kana) - pos <= self._max_final:
+            keys = finals.get(kana[pos:])
+            if keys is not None and len(keys) < best:
+                best, choice = len(keys), (len(kana) - pos, keys, 0)
+        return best, choice
+
+    def _lookup(self, pos: int, state: int) -> tuple[int, Optional[tuple[int, str, int]]]:
+        li = self._landing_index.get(state)
+        if li is not None:
+            return self._costs[pos][li], self._choices[pos][li]
+        # 保留中の状態(kyなど)はその場で1段だけ計算する
+        key = (pos, state)
+        cached = self._extra.get(key)
+        if cached is None:
+            if pos >= len(self._kana):
+                cached = (INF, None)
+            else:
+                cached = self._best_step(pos, state, self._costs)
+            self._extra[key] = cached
+        return cached
+
+    def cost(self, pos: int, state: int = 0) -> int:
+        # (pos, state)から最後まで打ち切るのに必要な最小打鍵数。打ち切れないならINF
+        if pos > len(self._kana):
+            return INF
+        return self._lookup(pos, state)[0]
+
+    def advance(self, pos: int, state: int, key: str) -> Optional[tuple[int, int]]:
+        # keyを打った後の(pos, state)。お題どおりに打ち切れなくなるキーならNone
+        if len(key) != 1:
+            return None
+        col = ord(key) - KEY_BASE
+        if col < 0 or col >= KEY_COUNT:
+            return None
+        table = self.table
+        index = state * COLUMNS + col
+        if table.results[index] & MISSED:
+            return None
+        target = table.next_state[index]
+        eid = table.emit_ids[index]
+        if eid:
+            if table.emit_back[eid]:
+                return None
+            text = table.emit_text[eid]
+            if not self._kana.startswith(text, pos):
+                return None
+            pos += len(text)
+        if self.cost(pos, target) >= INF:
+            return None
+        return pos, target
+
+    def flush_completes(self, pos: int, state: int) -> bool:
+        # 保留中の打鍵を強制確定すると、お題の残りがちょうど確定するか
+        if state == 0:
+            return False
+        table = self.table
+        index = state * COLUMNS + END_COLUMN
+        eid = table.emit_ids[index]
+        if not eid or table.results[index] & MISSED or table.emit_back[eid]:
+            return False
+        text = table.emit_text[eid]
+        return len(text) == len(self._kana) - pos and self._kana.startswith(text, pos)
+
+    def plan(self, pos: int, state: int = 0) -> tuple[str, tuple[int, ...]]:
+        # (pos, state)からの打鍵列と、各かなの打鍵が始まる位置を返す
+        # 打鍵列は未確定の入力(state_input[state])から始まる
+        # 計算済みの(pos, state)に当たるまで前に進み、そこから後ろ向きに組み立てるので、
+        # 打鍵ごとに増えるのは新しく通った分だけ。途中の位置は末尾からの距離で持ち、
+        # 後ろの分をずらさずにつなげられるようにする(お題の最初の計画で二乗にならない)
+        chain: list[tuple[int, int, Optional[tuple[int, str, int]]]] = []
+        cur_pos, cur_state = pos, state
+        while (cur_pos, cur_state) not in self._plans:
+            cost, choice = self._lookup(cur_pos, cur_state)
+            if cost >= INF or choice is None:
+                self._plans[(cur_pos, cur_state)] = (self.table.state_input[cur_state], ())
+                break
+            chain.append((cur_pos, cur_state, choice))
+            cur_pos, cur_state = cur_pos + choice[0], choice[2]
+        state_input = self.table.state_input
+        for cur_pos, cur_state, (length, keys, target) in reversed(chain):
+            rest_keys, rest_ends = self._plans[(cur_pos + length, target)]
+            # 確定後に残る打鍵(kk -> っ + k の k など)は次のかなの打鍵として数える
+            carry = len(state_input[target])
+            head = state_input[cur_state] + keys[:len(keys) - carry]
+            self._plans[(cur_pos, cur_state)] = (head + rest_keys, (len(head) + len(rest_keys),) * length + rest_ends)
+        keys, ends = self._plans[(pos, state)]
+        size = len(keys)
+        return keys, tuple(size - end for end in ends)
+
+    def next_keys(self, pos: int, state: int = 0, count: int = 2) -> str:
+        # キーガイド用: 次に打つキーをcount個
+        # 打鍵ごとに呼ぶので、計算済みの計画があれば各かなの位置の組み立て(plan)は省く
+        cached = self._plans.get((pos, state))
+        if cached is None:
+            self.plan(pos, state)
+            cached = self._plans[(pos, state)]
+        pending = len(self.table.state_input[state])
+        return cached[0][pending:pending + count]
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+DEFAULT_DB_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "prompts.sqlite3"))
+DEFAULT_PROMPT_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "prompt.json"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS prompts (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,            -- 取り込み元(ファイル名など)
+    source_id TEXT,                  -- 取り込み元でのid
+    text TEXT NOT NULL,
+    kana TEXT NOT NULL,
+    text_hash BLOB NOT NULL UNIQUE,  -- 重複を除くためのtextのハッシュ
+    weight REAL NOT NULL DEFAULT 1.0
+);
+CREATE INDEX IF NOT EXISTS prompts_source ON prompts(source);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    digest TEXT NOT NULL             -- 取り込んだときのファイルの内容のハッシュ
+);
+"""
+
+
+@dataclass(frozen=True)
+class Prompt:
+    id: int
+    text: str
+    kana: str
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def _build_alias(weights) -> tuple[array, array]:
+    # 重み付きの抽選をO(1)で行うための別名表(Walker / Vose)
+    n = len(weights)
+    prob = array("d", bytes(8 * n))
+    alias = array("i", bytes(4 * n))
+    total = sum(weights)
+    if n == 0 or total <= 0:
+        return array("d", [1.0] * n), alias
+    scaled = [w * n / total for w in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        (small if scaled[l] < 1.0 else large).append(l)
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+class PromptStore:
+    # お題の保存先(SQLite)
+    # 本文は必要になったときに1件ずつ引き、メモリにはidと重み(と抽選用の表)だけを持つ
+    def __init__(self, path: str = DEFAULT_DB_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._random = random.Random()
+        self._ids = array("q")
+        self._prob = array("d")
+        self._alias = array("i")
+        self.reload_index()
+
+    def close(self):
+        self._conn.close()
+
+    # ---- 索引 ----
+
+    def reload_index(self):
+        # idと重みを読み直して抽選用の表を作り直す
+        ids = array("q")
+        weights = array("d")
+        for prompt_id, weight in self._conn.execute("SELECT id, weight FROM prompts ORDER BY id"):
+            ids.append(prompt_id)
+            weights.append(weight)
+        self._ids = ids
+        self._prob, self._alias = _build_alias(weights)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get(self, prompt_id: int) -> Optional[Prompt]:
+        row = self._conn.execute("SELECT id, text, kana FROM prompts WHERE id = ?", (prompt_id,)).fetchone()
+        return Prompt(*row) if row is not None else None
+
+    def at(self, index: int) -> Optional[Prompt]:
+        # index番目(id順)のお題
+        if not 0 <= index < len(self._ids):
+            return None
+        return self.get(self._ids[index])
+
+    def first(self) -> Optional[Prompt]:
+        return self.at(0)
+
+    def random(self) -> Optional[Prompt]:
+        # 一様に1件選ぶ
+        if not self._ids:
+            return None
+        return self.at(self._random.randrange(len(self._ids)))
+
+    def sample(self, exclude: Optional[int] = None) -> Optional[Prompt]:
+        # 重みに比例して1件選ぶ。excludeのidは(他に候補があれば)選ばない
+        n = len(self._ids)
+        if n == 0:
+            return None
+        for _ in range(8):
+            i = self._random.randrange(n)
+            if self._random.random() >= self._prob[i]:
+                i = self._alias[i]
+            if n == 1 or self._ids[i] != exclude:
+                break
+        return self.get(self._ids[i])
+
+    def set_seed(self, seed):
+        self._random.seed(seed)
+
+    # ---- 追加 ----
+
+    def add_many(self, source: str, rows: Iterable[tuple[Optional[str], str, str]], batch_size: int = 1000) -> int:
+        # (source_id, text, kana)の並びを追加する。同じtextのお題は上書きする。索引は呼び出し側で読み直す
+        added = 0
+        batch = []
+        for source_id, text, kana in rows:
+            batch.append((source, source_id, text, kana, text_hash(text)))
+            if len(batch) >= batch_size:
+                added += self._insert(batch)
+                batch = []
+        if batch:
+            added += self._insert(batch)
+        return added
+
+    def _insert(self, batch: list) -> int:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO prompts (source, source_id, text, kana, text_hash) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(text_hash) DO UPDATE SET kana = excluded.kana, source = excluded.source,"
+                " source_id = excluded.source_id", batch)
+        return len(batch)
+
+    def text_hashes(self) -> set[bytes]:
+        # 取り込み済みのお題のtextのハッシュ(一括取り込みでの重複除去用)
+        return {row[0] for row in self._conn.execute("SELECT text_hash FROM prompts")}
+
+    def source_digest(self, path: str) -> Optional[str]:
+        row = self._conn.execute("SELECT digest FROM sources WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_source_digest(self, path: str, digest: str):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sources (path, digest) VALUES (?, ?)",
+                               (os.path.abspath(path), digest))
+
+    def sync_json(self, path: str = DEFAULT_PROMPT_PATH) -> bool:
+        # 同梱のお題ファイル(JSONの配列)を取り込む。内容が前回と同じなら何もしない
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return False
+        digest = hashlib.sha1(data).hexdigest()
+        if self.source_digest(path) == digest:
+            return False
+        try:
+            prompts = json.loads(data.decode("utf-8"))
+        except ValueError as e:  # JSONDecodeError, UnicodeDecodeError
+            print(f"お題ファイルを読み込めませんでした: {e}", file=sys.stderr)
+            return False
+        if not isinstance(prompts, list):
+            print("お題ファイルがJSONの配列ではありません", file=sys.stderr)
+            return False
+        # kanaの無いお題は打ち切れないので取り込まない(打てないかなは表示するときに入力方式ごとに除く)
+        rows = [(str(p.get("id")) if p.get("id") is not None else None, str(p["text"]), str(p["kana"]))
+                for p in prompts if isinstance(p, dict) and p.get("text") and p.get("kana")]
+        source = os.path.basename(path)
+        self.add_many(source, rows)
+        # ファイルから消えたお題は取り除く
+        keep = {text_hash(text) for _, text, _ in rows}
+        stale = [(row[0],) for row in self._conn.execute("SELECT text_hash FROM prompts WHERE source = ?", (source,))
+                 if row[0] not in keep]
+        with self._conn:
+            self._conn.executemany("DELETE FROM prompts WHERE text_hash = ?", stale)
+        self.set_source_digest(path, digest)
+        self.reload_index()
+        return True
@@ -0,0 +1,301 @@
+import math
+
+from PyQt6.QtWidgets import QWidget, QSizePolicy
+from PyQt6.QtCore import Qt, QSize, QPointF, QRect, QRectF, QEvent
+from PyQt6.QtGui import QPainter, QPalette, QColor, QTextLayout, QTextCharFormat
+
+import tracing
+
+# お題の表示行数(現在の行と次の行だけ見えればよい)
+VISIBLE_LINES = 2
+
+# 1行分のグループの中の段
+TRACK_TEXT = 0     # 漢字仮名交じり文
+TRACK_KANA = 1     # かな
+TRACK_STROKES = 2  # 入力打鍵列
+TRACK_COUNT = 3
+
+_MARGIN = 4
+# 流れる文字モードで入力位置を固定する横位置(幅に対する割合)
+_EYE_RATIO = 0.3
+# 改行しないレイアウトにするための十分大きい行幅
+_UNBOUNDED_WIDTH = 1.0e7
+
+
+class _Track:
+    # 1段分の文字列とそのレイアウト、入力状態
+    # レイアウトは文字列が変わったときだけ作り直し、状態が変わっても描き直すのはその範囲だけにする
+    __slots__ = ("text", "layout", "line", "confirmed", "error", "offset")
+
+    def __init__(self):
+        self.text = ""
+        self.layout = None
+        self.line = None
+        self.confirmed = 0  # [0, confirmed) は確定済み(薄い色)
+        self.error = 0      # [confirmed, error) は誤り(赤)
+        self.offset = 0     # 流れる文字モードでの横方向のずれ
+
+    def relayout(self, text: str, font):
+        self.text = text
+        if not text:
+            self.layout = None
+            self.line = None
+            return
+        layout = QTextLayout(text, font)
+        layout.setCacheEnabled(True)
+        layout.beginLayout()
+        line = layout.createLine()
+        line.setLineWidth(_UNBOUNDED_WIDTH)
+        layout.endLayout()
+        self.layout = layout
+        self.line = line
+
+    def x_of(self, index: int) -> float:
+        if self.line is None:
+            return 0.0
+        return self.line.cursorToX(max(0, min(index, len(self.text))))[0]
+
+    def width(self) -> float:
+        return self.line.naturalTextWidth() if self.line is not None else 0.0
+
+
+class PromptView(QWidget):
+    # お題の text / kana / 入力打鍵列 を自前で描くウィジェット
+    # 見えている行(VISIBLE_LINES)ごとに段のレイアウトを持ち、文字ごとの状態
+    # (確定済みは薄く、未入力は通常、誤りは赤)を描き分ける。流れる文字モードでは
+    # 入力位置が常に同じ横位置に来るよう、お題全体を1行にして左へ送る
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._slots = [[_Track() for _ in range(TRACK_COUNT)] for _ in range(VISIBLE_LINES)]
+        self._flow = [_Track() for _ in range(TRACK_COUNT)]
+        self._track_visible = [True, True, True]
+        self._line_mode = True
+        self._flow_mode = False
+        self._faded_format = QTextCharFormat()
+        self._error_format = QTextCharFormat()
+        self._update_formats()
+        # 背景は自分で塗るので親の描画を待たない
+        self.setAttribute(Qt.WidgetAttribute.WA_OpaquePaintEvent)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
+
+    # ---- 設定 ----
+
+    def set_conversion(self, enabled: bool):
+        # 変換ありではtextだけ表示する(入力はpreedit欄で行う)
+        visible = [True, not enabled, not enabled]
+        if visible != self._track_visible:
+            self._track_visible = visible
+            self._geometry_changed()
+
+    def set_modes(self, line_mode: bool, flow_mode: bool):
+        # 改行表示と流れる文字表示。どちらか一方は必ずON、両方ONでもよい
+        if not line_mode and not flow_mode:
+            line_mode = True
+        if (line_mode, flow_mode) != (self._line_mode, self._flow_mode):
+            self._line_mode = line_mode
+            self._flow_mode = flow_mode
+            for track in self._flow:
+                track.offset = self._flow_offset(track)
+            self._geometry_changed()
+
+    @property
+    def line_mode(self) -> bool:
+        return self._line_mode
+
+    @property
+    def flow_mode(self) -> bool:
+        return self._flow_mode
+
+    # ---- 内容と状態 ----
+
+    def set_line(self, slot: int, track: int, text: str, confirmed: int = 0, error: int = 0):
+        # 表示行slotの段trackの内容と状態を設定する
+        target = self._slots[slot][track]
+        if text != target.text:
+            target.relayout(text, self.font())
+            target.confirmed, target.error = confirmed, error
+            if self._line_mode and self._track_visible[track]:
+                self.update(self._band_rect(self._line_band(slot, track)))
+            return
+        self._set_state(target, self._line_band(slot, track) if self._line_mode else None, 0, confirmed, error)
+
+    def set_flow(self, track: int, text: str, confirmed: int = 0, error: int = 0):
+        # 流れる文字モードの段trackの内容(お題全体)と状態を設定する
+        target = self._flow[track]
+        if text != target.text:
+            target.relayout(text, self.font())
+            target.confirmed, target.error = confirmed, error
+            target.offset = self._flow_offset(target)
+            if self._flow_mode and self._track_visible[track]:
+                self.update(self._band_rect(self._flow_band(track)))
+            return
+        band = self._flow_band(track) if self._flow_mode else None
+        offset = self._flow_offset(target, confirmed)
+        if offset != target.offset:
+            dx = offset - target.offset
+            target.offset = offset
+            if band is not None and self._track_visible[track]:
+                # 描画済みの画素をずらし、新しく見える部分と状態の変わった範囲だけ描き直す
+                self.scroll(dx, 0, self._band_rect(band))
+        self._set_state(target, band, target.offset, confirmed, error)
+
+    def _set_state(self, target: _Track, band, offset: int, confirmed: int, error: int):
+        old_confirmed, old_error = target.confirmed, target.error
+        if (old_confirmed, old_error) == (confirmed, error):
+            return
+        target.confirmed, target.error = confirmed, error
+        if band is None:
+            return
+        # 状態が変わり得るのは [min(確定位置), max(確定位置, 誤りの終わり)) の範囲だけ
+        lo = min(old_confirmed, confirmed)
+        hi = max(old_confirmed, confirmed, old_error, error)
+        if lo >= hi:
+            return
+        x0 = _MARGIN + offset + target.x_of(lo)
+        x1 = _MARGIN + offset + target.x_of(hi)
+        rect = self._band_rect(band)
+        left = math.floor(x0) - 1
+        self.update(QRect(left, rect.top(), math.ceil(x1) + 1 - left, rect.height()))
+
+    # ---- 配置 ----
+
+    def _row_height(self) -> int:
+        return self.fontMetrics().height() + 4
+
+    def _visible_tracks(self) -> list[int]:
+        return [track for track in range(TRACK_COUNT) if self._track_visible[track]]
+
+    def _flow_band(self, track: int):
+        # 流れる文字の段は上にまとめて置く
+        if not self._track_visible[track]:
+            return None
+        return self._visible_tracks().index(track)
+
+    def _line_band(self, slot: int, track: int):
+        if not self._track_visible[track]:
+            return None
+        tracks = self._visible_tracks()
+        base = len(tracks) if self._flow_mode else 0
+        return base + slot * len(tracks) + tracks.index(track)
+
+    def _band_rect(self, band) -> QRect:
+        if band is None:
+            return QRect()
+        height = self._row_height()
+        return QRect(0, band * height, self.width(), height)
+
+    def _flow_offset(self, track: _Track, confirmed: int | None = None) -> int:
+        if confirmed is None:
+            confirmed = track.confirmed
+        eye = int(max(0, self.width() - 2 * _MARGIN) * _EYE_RATIO)
+        return eye - int(round(track.x_of(confirmed)))
+
+    def _geometry_changed(self):
+        self.updateGeometry()
+        self.update()
+
+    def sizeHint(self) -> QSize:
+        widths = [track.width() for slot in self._slots for track in slot]
+        width = int(max(widths, default=0)) + 2 * _MARGIN + 16
+        bands = len(self._visible_tracks()) * ((VISIBLE_LINES if self._line_mode else 0) + (1 if self._flow_mode else 0))
+        return QSize(max(100, width), bands * self._row_height())
+
+    def minimumSizeHint(self) -> QSize:
+        return QSize(100, self.sizeHint().height())
+
+    # ---- 描画 ----
+
+    def _update_formats(self):
+        faded = QColor(self.palette().color(QPalette.ColorRole.WindowText))
+        faded.setAlphaF(0.35)
+        self._faded_format.setForeground(faded)
+        self._error_format.setForeground(QColor(208, 48, 48))
+
+    def _selections(self, track: _Track) -> list:
+        selections = []
+        confirmed = min(track.confirmed, len(track.text))
+        if confirmed > 0:
+            faded = QTextLayout.FormatRange()
+            faded.start, faded.length, faded.format = 0, confirmed, self._faded_format
+            selections.append(faded)
+        error = min(track.error, len(track.text))
+        if error > confirmed:
+            wrong = QTextLayout.FormatRange()
+            wrong.start, wrong.length, wrong.format = confirmed, error - confirmed, self._error_format
+            selections.append(wrong)
+        return selections
+
+    @tracing.traced("PromptView.paint", "render")
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        clip = event.rect()
+        painter.fillRect(clip, self.palette().color(QPalette.ColorRole.Window))
+        painter.setPen(self.palette().color(QPalette.ColorRole.WindowText))
+        pad = 2
+        if self._flow_mode:
+            for index, track in enumerate(self._flow):
+                self._draw_track(painter, clip, track, self._flow_band(index), track.offset, pad)
+        if self._line_mode:
+            for slot, tracks in enumerate(self._slots):
+                for index, track in enumerate(tracks):
+                    self._draw_track(painter, clip, track, self._line_band(slot, index), 0, pad)
+        painter.end()
+
+    def _draw_track(self, painter, clip: QRect, track: _Track, band, offset: int, pad: int):
+        if band is None or track.layout is None:
+            return
+        rect = self._band_rect(band)
+        if not rect.intersects(clip):
+            return
+        track.layout.draw(painter, QPointF(_MARGIN + offset, rect.top() + pad),
+                          self._selections(track), QRectF(clip.intersected(rect)))
+
+    def changeEvent(self, event):
+        kind = event.type()
+        if kind == QEvent.Type.FontChange:
+            # フォントが変わったら各段のレイアウトを作り直す
+            for tracks in self._slots + [self._flow]:
+                for track in tracks:
+                    track.relayout(track.text, self.font())
+            for track in self._flow:
+                track.offset = self._flow_offset(track)
+            self._geometry_changed()
+        elif kind == QEvent.Type.PaletteChange:
+            self._update_formats()
+            self.update()
+        super().changeEvent(event)
+
+    def resizeEvent(self, event):
+        for track in self._flow:
+            track.offset = self._flow_offset(track)
+        super().resizeEvent(event)
+
+
+class KeyGuide(QWidget):
+    # キーガイド(次に打つキー)。打鍵ごとに変わるので、QLabelのように
+    # 中身が変わるたびにレイアウトを組み直させず、描き直すだけにする
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._text = ""
+        self.setSizePolicy(QSizePolicy.Policy.Fixed, QSizePolicy.Policy.Preferred)
+
+    def set_text(self, text: str):
+        if text != self._text:
+            self._text = text
+            self.update()
+
+    def text(self) -> str:
+        return self._text
+
+    def sizeHint(self) -> QSize:
+        metrics = self.fontMetrics()
+        return QSize(metrics.horizontalAdvance("次: W W") + 2 * _MARGIN, metrics.height())
+
+    def paintEvent(self, event):
+        if not self._text:
+            return
+        painter = QPainter(self)
+        painter.setPen(self.palette().color(QPalette.ColorRole.WindowText))
+        painter.drawText(self.rect().adjusted(_MARGIN, 0, 0, 0),
+                         int(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter), self._text)
+        painter.end()
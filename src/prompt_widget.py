@@ -1,15 +1,67 @@
-import json
+import time
+from bisect import bisect_right
+from typing import TYPE_CHECKING
 from PyQt6.QtWidgets import (
     QWidget, QLabel, QVBoxLayout, QHBoxLayout, QSizePolicy, 
     QPushButton, QComboBox, QTimeEdit, QLineEdit
 )
-from PyQt6.QtCore import Qt, QSize, QTime
+from PyQt6.QtCore import Qt, QSize, QTime, QEvent
 from PyQt6.QtGui import QKeySequence, QShortcut
-from timer import TimerController
+from timer import TimerController, NS_PER_SECOND
+from composer import EMITTED, MISSED, ComposerTable
+from matcher import KANJI_DIRECT, ROMAJI, Matcher, create_matcher
+from prompt_view import KeyGuide, PromptView, VISIBLE_LINES, TRACK_TEXT, TRACK_KANA, TRACK_STROKES
+from utils.kana_align import align_text_kana, text_progress
+from event_log import EventLog, Events, KEY, EMIT, MISTAKE, PROMPT, remove_spool
+from continuous import PreRoll, RateDetector
+from pace_graph import PaceGraph
+from conversion import ConversionDiff, LineEditDiffer
+from line_breaker import REFERENCE_CHAR, advance_cache, break_lines
+from scoring import ScoreKeeper
+import tracing
+
+# 記録・お題・集計(sqlite3などを読み込む)は窓を出した後に読み込むので、ここでは型だけ
+if TYPE_CHECKING:
+    from analytics import SessionAnalysis
+    from prompt_store import Prompt, PromptStore
+    from storage import SessionStore
+    from weakness import WeaknessTracker
+
+# お題とお題の間に打つスペース(表記上は_)
+SEPARATOR_KANA = " "
+SEPARATOR_TEXT = "_"
+# 打ち切れないお題を引いたときに選び直す回数
+PROMPT_ATTEMPTS = 20
+
 
 class PromptWidget(QWidget):
-    def __init__(self, prompt_path: str | None = None, parent=None):
+    def __init__(self, prompts: "PromptStore | None" = None, rule_table: ComposerTable | None = None,
+                 store: "SessionStore | None" = None, weakness: "WeaknessTracker | None" = None, parent=None):
         super().__init__(parent)
+        # 苦手お題の集計と、苦手お題だけを出すモード
+        self._weakness = weakness
+        self._weak_mode = False
+        # お題の保存先と、表示中のお題のid(とその前にスペースを打たせるか)
+        self._prompts = prompts
+        self._prompt_id = None
+        self._prompt_separator = False
+        # 連続打鍵モード: 計測中でなくても打て、打ち続けていれば途中から計測が始まる
+        self._continuous = False
+        self._detector = RateDetector()
+        self._preroll = PreRoll()
+        # リプレイ中(打鍵は計測にもプレロールにも入れない)と、リプレイの後に戻す入力方式・変換の有無
+        self._replaying = False
+        self._replay_restore: tuple[str, bool] | None = None
+        # お題を打ち終えたら次のお題へ進む(リプレイ中はリプレイに従う)
+        self._auto_advance = True
+        # 計測記録の保存先
+        self._store = store
+        # 入力ルール表(コンパイル済み)と、入力方式ごとの照合(作ったものは切り替えても取っておく)
+        self._rule_table = rule_table
+        self._matchers: dict[str, Matcher] = {}
+        # (入力方式, お題のid) -> 打ち切れるか
+        self._typable_cache: dict[tuple[str, int], bool] = {}
+        self._matcher = self._matcher_for(ROMAJI) if rule_table is not None else None
         # 計測開始ボタン
         self.start_button = QPushButton("開始[s]")
         self.start_button.clicked.connect(self.on_start_clicked)
@@ -29,9 +81,16 @@ class PromptWidget(QWidget):
         self.duration_selector.setCurrentIndex(0)
 
         # タイマー残り時間表示ラベル
-        self.time_label = QLabel("00:01:00")
+        self.time_label = QLabel("00:01:00.00")
         self.time_label.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
 
+        # スコア表示(タイマーの右)
+        self.score_label = QLabel("")
+        self.score_label.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
+
+        # キーガイド(次に打つ2キー。入力打鍵列を出せる方式だけ)
+        self.key_guide = KeyGuide()
+
         # カスタム入力用の時間エディット
         self.time_edit = QTimeEdit()
         self.time_edit.setDisplayFormat("hh:mm:ss")
@@ -55,6 +114,8 @@ class PromptWidget(QWidget):
         timer_top = QHBoxLayout()
         timer_top.addWidget(self.start_button)
         timer_top.addWidget(self.time_label)
+        timer_top.addWidget(self.score_label)
+        timer_top.addWidget(self.key_guide)
         timer_top.addWidget(self.duration_selector)
         timer_top.addWidget(self.time_edit)
         timer_top.addStretch()
@@ -65,24 +126,63 @@ class PromptWidget(QWidget):
         # layout.addWidget(self.kana_label)
         # layout.addWidget(self.preedit_label)
 
-        # お題はここに行グループを追加していく(text, (kana,) preeditのグループを縦に積む)
+        # お題の表示(text, kana, 入力打鍵列を自前で描く)と、変換ありモードのpreedit入力欄
         self.content_layout = QVBoxLayout()
         # 行間を埋める
         self.content_layout.setSpacing(0)
         self.content_layout.setContentsMargins(0, 0, 0, 0)
+        self.view = PromptView()
+        self.content_layout.addWidget(self.view)
+        self.preedit_edit = QLineEdit("")
+        self.preedit_edit.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
+        self.preedit_edit.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
+        # 変換ありモードの照合(入力欄への編集ごとに入力中の行と比べる)
+        self._conversion = LineEditDiffer(self.preedit_edit, ConversionDiff(), self._on_conversion_changed)
+        self.content_layout.addWidget(self.preedit_edit)
         layout.addLayout(self.content_layout)
         self.setLayout(layout)
 
         self._conversion_enabled = False
 
-        # 行長のデフォルト
+        # 行長のデフォルト(全角の文字数。改行は表示したときの幅で決める)
         self._line_length = 25
+        # 今のフォントでの文字ごとの送り幅
+        self._advances = advance_cache(self.font())
 
         # 最後に表示した元テキスト(再描画用)
         self._last_text = None
         self._last_kana = None
-        # 最後に入力したpreeditのリスト(行ごと)
-        self._last_preedits = []
+        # 行ごとの (textの開始, textの終了, kanaの開始, kanaの終了)
+        self._line_bounds = []
+        self._kana_line_starts = []
+        # textの各文字の境界がkanaのどこに当たるか
+        self._text_bounds = [0]
+        # 変換ありモードで入力中の行
+        self._conversion_line = 0
+
+        # 変換なしモードの入力状態
+        self._kana_pos = 0        # 確定したかなの数
+        self._typed_keys = ""     # 受理した打鍵列
+        self._typed_starts = []   # 確定したかなごとの、打鍵列上の開始位置
+        self._step_start = 0      # 未確定のかなの打鍵が始まる位置
+        self._miss_count = 0
+        # ミスしてから次に確定するまではその位置を赤く表示する
+        self._miss_pending = False
+        # 打鍵イベントの記録(書き出しは別スレッド)と、直前の計測で記録したイベント
+        self._events = EventLog()
+        self.last_events = Events()
+        # 直前の計測の解析(計測を終えるまではNone)
+        self.last_analysis: "SessionAnalysis | None" = None
+        self._session_started_at = 0.0
+        # 計測モードと入力方式・変換の有無(計測を始めるときに決める)
+        self._session_mode = ""
+        self._session_method = ROMAJI
+        self._session_conversion = False
+        # スコア(打鍵ごとに更新)
+        self._score = ScoreKeeper()
+        # 打鍵中の速さのグラフ(配置は親が決める。お題の横に置く)
+        self.pace_graph = PaceGraph()
+        self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
 
         # 子が希望サイズを持つようにポリシーを設定
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Preferred)
@@ -95,12 +195,15 @@ class PromptWidget(QWidget):
         # 内部状態
         self._initial_seconds = 60 # デフォルト1分
         self._update_time_display_from_selection()
+        self._update_score_label()
+        self._apply_row_style()
 
         # シグナル接続
         self.duration_selector.currentIndexChanged.connect(self._on_duration_changed)
 
-        if prompt_path:
-            self.load_and_show_first(prompt_path)
+        if prompts is not None:
+            self.show_next_prompt()
+        self._update_ready()
 
     def _on_duration_changed(self, index: int):
         # 0: 1分, 1: 1時間, 2: カスタム
@@ -121,65 +224,96 @@ class PromptWidget(QWidget):
             # ラベルに反映
             self._set_time_label_from_seconds(self._initial_seconds)
 
+    def _selected_seconds(self) -> int | None:
+        # 開始秒数を決定する
+        if self.duration_selector.currentText() == "カスタム":
+            # time_editの値を使う
+            time = self.time_edit.time()
+            seconds = time.hour() * 3600 + time.minute() * 60 + time.second()
+            if seconds <= 0:
+                tracing.instant("custom duration <= 0", "ui")
+                return None
+            return seconds
+        return self._initial_seconds
+
     def on_start_clicked(self):
         # 押したら開始、実行中に押すと停止
         if not self._timer.is_running():
-            # 開始秒数を決定する
-            if self.duration_selector.currentText() == "カスタム":
-                # time_editの値を使う
-                time = self.time_edit.time()
-                seconds = time.hour() * 3600 + time.minute() * 60 + time.second()
-                if seconds <= 0:
-                    print("カスタム時間が0秒以下のため計測を開始できません")
-                    return
-            else:
-                seconds = self._initial_seconds
-            print(f"Start button clicked -> start {seconds}s timer")
+            seconds = self._selected_seconds()
+            if seconds is None:
+                return
+            tracing.instant("start button", "ui", {"seconds": seconds})
             # 実行中はセレクタとtime_editを無効化
             self.duration_selector.setEnabled(False)
             self.time_edit.setEnabled(False)
             self._timer.start(seconds)
+            self._begin_typing()
             self.start_button.setText("停止[Esc]")
         else:
-            print("Start button clicked -> stop timer")
+            tracing.instant("stop button", "ui")
             self._timer.stop()
             self._on_timer_finished()
 
     def on_s_pressed(self):
-        print(f"s key pressed -> start timer")
         if not hasattr(self, "_timer") or not self._timer.is_running():
-            if self.duration_selector.currentText() == "カスタム":
-                time = self.time_edit.time()
-                seconds = time.hour() * 3600 + time.minute() * 60 + time.second()
-                if seconds <= 0:
-                    print("カスタム時間が0秒以下のため計測を開始できません")
-                    return
-            else:
-                seconds = self._initial_seconds
-            print(f"Start (shortcut) -> start {seconds}s timer")
+            seconds = self._selected_seconds()
+            if seconds is None:
+                return
+            tracing.instant("start shortcut", "ui", {"seconds": seconds})
             self.duration_selector.setEnabled(False)
             self.time_edit.setEnabled(False)
             self._timer.start(seconds)
+            self._begin_typing()
             self.start_button.setText("停止[Esc]")
-        else:
-            print("s pressed (no-op): timer already running")
     
     def on_escape_pressed(self):
         if hasattr(self, "_timer") and self._timer.is_running():
-            print("Escape key pressed -> stop timer")
+            tracing.instant("stop shortcut", "ui")
             self._timer.stop()
             self._on_timer_finished()
-        else:
-            print("Escape pressed (no-op): timer not running")
 
-    # TimeContollerから呼ばれるコールバック(残り秒数を受け取る)
-    def _on_timer_tick_callback(self, remaining: int):
-        print(f"timer tick: remaining={remaining}")
-        self._set_time_label_from_seconds(remaining)
+    # TimeContollerから呼ばれるコールバック(残りナノ秒を受け取る)
+    # 表示の更新間隔で呼ばれるので、ここでは出力しない
+    @tracing.traced("timer tick", "timer")
+    def _on_timer_tick_callback(self, remaining_ns: int):
+        self._set_time_label_from_ns(remaining_ns)
+        # 連続打鍵モードでは手を止めたら最後の打鍵の時刻で計測を終える
+        if (self._continuous and self._events.recording
+                and self._detector.is_idle(time.perf_counter_ns())):
+            self._timer.stop()
+            self._on_timer_finished(self._detector.last_ns)
+            return
+        # 目標との差は経過時間で按分するので時間とともに変わる
+        if self._score.target:
+            self._update_score_label()
 
     # タイマー終了時コールバック
-    def _on_timer_finished(self):
-        print("timer finished or stopped")
+    def _on_timer_finished(self, end_ns: int | None = None):
+        tracing.instant("timer finished", "ui")
+        if self._events.recording:
+            if end_ns is None:
+                end_ns = time.perf_counter_ns()
+            end_ns = min(end_ns, self._timer.deadline_ns)
+            self.last_events = self._events.stop(end_ns, self._kana_pos)
+            from analytics import analyze
+            from storage import SessionRecord
+            with tracing.span("analyze", "storage"):
+                self.last_analysis = analyze(self.last_events)
+            # 書き出し先のファイルは記録を保存し終えたら要らない
+            spool = self._events.spool_path
+            if self._store is not None:
+                self._store.submit(SessionRecord.from_events(self.last_events, self._session_mode,
+                                                             self._session_started_at, self.last_analysis,
+                                                             self._session_prompts(),
+                                                             self._session_method, self._session_conversion),
+                                   lambda record: remove_spool(spool))
+            else:
+                remove_spool(spool)
+        if self._continuous:
+            # 次の計測はここからまた打ち続けてから
+            self._detector.reset()
+            self._preroll.clear((self._prompt_id, int(self._prompt_separator)))
+        self._update_ready()
         self.start_button.setText("開始[s]")
         # セレクタとtime_editを有効化
         self.duration_selector.setEnabled(True)
@@ -192,10 +326,27 @@ class PromptWidget(QWidget):
         self._set_time_label_from_seconds(self._initial_seconds)
 
     def _set_time_label_from_seconds(self, seconds: int):
+        self._set_time_label_from_ns(seconds * NS_PER_SECOND)
+
+    def _set_time_label_from_ns(self, ns: int):
+        # 1/100秒まで表示する。残り時間なので切り上げて、0.00は締め切りちょうどにだけ出す
+        centis = -(-ns // (NS_PER_SECOND // 100))
+        seconds, centis = divmod(centis, 100)
         hours = seconds // 3600
         minutes = (seconds % 3600) // 60
         seconds = seconds % 60
-        self.time_label.setText(f"{hours:02}:{minutes:02}:{seconds:02}")
+        text = f"{hours:02}:{minutes:02}:{seconds:02}.{centis:02}"
+        # 同じ表示なら再描画しない
+        if self.time_label.text() != text:
+            self.time_label.setText(text)
+
+    def _update_score_label(self):
+        score = self._score
+        text = f"スコア {score.score}  L{score.level}"
+        if score.target:
+            text += f"  目標差 {score.target_delta(self._timer.elapsed_ns()):+d}"
+        if self.score_label.text() != text:
+            self.score_label.setText(text)
 
     def _update_time_display_from_selection(self):
         index = self.duration_selector.currentIndex()
@@ -215,132 +366,478 @@ class PromptWidget(QWidget):
     
     @conversion_enabled.setter
     def conversion_enabled(self, v: bool):
-        print(f"PromptWidget: set conversion_enabled to {v}")
-        self._conversion_enabled = bool(v)
-        # kana_labelの表示/非表示はcontent_layoutの再描画で制御する
-        if getattr(self, "_last_text", None) is not None:
-            # 再描画してkanaの行を反映
-            self.set_prompt(self._last_text or "", self._last_kana or "")
-        else:
-            # ウィジェット全体を再計算
-            self.updateGeometry()
-            top = self.window()
-            if top is not None:
-                top.adjustSize()
+        tracing.instant("conversion", "ui", {"enabled": bool(v)})
+        if bool(v) != self._conversion_enabled:
+            # 打鍵での位置と変換での位置は持ち方が違うので、お題の最初から打ち直す
+            self._conversion_enabled = bool(v)
+            self._reset_typing()
+        # 行は作り直さず、各行の表示内容だけ切り替える
+        self._apply_row_style()
+        self._refresh_rows()
+        self._adjust_window()
+
+    @property
+    def line_mode(self) -> bool:
+        return self.view.line_mode
+
+    @line_mode.setter
+    def line_mode(self, v: bool):
+        self.view.set_modes(bool(v), self.view.flow_mode)
+        self._refresh_rows()
+        self._adjust_window()
+
+    @property
+    def flow_mode(self) -> bool:
+        return self.view.flow_mode
+
+    @flow_mode.setter
+    def flow_mode(self, v: bool):
+        # 流れる文字モード。改行表示とどちらか一方は必ずON
+        self.view.set_modes(self.view.line_mode, bool(v))
+        self._refresh_rows()
+        self._adjust_window()
+
+    @property
+    def weak_mode(self) -> bool:
+        return self._weak_mode
+
+    @weak_mode.setter
+    def weak_mode(self, v: bool):
+        # 苦手お題モード。次のお題から反映する(計測中でなければすぐ入れ替える)
+        self._weak_mode = bool(v)
+        if not self._timer.is_running() and self._prompts is not None:
+            self.show_next_prompt()
+
+    @property
+    def weak_threshold(self) -> float:
+        return self._weakness.threshold if self._weakness is not None else 0.0
+
+    @weak_threshold.setter
+    def weak_threshold(self, v: float):
+        if self._weakness is not None:
+            self._weakness.set_threshold(float(v))
+
+    @property
+    def continuous_mode(self) -> bool:
+        return self._continuous
+
+    @continuous_mode.setter
+    def continuous_mode(self, v: bool):
+        self._continuous = bool(v)
+        self._detector.reset()
+        self._preroll.clear((self._prompt_id, int(self._prompt_separator)))
+        # 連続打鍵モードではsも入力に回す
+        if not self._timer.is_running():
+            self._update_ready()
+            if self._continuous and not self._conversion_enabled:
+                self.setFocus()
+
+    # ---- 起動時に遅れて読み込むもの ----
+
+    @property
+    def ready(self) -> bool:
+        # ルール表とお題がそろって計測を始められるか
+        return self._matcher is not None and self._prompts is not None
+
+    def _update_ready(self):
+        self.start_button.setEnabled(self.ready)
+        self._shortcut_s.setEnabled(self.ready and not self._continuous)
+
+    def set_rule_table(self, rule_table: ComposerTable):
+        # 作った照合はルール表ごと作り直す
+        method = self.input_method or ROMAJI
+        self._rule_table = rule_table
+        self._matchers.clear()
+        self._matcher = self._matcher_for(method)
+        if self._last_text is not None:
+            self._matcher.set_target(self._last_text, self._last_kana or "", self._text_bounds)
+        self._reset_typing()
+        self._refresh_rows()
+        self._update_ready()
+
+    def set_prompts(self, prompts: "PromptStore"):
+        self._prompts = prompts
+        self._typable_cache.clear()
+        if not self._timer.is_running():
+            self.show_next_prompt()
+        self._update_ready()
+
+    def set_store(self, store: "SessionStore", weakness: "WeaknessTracker | None" = None):
+        self._store = store
+        self._weakness = weakness
+
+    def _matcher_for(self, method: str) -> Matcher:
+        matcher = self._matchers.get(method)
+        if matcher is None:
+            matcher = self._matchers[method] = create_matcher(method, self._rule_table)
+        return matcher
+
+    @property
+    def input_method(self) -> str:
+        return self._matcher.name if self._matcher is not None else ""
+
+    @input_method.setter
+    def input_method(self, method: str):
+        # 照合だけを差し替える(ウィジェットは作り直さない)。計測中なら計測は終える
+        if self._matcher is not None and self._matcher.name == method:
+            return
+        if self._timer.is_running():
+            self._timer.stop()
+            self._on_timer_finished()
+        self._matcher = self._matcher_for(method)
+        # 漢直はIMEなどから確定した文字を受け取る
+        self.setAttribute(Qt.WidgetAttribute.WA_InputMethodEnabled, method == KANJI_DIRECT)
+        if self._last_text is not None:
+            self._matcher.set_target(self._last_text, self._last_kana or "", self._text_bounds)
+        self._reset_typing()
+        self._refresh_rows()
 
     def set_prompt(self, text: str, kana: str = ""):
+        # 別のお題になったら入力状態を最初からにする
+        if text != self._last_text or kana != self._last_kana:
+            self._text_bounds = align_text_kana(text, kana)
+            if self._matcher is not None:
+                self._matcher.set_target(text, kana, self._text_bounds)
+            self._reset_typing()
         # 最後に表示した値を保存(line_length変更時に再描画するため)
         self._last_text = text
         self._last_kana = kana
-
-        # 既存のpreedit入力内容を収集して保持(再描画後に復元するため)
-        prev_preedits = []
-        for i in range(self.content_layout.count()):
-            item = self.content_layout.itemAt(i)
-            widget = item.widget()
-            if widget:
-                # QLineEditを探す
-                edits = widget.findChildren(QLineEdit)
-                if edits:
-                    prev_preedits.append(edits[0].text())
-                else:
-                    prev_preedits.append("")
-        if prev_preedits:
-            self._last_preedits = prev_preedits
-
-        # 古い行グループを削除
-        while self.content_layout.count():
-            it = self.content_layout.takeAt(0)
-            widget = it.widget()
-            if widget:
-                widget.deleteLater()
-            else:
-                # レイアウトが残っている場合は中身を削除
-                sub = it.layout()
-                if sub:
-                    while sub.count():
-                        it2 = sub.takeAt(0)
-                        widget2 = it2.widget()
-                        if widget2:
-                            widget2.deleteLater()
-            
-        def chunks(s: str, n: int):
-            return [s[i:i+n] for i in range(0, len(s), n)] if s else []
-
-        n = max(1, int(self._line_length))
-        text_chunks = chunks(text, n)
-        kana_chunks = chunks(kana, n)
-        max_chunks = max(1, len(text_chunks), len(kana_chunks))
-
-        # 各チャンクについてグループ(QWidget)を作ってcontent_layoutに追加
-        for i in range(max_chunks):
-            row_widget = QWidget()
-            row_layout = QVBoxLayout(row_widget)
-            # text
-            text = text_chunks[i] if i < len(text_chunks) else ""
-            label_text = QLabel(text)
-            label_text.setWordWrap(False)
-            label_text.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
-            # 高さをコンパクトに固定気味にする
-            label_text.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
-            label_text.setFixedHeight(self.fontMetrics().height() + 4)
-            row_layout.addWidget(label_text)
-
-            # preeditの復元テキスト
-            preedit_text = ""
-            if i < len(self._last_preedits):
-                preedit_text = self._last_preedits[i]
-
-            if bool(self._conversion_enabled):
-                # 変換あり: 編集可能な QLineEdit を追加 (kana は表示しない)
-                preedit_edit = QLineEdit(preedit_text)
-                preedit_edit.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
-                preedit_edit.setEnabled(True)
-                preedit_edit.textChanged.connect(lambda index=i, widget=preedit_edit: self._on_preedit_entered(index, widget.text()))
-                preedit_edit.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
-                preedit_edit.setFixedHeight(self.fontMetrics().height() + 6)
-                row_layout.addWidget(preedit_edit)
-                # 変換ありでは余分な空行 (placeholder) は追加しない
-            else:
-                # 変換なし: text, kana, preedit(表示のみ) の順で表示する
-                kana_chunk = kana_chunks[i] if i < len(kana_chunks) else ""
-                label_kana = QLabel(kana_chunk)
-                label_kana.setWordWrap(False)
-                label_kana.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
-                label_kana.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
-                label_kana.setFixedHeight(self.fontMetrics().height() + 4)
-                row_layout.addWidget(label_kana)
-
-                # preedit は読み取り専用ラベルで復元して表示（空でも高さを確保）
-                placeholder = QLabel(preedit_text)
-                placeholder.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter)
-                if not preedit_text:
-                    placeholder_height = max(8, self.preedit_label.sizeHint().height())
-                    placeholder.setFixedHeight(placeholder_height + 2)
-                else:
-                    placeholder.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Fixed)
-                    placeholder.setFixedHeight(self.fontMetrics().height() + 6)
-                row_layout.addWidget(placeholder)
-
-            # マージン・間隔を詰める（行間の余白をなくす）
-            row_layout.setContentsMargins(0, 0, 0, 0)
-            row_layout.setSpacing(0)
-
-            self.content_layout.addWidget(row_widget)
-        
+        self._layout_lines()
+        self._retarget_conversion()
+        self._refresh_rows()
+        self._adjust_window()
+
+    def _layout_lines(self):
+        # 行の区切り位置だけを計算しておき、表示は見えている行の分だけ行う
+        # 区切りは表示したときの幅で決め、textとkanaは文字の対応で同じ所で区切る
+        text = self._last_text or ""
+        kana = (self._last_kana or "").replace(SEPARATOR_KANA, SEPARATOR_TEXT)
+        advances = self._advances
+        width = max(1, int(self._line_length)) * advances.advance(REFERENCE_CHAR)
+        self._line_bounds = break_lines(advances.prefix(text), advances.prefix(kana), self._text_bounds, width)
+        self._kana_line_starts = [bounds[2] for bounds in self._line_bounds]
+
+    def _apply_row_style(self):
+        # フォントと変換モードに合わせて見た目を整える(表示内容は変えない)
+        self.view.set_conversion(bool(self._conversion_enabled))
+        self.preedit_edit.setFixedHeight(self.fontMetrics().height() + 6)
+        self.preedit_edit.setVisible(bool(self._conversion_enabled))
+
+    def _adjust_window(self):
         self.updateGeometry()
         top = self.window()
         if top is not None:
             top.adjustSize()
 
-    def _on_preedit_entered(self, index: int, text: str):
-        # インデックスの範囲を拡張してから保存
-        if index < 0:
+    def changeEvent(self, event):
+        if event.type() == QEvent.Type.FontChange:
+            self._apply_row_style()
+            # 文字の幅が変わるので、そのフォントの送り幅の表で改行し直す
+            self._advances = advance_cache(self.font())
+            if self._last_text is not None:
+                line_bounds = self._line_bounds
+                self._layout_lines()
+                if self._line_bounds != line_bounds:
+                    self._retarget_conversion()
+                self._refresh_rows()
+        super().changeEvent(event)
+
+    def _current_line(self) -> int:
+        if self._conversion_enabled:
+            return min(self._conversion_line, max(0, len(self._line_bounds) - 1))
+        # 打ち終わった行の末尾ちょうどにいるときは次の行を現在の行とする
+        return max(0, bisect_right(self._kana_line_starts, self._kana_pos) - 1)
+
+    def _reset_typing(self):
+        self._kana_pos = 0
+        self._typed_keys = ""
+        self._typed_starts = []
+        self._step_start = 0
+        self._miss_count = 0
+        self._miss_pending = False
+        self._conversion_line = 0
+        if self._matcher is not None:
+            self._matcher.reset()
+        self._retarget_conversion()
+
+    def _begin_typing(self):
+        # 計測中はEsc以外のキーをすべて入力に回す
+        self._reset_typing()
+        self._begin_session(self._kana_pos, self._prompt_id, self._prompt_separator)
+        self._refresh_rows()
+        if self._conversion_enabled:
+            self.preedit_edit.setFocus()
+        else:
+            self.setFocus()
+
+    def _begin_session(self, kana_pos: int, prompt_id: int | None, separator: bool):
+        # 計測の記録を始める(時刻はタイマーの開始時刻。さかのぼって始めるときは過去になる)
+        start_ns = self._timer.start_ns
+        self._shortcut_s.setEnabled(False)
+        self._session_started_at = time.time() - (time.perf_counter_ns() - start_ns) / NS_PER_SECOND
+        from storage import MODE_1MIN, MODE_1HOUR, MODE_CUSTOM
+        self._session_mode = {"1分": MODE_1MIN, "1時間": MODE_1HOUR}.get(self.duration_selector.currentText(), MODE_CUSTOM)
+        self._session_method = self.input_method
+        self._session_conversion = bool(self._conversion_enabled)
+        self._events.start(start_ns, kana_pos)
+        if prompt_id is not None:
+            self._events.record(PROMPT, int(separator), prompt_id, start_ns)
+        self._score.reset()
+        # 目標はこのモード・入力方式・変換の有無での自己ベスト
+        best = (self._store.best_session(self._session_mode, self._session_method, self._session_conversion)
+                if self._store is not None else None)
+        self._score.set_target(best.score if best is not None else 0, best.duration_ns if best is not None else 0)
+        self._update_score_label()
+        if best is not None:
+            self.pace_graph.start(best.laps, best.duration_ns)
+        else:
+            self.pace_graph.start()
+
+    def _begin_continuous_session(self):
+        # 打ち続けている途中から計測を始める。直近の打鍵の最初(変換器が何も保留していない打鍵)まで
+        # さかのぼり、その時刻を開始時刻にしてそこからのイベントを計測に入れ直す
+        point = self._preroll.start_point(self._detector.burst_start())
+        seconds = self._selected_seconds()
+        if point is None or seconds is None:
+            return
+        position, start_ns, kana_pos, prompt = point
+        tracing.instant("start continuous", "ui", {"seconds": seconds})
+        self.duration_selector.setEnabled(False)
+        self.time_edit.setEnabled(False)
+        self._timer.start(seconds, start_ns)
+        prompt_id, separator = prompt if prompt is not None else (None, 0)
+        self._begin_session(kana_pos, prompt_id, bool(separator))
+        for t_ns, kind, code, index in self._preroll.events_from(position):
+            self._events.record(kind, code, index, t_ns)
+            if kind == EMIT or kind == MISTAKE:
+                self._score.apply(kind, code)
+            if kind == EMIT:
+                self.pace_graph.add_kana(t_ns - start_ns, code)
+        self._preroll.clear()
+        self._update_score_label()
+        self.start_button.setText("停止[Esc]")
+
+    def _record(self, kind: int, code: int = 0, index: int = 0, t_ns: int | None = None, clean: bool = False):
+        # 計測中は計測に、連続打鍵モードで計測していなければプレロールに記録する
+        if self._events.recording:
+            # 締め切りを過ぎた分は計測に含めない(終了の通知が届く前の打鍵)
+            if t_ns is not None and self._past_deadline(t_ns):
+                return
+            self._events.record(kind, code, index, t_ns)
+        elif self._continuous and not self._replaying:
+            self._preroll.record(t_ns if t_ns is not None else time.perf_counter_ns(), kind, code, index, clean)
+
+    def _past_deadline(self, t_ns: int) -> bool:
+        return self._events.recording and not self._replaying and t_ns >= self._timer.deadline_ns
+
+    def _finish_late(self, t_ns: int) -> bool:
+        # 締め切り後、タイマーの終了より先に届いた入力なら計測をここで終えてTrue
+        # (連続打鍵モードでは締め切り後も打鍵を受け付けるので、遅れた打鍵を採点しない)
+        if not self._past_deadline(t_ns):
+            return False
+        self._timer.stop()
+        self._on_timer_finished()
+        return True
+
+    def keyPressEvent(self, event):
+        key = event.text()
+        if ((self._timer.is_running() or self._continuous) and not self._conversion_enabled
+                and self._matcher is not None and key):
+            with tracing.span("key", "input"):
+                self._on_key(key)
+            event.accept()
             return
-        while len(self._last_preedits) <= index:
-            self._last_preedits.append("")
-        self._last_preedits[index] = text
-        print(f"_on_preedit_entered: index={index}, text='{text}'")
+        super().keyPressEvent(event)
+
+    def inputMethodEvent(self, event):
+        # IMEから確定した文字(漢直)は1文字ずつ打鍵として扱う
+        commit = event.commitString()
+        if ((self._timer.is_running() or self._continuous) and not self._conversion_enabled
+                and self._matcher is not None and commit):
+            with tracing.span("ime commit", "input"):
+                for ch in commit:
+                    if not (self._timer.is_running() or self._continuous):
+                        break
+                    self._on_key(ch)
+            event.accept()
+            return
+        super().inputMethodEvent(event)
+
+    def _on_key(self, key: str, refresh: bool = True):
+        t_ns = time.perf_counter_ns()
+        if self._finish_late(t_ns):
+            return
+        code = min(ord(key[0]), 0xFFFF)
+        # 計測していない打鍵はスコアに数えない(連続打鍵モード)
+        scoring = self._events.recording or self._replaying or not self._continuous
+        matcher = self._matcher
+        clean = matcher.clean
+        if self._continuous and not self._replaying:
+            self._detector.feed(t_ns)
+        # お題どおりでないキーはミスとして受理しない(漢直はミスを数えない)
+        result, pos = tracing.call("feed", "composer", matcher.feed, self._kana_pos, key)
+        if result & MISSED:
+            if not matcher.counts_misses:
+                return
+            tracing.counter("mistakes", self._miss_count + 1, "input")
+            self._record(MISTAKE, code, self._kana_pos, t_ns, clean)
+            if scoring:
+                self._score.apply(MISTAKE)
+                self._update_score_label()
+            self._miss_count += 1
+            if not self._miss_pending:
+                self._miss_pending = True
+                if refresh:
+                    self._refresh_rows()
+            self._check_continuous_start()
+            return
+        self._record(KEY, code, self._kana_pos, t_ns, clean)
+        self._typed_keys += key
+        if result & EMITTED:
+            self._record(EMIT, pos - self._kana_pos, pos, t_ns)
+            if scoring:
+                self._score.apply(EMIT, pos - self._kana_pos)
+                self._update_score_label()
+            if self._events.recording:
+                self.pace_graph.add_kana(t_ns - self._timer.start_ns, pos - self._kana_pos)
+            self._miss_pending = False
+            self._typed_starts.extend([self._step_start] * (pos - self._kana_pos))
+            tracing.counter("kana", pos, "input")
+            # 確定後に残った打鍵(kk -> っ + k の k など)は次のかなの打鍵になる
+            self._step_start = len(self._typed_keys) - len(matcher.preedit)
+        self._kana_pos = pos
+        if pos >= len(self._last_kana or "") and self._prompts is not None and self._auto_advance:
+            # 打ち終えたら続けて次のお題へ
+            self.show_next_prompt(separator=True)
+        elif refresh:
+            self._refresh_rows()
+        self._check_continuous_start()
+
+    def _check_continuous_start(self):
+        if (self._continuous and not self._replaying and not self._events.recording
+                and self._detector.ready()):
+            self._begin_continuous_session()
+
+    @tracing.traced("refresh_rows", "render")
+    def _refresh_rows(self):
+        # 見えている行だけを書き換える。お題の長さによらず行数分の処理で済む
+        if not self._line_bounds:
+            return
+        text = self._last_text or ""
+        kana = (self._last_kana or "").replace(SEPARATOR_KANA, SEPARATOR_TEXT)
+        strokes, offset = self._stroke_layout()
+        strokes = strokes.replace(SEPARATOR_KANA, SEPARATOR_TEXT)
+        self.key_guide.set_text(self._key_guide() if strokes else "")
+        text_done, text_error = self._text_state()
+        kana_error = self._kana_pos + 1 if self._miss_pending else self._kana_pos
+        typed = len(self._typed_keys)
+        stroke_error = typed + 1 if self._miss_pending else typed
+
+        def clamp(pos: int, start: int, end: int) -> int:
+            return max(0, min(pos, end) - start)
+
+        view = self.view
+        if view.flow_mode:
+            view.set_flow(TRACK_TEXT, text, text_done, text_error)
+            view.set_flow(TRACK_KANA, kana, self._kana_pos, kana_error)
+            view.set_flow(TRACK_STROKES, strokes, typed, stroke_error)
+        if not view.line_mode:
+            return
+        first = self._current_line()
+        for slot in range(VISIBLE_LINES):
+            line = first + slot
+            if line >= len(self._line_bounds):
+                for track in (TRACK_TEXT, TRACK_KANA, TRACK_STROKES):
+                    view.set_line(slot, track, "")
+                continue
+            text_start, text_end, kana_start, kana_end = self._line_bounds[line]
+            view.set_line(slot, TRACK_TEXT, text[text_start:text_end],
+                          clamp(text_done, text_start, text_end), clamp(text_error, text_start, text_end))
+            view.set_line(slot, TRACK_KANA, kana[kana_start:kana_end],
+                          clamp(self._kana_pos, kana_start, kana_end), clamp(kana_error, kana_start, kana_end))
+            if strokes:
+                stroke_start, stroke_end = offset(kana_start), offset(kana_end)
+                view.set_line(slot, TRACK_STROKES, strokes[stroke_start:stroke_end],
+                              clamp(typed, stroke_start, stroke_end), clamp(stroke_error, stroke_start, stroke_end))
+            else:
+                view.set_line(slot, TRACK_STROKES, "")
+
+    def _text_state(self) -> tuple[int, int]:
+        # textの (確定した文字数, 誤りの終わり)
+        if self._conversion_enabled:
+            # 変換あり: 入力済みの行は確定、入力中の行はpreeditと一致している所まで確定し、
+            # 最初に食い違った所から最後の入力までを誤りとする
+            line = self._current_line()
+            if line >= len(self._line_bounds) or self._last_text is None:
+                return 0, 0
+            text_start = self._line_bounds[line][0]
+            diff = self._conversion.diff
+            return text_start + diff.matched, text_start + diff.error_end
+        done = text_progress(self._text_bounds, self._kana_pos)
+        return done, done + 1 if self._miss_pending else done
+
+    def _stroke_layout(self):
+        # 入力打鍵列 = 打った分 + 現在位置からの最短打鍵列 と、かなの位置 -> 打鍵列上の位置 の対応
+        if self._matcher is None or not self._matcher.plans_strokes or self._conversion_enabled:
+            return "", None
+        plan, starts = self._matcher.plan(self._kana_pos)
+        strokes = self._typed_keys[:self._step_start] + plan
+
+        def offset(k: int) -> int:
+            if k < self._kana_pos:
+                return self._typed_starts[k]
+            if k - self._kana_pos < len(starts):
+                return self._step_start + starts[k - self._kana_pos]
+            return len(strokes)
+
+        return strokes, offset
+
+    def _key_guide(self) -> str:
+        # 次に打つキー(別表記を選べば以降もそれに合わせた計画になる)。空白キーは見える記号にする
+        keys = self._matcher.next_keys(self._kana_pos)
+        if not keys:
+            return ""
+        return "次: " + " ".join("␣" if key == " " else key for key in keys)
+
+    def _retarget_conversion(self):
+        # 変換ありモードで入力中の行をお題のその行と比べるようにする(入力欄は空にする)
+        if not self._line_bounds or self._last_text is None:
+            self._conversion.reset("")
+            return
+        line = min(self._conversion_line, len(self._line_bounds) - 1)
+        text_start, text_end, _, _ = self._line_bounds[line]
+        self._conversion.reset(self._last_text[text_start:text_end])
+
+    @tracing.traced("conversion changed", "input")
+    def _on_conversion_changed(self, diff: ConversionDiff):
+        # 入力欄が変わった: 行の終わりまで一致したら次の行へ送り、textの一致した所までをかなに直して進める
+        if not self._line_bounds or self._last_text is None:
+            return
+        line = min(self._conversion_line, len(self._line_bounds) - 1)
+        done = self._line_bounds[line][0] + diff.matched
+        last_line = line >= len(self._line_bounds) - 1
+        kana_done = self._text_bounds[min(done, len(self._text_bounds) - 1)]
+        if kana_done > self._kana_pos:
+            # 確定したかな数は一番進んだ所で数える(消して打ち直しても二重には数えない)
+            t_ns = time.perf_counter_ns()
+            if self._finish_late(t_ns):
+                return
+            count = kana_done - self._kana_pos
+            self._record(EMIT, count, kana_done, t_ns)
+            if self._events.recording:
+                self._score.apply(EMIT, count)
+                self._update_score_label()
+                self.pace_graph.add_kana(t_ns - self._timer.start_ns, count)
+            self._kana_pos = kana_done
+        if diff.complete:
+            if not last_line:
+                self._conversion_line += 1
+                self._retarget_conversion()
+            elif self._prompts is not None and self._auto_advance:
+                # 打ち終えたら続けて次のお題へ(入力欄で打つので区切りのスペースは入れない)
+                self.show_next_prompt()
+                return
+        self._refresh_rows()
 
     @property
     def line_length(self) -> int:
@@ -365,43 +862,136 @@ class PromptWidget(QWidget):
     def set_preedit(self, preedit: str):
         self.preedit_label.setText(preedit)
 
-    def load_and_show_first(self, prompt_path: str):
-        try:
-            with open(prompt_path, "r", encoding="utf-8") as file:
-                prompt = json.load(file)
-            if isinstance(prompt, list) and prompt:
-                first = prompt[0]
-                
-                text = first.get("text", "")
-                kana = first.get("kana", "")
-                self.set_prompt(text, kana)
-        except Exception:
+    @tracing.traced("next prompt", "input")
+    def show_next_prompt(self, separator: bool = False):
+        # 次のお題をランダムに選んで表示する。separatorならお題の間のスペース(表記上は_)から打たせる
+        prompt = None
+        for _ in range(PROMPT_ATTEMPTS):
+            prompt = self._pick_prompt()
+            if prompt is None or self._typable(prompt):
+                break
+            prompt = None
+        if prompt is None:
+            self._prompt_id = None
             self.set_prompt("お題読み込み失敗", "")
+            return
+        self.show_prompt(prompt, separator)
+
+    def _pick_prompt(self) -> "Prompt | None":
+        prompt = None
+        if self._weak_mode and self._weakness is not None and self._prompts is not None:
+            # 苦手お題が無ければ普通に選ぶ
+            prompt_id = self._weakness.sample_prompt(exclude=self._prompt_id)
+            prompt = self._prompts.get(prompt_id) if prompt_id is not None else None
+        if prompt is None and self._prompts is not None:
+            prompt = self._prompts.sample(exclude=self._prompt_id)
+        return prompt
+
+    def _typable(self, prompt: "Prompt") -> bool:
+        # 今の入力方式で打ち切れないお題(kanaが空、ルールに無い文字を含むなど)は出さない
+        if self._matcher is None:
+            return bool(prompt.kana)
+        key = (self._matcher.name, prompt.id)
+        typable = self._typable_cache.get(key)
+        if typable is None:
+            typable = self._typable_cache[key] = self._matcher.typable(prompt.text, prompt.kana)
+        return typable
+
+    def show_prompt(self, prompt: "Prompt", separator: bool = False):
+        self._prompt_id = prompt.id
+        self._prompt_separator = separator
+        self._record(PROMPT, int(separator), prompt.id)
+        # 同じお題が続いても最初から打たせる
+        self._reset_typing()
+        if separator:
+            self.set_prompt(SEPARATOR_TEXT + prompt.text, SEPARATOR_KANA + prompt.kana)
+        else:
+            self.set_prompt(prompt.text, prompt.kana)
+
+    def _session_prompts(self) -> "list[Prompt]":
+        # 直前の計測で打ったお題(リプレイに入れる)
+        if self._prompts is None:
+            return []
+        ids = dict.fromkeys(index for kind, index in zip(self.last_events.kind, self.last_events.index)
+                            if kind == PROMPT)
+        return [prompt for prompt in map(self._prompts.get, ids) if prompt is not None]
+
+    # ---- リプレイ ----
+
+    def begin_replay(self, kana_count: int = 0, mistakes: int = 0, input_method: str | None = None,
+                     conversion: bool | None = None):
+        # ReplayPlayerから打鍵を流し込む。お題の切り替えもリプレイに従う
+        # 入力方式と変換の有無は計測したときのものにする(end_replayで戻す)
+        if self._timer.is_running():
+            self._timer.stop()
+            self._on_timer_finished()
+        if not self._replaying:
+            self._replay_restore = (self.input_method, bool(self._conversion_enabled))
+        self._auto_advance = False
+        self._replaying = True
+        if input_method is not None and self._rule_table is not None:
+            self.input_method = input_method
+        if conversion is not None and conversion != self._conversion_enabled:
+            self.conversion_enabled = conversion
+        self._reset_typing()
+        self._score.restore(kana_count, mistakes)
+        self._score.set_target(0)
+        self._update_score_label()
+
+    def end_replay(self):
+        self._auto_advance = True
+        self._replaying = False
+        if self._replay_restore is not None:
+            method, conversion = self._replay_restore
+            self._replay_restore = None
+            if method:
+                self.input_method = method
+            if conversion != self._conversion_enabled:
+                self.conversion_enabled = conversion
+        self._reset_typing()
+        self._refresh_rows()
+
+    def skip_to(self, kana_pos: int):
+        # お題の途中から始めた計測のリプレイ用: kana_posまでを打ち終えた状態にする
+        # (計測は変換器が何も保留していない打鍵から始まるので、保留の無い状態でよい)
+        self._reset_typing()
+        kana_pos = max(0, min(kana_pos, len(self._last_kana or "")))
+        if self._matcher is not None and kana_pos:
+            keys, starts = self._matcher.plan_from_start()
+            self._typed_keys = keys[:starts[kana_pos]] if kana_pos < len(starts) else keys
+            self._typed_starts = list(starts[:kana_pos]) + [0] * max(0, kana_pos - len(starts))
+            self._step_start = len(self._typed_keys)
+            self._matcher.seek(kana_pos)
+        self._kana_pos = kana_pos
+        if self._conversion_enabled:
+            self._show_conversion_progress()
+
+    def replay_emit(self, count: int, kana_pos: int):
+        # 変換ありの計測のリプレイ用: 確定したかな(EMIT)をそのまま反映する
+        self._score.apply(EMIT, count)
+        self._update_score_label()
+        self._kana_pos = max(0, min(kana_pos, len(self._last_kana or "")))
+        self._show_conversion_progress()
+
+    def _show_conversion_progress(self):
+        # 変換あり: かなの位置を含む行を入力中の行にし、入力欄にはその行の打ち終えた所までを入れる
+        if not self._line_bounds or self._last_text is None:
+            return
+        done = text_progress(self._text_bounds, self._kana_pos)
+        line = max(0, bisect_right([bounds[0] for bounds in self._line_bounds], done) - 1)
+        if line != self._conversion_line:
+            self._conversion_line = line
+            self._retarget_conversion()
+        self._conversion.show_text(self._last_text[self._line_bounds[line][0]:done])
+
+    def set_replay_time(self, t_ns: int, duration_ns: int):
+        self._set_time_label_from_ns(max(0, duration_ns - t_ns))
 
     def sizeHint(self) -> QSize:
-        # content_layoutに行がある場合はその行のテキストを使って幅を計算
-        sample_text = ""
-        if self.content_layout.count() > 0:
-            it = self.content_layout.itemAt(0)
-            widget = it.widget()
-            if widget:
-                # その行の最初のQLabelを探す
-                first_label = None
-                for child in widget.findChildren(QLabel):
-                    first_label = child
-                    break
-                if first_label is not None:
-                    sample_text = first_label.text() or ""
-        else:
-            # fallback: テンプレートラベル(空)を利用
-            sample_text = self.text_label.text() or ""
-        
-        fontMetrics = self.fontMetrics()
-        width = fontMetrics.horizontalAdvance(sample_text) + 20  # 余白分を追加
-        # 高さは各ラベルの高さの合計
-        height = (self.start_button.sizeHint().height()
-                  + self.text_label.sizeHint().height()
-                  + self.kana_label.sizeHint().height()
-                  + self.preedit_label.sizeHint().height())
+        # 幅はお題の表示に合わせる
+        width = self.view.sizeHint().width() + 20  # 余白分を追加
+        # 高さはボタン行、お題表示、(変換ありなら)preedit欄の合計
+        height = self.start_button.sizeHint().height() + self.view.sizeHint().height()
+        if self._conversion_enabled:
+            height += self.preedit_edit.sizeHint().height()
         return QSize(max(100, width), height)
-    
\ No newline at end of file
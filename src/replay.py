@@ -0,0 +1,304 @@
+import struct
+import time
+import zlib
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from PyQt6.QtCore import QObject, QTimer, Qt
+
+from event_log import EMIT, END, KEY, MISTAKE, PROMPT, START, Events
+from matcher import ROMAJI
+from prompt_store import Prompt
+from timer import display_refresh_interval_ms
+
+# リプレイのバイナリ形式
+#
+#   ヘッダ: magic, version, flags, イベント数, キーフレーム数, お題数, 長さ(ns), 本体の長さ,
+#           入力方式(ASCII, 16バイト。version 1には無く、ローマ字とする)
+#   キーフレーム表 (キーフレーム数件): 時刻, イベント番号, 本体での位置, その時点の確定かな数, ミス数
+#   お題表 (お題数件): id, textの長さ, kanaの長さ, text, kana (UTF-8)
+#   本体: イベントごとに 前のイベントからの経過ns(varint), 種類(1バイト), code(varint),
+#         前のイベントからのindexの差(zigzag varint)。flagsにFLAG_ZLIBがあればzlibで圧縮する
+#   flagsにFLAG_CONVERSIONがあれば変換ありの計測(打鍵は無く、確定したかな(EMIT)だけが並ぶ)
+#
+# キーフレームはお題の切り替わり(PROMPT)ごとに置く。シークはその時刻以前の最後のキーフレームから
+# そのお題の打鍵だけを入れ直せばよいので、セッションの長さによらず一瞬で済む。
+# キーフレームのイベントはindexの差を0からにしてあり、時刻はキーフレーム表の値を使う
+
+MAGIC = b"ATWP"
+VERSION = 2
+FLAG_ZLIB = 1
+FLAG_CONVERSION = 2
+
+_HEADER = struct.Struct("<4sHHIIIqI")
+_METHOD = struct.Struct("<16s")
+_KEYFRAME = struct.Struct("<qIIII")
+_PROMPT = struct.Struct("<qII")
+
+
+@dataclass(frozen=True)
+class Keyframe:
+    t_ns: int
+    event: int       # イベント番号
+    offset: int      # 本体(展開後)での位置
+    kana_count: int  # この時点までに確定したかなの数
+    mistakes: int
+
+
+def _put_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def encode(events: Events, prompts: Iterable[Prompt] = (), compress: bool = True,
+           input_method: str = ROMAJI, conversion: bool = False) -> bytes:
+    body = bytearray()
+    keyframes = []
+    t0 = events.t_ns[0] if len(events) else 0
+    prev_t = t0
+    prev_index = 0
+    kana_count = mistakes = 0
+    for number, (t_ns, kind, code, index) in enumerate(events):
+        if kind == PROMPT or number == 0:
+            keyframes.append(_KEYFRAME.pack(t_ns - t0, number, len(body), kana_count, mistakes))
+            prev_index = 0
+        _put_varint(body, max(0, t_ns - prev_t))
+        body.append(kind)
+        _put_varint(body, code)
+        _put_varint(body, _zigzag(index - prev_index))
+        prev_t, prev_index = t_ns, index
+        if kind == EMIT:
+            kana_count += code
+        elif kind == MISTAKE:
+            mistakes += 1
+    duration = events.t_ns[-1] - t0 if len(events) else 0
+
+    prompt_table = bytearray()
+    prompt_count = 0
+    for prompt in prompts:
+        text = prompt.text.encode("utf-8")
+        kana = prompt.kana.encode("utf-8")
+        prompt_table += _PROMPT.pack(prompt.id, len(text), len(kana)) + text + kana
+        prompt_count += 1
+
+    flags = (FLAG_ZLIB if compress else 0) | (FLAG_CONVERSION if conversion else 0)
+    payload = zlib.compress(bytes(body)) if compress else bytes(body)
+    header = _HEADER.pack(MAGIC, VERSION, flags, len(events), len(keyframes), prompt_count, duration, len(body))
+    header += _METHOD.pack(input_method.encode("ascii"))
+    return header + b"".join(keyframes) + bytes(prompt_table) + payload
+
+
+class Replay:
+    # デコード済みのリプレイ。本体は展開だけしておき、イベントは読む位置から順に取り出す
+    def __init__(self, body: bytes, keyframes: list[Keyframe], prompts: dict[int, Prompt],
+                 event_count: int, duration_ns: int, input_method: str = ROMAJI, conversion: bool = False):
+        self.body = body
+        self.keyframes = keyframes
+        self.prompts = prompts
+        self.event_count = event_count
+        self.duration_ns = duration_ns
+        # 計測したときの入力方式と変換の有無(再生はこれに合わせる)
+        self.input_method = input_method
+        self.conversion = conversion
+        self._keyframe_times = [keyframe.t_ns for keyframe in keyframes]
+
+    @classmethod
+    def decode(cls, data: bytes) -> "Replay":
+        magic, version, flags, event_count, keyframe_count, prompt_count, duration, body_size = \
+            _HEADER.unpack_from(data, 0)
+        if magic != MAGIC or not 1 <= version <= VERSION:
+            raise ValueError("リプレイの形式が違います")
+        pos = _HEADER.size
+        input_method = ROMAJI
+        if version >= 2:
+            input_method = _METHOD.unpack_from(data, pos)[0].rstrip(b"\0").decode("ascii") or ROMAJI
+            pos += _METHOD.size
+        keyframes = []
+        for _ in range(keyframe_count):
+            keyframes.append(Keyframe(*_KEYFRAME.unpack_from(data, pos)))
+            pos += _KEYFRAME.size
+        prompts = {}
+        for _ in range(prompt_count):
+            prompt_id, text_size, kana_size = _PROMPT.unpack_from(data, pos)
+            pos += _PROMPT.size
+            text = data[pos:pos + text_size].decode("utf-8")
+            pos += text_size
+            kana = data[pos:pos + kana_size].decode("utf-8")
+            pos += kana_size
+            prompts[prompt_id] = Prompt(prompt_id, text, kana)
+        body = data[pos:]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        if len(body) != body_size:
+            raise ValueError("リプレイが壊れています")
+        return cls(bytes(body), keyframes, prompts, event_count, duration, input_method,
+                   bool(flags & FLAG_CONVERSION))
+
+    def keyframe_at(self, t_ns: int) -> int:
+        # t_ns以前の最後のキーフレームの番号
+        return max(0, bisect_right(self._keyframe_times, t_ns) - 1)
+
+    def iter_from(self, keyframe: int = 0) -> Iterator[tuple[int, int, int, int]]:
+        # キーフレームから (時刻, 種類, code, index) を順に取り出す
+        if not self.keyframes:
+            return
+        start = self.keyframes[keyframe]
+        body = self.body
+        pos = start.offset
+        end = len(body)
+        t_ns = start.t_ns
+        index = 0
+        first = True
+        while pos < end:
+            value = shift = 0
+            while True:
+                byte = body[pos]
+                pos += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            dt = value
+            kind = body[pos]
+            pos += 1
+            value = shift = 0
+            while True:
+                byte = body[pos]
+                pos += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            code = value
+            value = shift = 0
+            while True:
+                byte = body[pos]
+                pos += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            if kind == PROMPT:
+                index = 0
+            index += _unzigzag(value)
+            if first:
+                first = False
+            else:
+                t_ns += dt
+            yield t_ns, kind, code, index
+
+    def to_events(self) -> Events:
+        events = Events()
+        for record in self.iter_from(0):
+            events.append(*record)
+        return events
+
+
+class ReplayPlayer(QObject):
+    # リプレイをPromptWidgetに流して再生する(表示は計測中と同じ経路で行う)
+    # 再生速度は自由に変えられ、シークはキーフレームからそのお題の分だけを入れ直す
+    # 入力方式と変換の有無はリプレイ(計測したとき)に合わせる(end_replayで元に戻る)
+    def __init__(self, widget, replay: Replay, parent=None):
+        super().__init__(parent)
+        self.widget = widget
+        self.replay = replay
+        self._speed = 1.0
+        self._position = 0
+        self._events: Optional[Iterator] = None
+        self._pending: Optional[tuple[int, int, int, int]] = None
+        # お題の途中から始まった計測(連続打鍵モード)の開始位置
+        self._start_index = 0
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._timer.setInterval(display_refresh_interval_ms())
+        self._timer.timeout.connect(self._on_timeout)
+        self._last_ns = 0
+        self.seek(0)
+
+    @property
+    def speed(self) -> float:
+        return self._speed
+
+    def set_speed(self, speed: float):
+        self._speed = max(0.0, float(speed))
+
+    @property
+    def position_ns(self) -> int:
+        return self._position
+
+    def is_playing(self) -> bool:
+        return self._timer.isActive()
+
+    def play(self):
+        if self._position >= self.replay.duration_ns:
+            self.seek(0)
+        self._last_ns = time.perf_counter_ns()
+        self._timer.start()
+
+    def pause(self):
+        self._timer.stop()
+
+    def seek(self, t_ns: int):
+        # t_nsの時点の表示にする
+        t_ns = max(0, min(t_ns, self.replay.duration_ns))
+        keyframe_index = self.replay.keyframe_at(t_ns)
+        keyframe = self.replay.keyframes[keyframe_index] if self.replay.keyframes else None
+        self.widget.begin_replay(keyframe.kana_count if keyframe else 0, keyframe.mistakes if keyframe else 0,
+                                 self.replay.input_method, self.replay.conversion)
+        self._events = self.replay.iter_from(keyframe_index)
+        self._pending = None
+        self._start_index = 0
+        self._position = keyframe.t_ns if keyframe else 0
+        self.advance_to(t_ns)
+
+    def advance_to(self, t_ns: int):
+        # t_nsまでのイベントを反映して1回だけ描き直す
+        widget = self.widget
+        while True:
+            if self._pending is None:
+                self._pending = next(self._events, None)
+                if self._pending is None:
+                    break
+            event_t, kind, code, index = self._pending
+            if event_t > t_ns:
+                break
+            self._pending = None
+            if kind == KEY or kind == MISTAKE:
+                widget._on_key(chr(code), refresh=False)
+            elif kind == PROMPT:
+                prompt = self.replay.prompts.get(index)
+                if prompt is not None:
+                    widget.show_prompt(prompt, separator=bool(code))
+                    if self._start_index:
+                        widget.skip_to(self._start_index)
+                self._start_index = 0
+            elif kind == START:
+                self._start_index = index
+            elif kind == EMIT:
+                # 打鍵のある計測では打鍵から再現されるので何もしない。変換ありの計測は確定したかなをそのまま入れる
+                if self.replay.conversion:
+                    widget.replay_emit(code, index)
+            elif kind == END:
+                t_ns = event_t
+        self._position = t_ns
+        widget.set_replay_time(t_ns, self.replay.duration_ns)
+        widget._refresh_rows()
+
+    def _on_timeout(self):
+        now = time.perf_counter_ns()
+        elapsed = now - self._last_ns
+        self._last_ns = now
+        self.advance_to(self._position + int(elapsed * self._speed))
+        if self._position >= self.replay.duration_ns:
+            self.pause()
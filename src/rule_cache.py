@@ -0,0 +1,148 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Optional
+
+from composer import COLUMNS, DEFAULT_RULES_PATH, KEY_BASE, ComposerTable, parse_rules
+
+# コンパイル済みルール表のバイナリキャッシュ
+#
+# レイアウト(すべてネイティブのバイト順、各セクションは4バイト境界):
+#   ヘッダ: magic, version, バイト順マーカー, KEY_BASE, COLUMNS, 状態数, 確定内容数, 元テーブルのsha256
+#   next_state (i32 x 状態数*COLUMNS)
+#   emit_ids   (i32 x 状態数*COLUMNS)
+#   results    (u8  x 状態数*COLUMNS)
+#   emit_back  (i32 x 確定内容数)
+#   文字列表 x3 (emit_text, state_input, state_preview): オフセット(i32 x 件数+1) + UTF-8
+# 遷移表はmmapしたままmemoryviewで引くので、読み込み時にパースもコピーもしない
+
+MAGIC = b"ATWR"
+VERSION = 1
+_BYTE_ORDER = 0x01020304
+_HEADER = struct.Struct("=4sIIIIII32s")
+
+DEFAULT_CACHE_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "cache", "rules"))
+
+
+def source_digest(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+def cache_path_for(source_path: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    # 同名の別テーブルと衝突しないよう元ファイルの絶対パスのハッシュも付ける
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    tag = hashlib.sha1(os.path.abspath(source_path).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(cache_dir, f"{name}.{tag}.bin")
+
+
+def _align(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def _pack_strings(strings: list[str]) -> bytes:
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = array("i", [0])
+    total = 0
+    for b in encoded:
+        total += len(b)
+        offsets.append(total)
+    blob = b"".join(encoded)
+    return offsets.tobytes() + blob + b"\0" * (_align(len(blob)) - len(blob))
+
+
+def _section(buf, pos: int, size: int):
+    # 途中で切れた・壊れたキャッシュでは、セクションがファイルの外にはみ出す
+    if size < 0 or pos + size > len(buf):
+        raise ValueError(f"キャッシュのセクションがファイルの外にあります: {pos}+{size} > {len(buf)}")
+    return buf[pos:pos + size]
+
+
+def _unpack_strings(buf, pos: int, count: int) -> tuple[list[str], int]:
+    offsets = _section(buf, pos, 4 * (count + 1)).cast("i")
+    pos += 4 * (count + 1)
+    if offsets[0] != 0 or any(offsets[i] > offsets[i + 1] for i in range(count)):
+        raise ValueError("キャッシュの文字列表のオフセットが壊れています")
+    blob = bytes(_section(buf, pos, offsets[count]))
+    strings = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)]
+    return strings, pos + _align(offsets[count])
+
+
+def save_table(table: ComposerTable, path: str, digest: bytes) -> None:
+    states = table.state_count
+    emits = len(table.emit_text)
+    results = bytes(table.results)
+    parts = [
+        _HEADER.pack(MAGIC, VERSION, _BYTE_ORDER, KEY_BASE, COLUMNS, states, emits, digest),
+        array("i", table.next_state).tobytes(),
+        array("i", table.emit_ids).tobytes(),
+        results + b"\0" * (_align(len(results)) - len(results)),
+        array("i", table.emit_back).tobytes(),
+        _pack_strings(table.emit_text),
+        _pack_strings(table.state_input),
+        _pack_strings(table.state_preview),
+    ]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # 書きかけのファイルを読まれないように一時ファイルから置き換える
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        for part in parts:
+            file.write(part)
+    os.replace(tmp_path, path)
+
+
+def load_table(path: str, digest: Optional[bytes] = None) -> Optional[ComposerTable]:
+    # キャッシュを開いてComposerTableを返す。無い・壊れている・digestが違う場合はNone
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        buf = memoryview(mapped)
+        if len(buf) < _HEADER.size:
+            return None
+        magic, version, order, key_base, columns, states, emits, stored = _HEADER.unpack_from(buf, 0)
+        if (magic != MAGIC or version != VERSION or order != _BYTE_ORDER
+                or key_base != KEY_BASE or columns != COLUMNS):
+            return None
+        if digest is not None and stored != digest:
+            return None
+        size = states * columns
+        pos = _HEADER.size
+        next_state = _section(buf, pos, 4 * size).cast("i")
+        pos += 4 * size
+        emit_ids = _section(buf, pos, 4 * size).cast("i")
+        pos += 4 * size
+        results = _section(buf, pos, size)
+        pos += _align(size)
+        emit_back = _section(buf, pos, 4 * emits).cast("i")
+        pos += 4 * emits
+        emit_text, pos = _unpack_strings(buf, pos, emits)
+        state_input, pos = _unpack_strings(buf, pos, states)
+        state_preview, pos = _unpack_strings(buf, pos, states)
+        if pos > len(buf) or len(emit_ids) != size:
+            return None
+    except (struct.error, TypeError, ValueError, IndexError, UnicodeDecodeError):
+        return None
+    return ComposerTable(next_state, emit_ids, results, emit_text, emit_back, state_input, state_preview)
+
+
+def load_cached(source_path: str = DEFAULT_RULES_PATH, cache_dir: str = DEFAULT_CACHE_DIR) -> ComposerTable:
+    # 元テーブルのハッシュが一致するキャッシュがあればそれを使い、無ければコンパイルして保存する
+    with open(source_path, "rb") as file:
+        data = file.read()
+    digest = source_digest(data)
+    path = cache_path_for(source_path, cache_dir)
+    table = load_table(path, digest)
+    if table is not None:
+        return table
+    table = ComposerTable.from_rules(parse_rules(source_path, data.decode("utf-8")))
+    try:
+        save_table(table, path, digest)
+    except OSError as e:
+        # 書き込めなくてもコンパイル済みの表はそのまま使える
+        print(f"ルール表のキャッシュを保存できませんでした: {e}", file=sys.stderr)
+    return table
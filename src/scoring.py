@@ -0,0 +1,121 @@
+import math
+from typing import Optional
+
+from event_log import EMIT, MISTAKE, START, Events
+
+# 等級 L = floor((raw / S0) ^ p)
+S0 = 50
+P = 1.6
+
+
+def raw_score(kana_count: int, mistakes: int) -> int:
+    # 基本スコア = 確定かな数 - ミス数(下限0)
+    return max(0, kana_count - mistakes)
+
+
+def level_of(raw: int, s0: float = S0, p: float = P) -> int:
+    if raw <= 0:
+        return 0
+    return math.floor((raw / s0) ** p)
+
+
+def level_threshold(level: int, s0: float = S0, p: float = P) -> int:
+    # 等級levelに届く最小のraw
+    raw = max(0, math.ceil(s0 * level ** (1 / p)))
+    # 浮動小数の誤差で境界がずれないようにlevel_ofで確かめる
+    while raw > 0 and level_of(raw - 1, s0, p) >= level:
+        raw -= 1
+    while level_of(raw, s0, p) < level:
+        raw += 1
+    return raw
+
+
+class ScoreKeeper:
+    # スコアと等級をイベントごとに更新する
+    # 計測中(打鍵ごと)もリプレイや保存済みの記録からの再計算も同じapplyを通すので結果は必ず一致する
+    def __init__(self, s0: float = S0, p: float = P):
+        self.s0 = s0
+        self.p = p
+        self._target = 0
+        self._target_duration_ns = 0
+        self.reset()
+
+    def reset(self):
+        self.kana_count = 0
+        self.mistakes = 0
+        self._score = 0
+        self._level = 0
+        # 現在の等級の範囲 [_floor, _next_threshold)
+        self._floor = 0
+        self._next_threshold = level_threshold(1, self.s0, self.p)
+
+    def restore(self, kana_count: int, mistakes: int):
+        # 途中の状態から始める(リプレイのシーク用)
+        self.reset()
+        self.kana_count = kana_count
+        self.mistakes = mistakes
+        self._update()
+
+    def apply(self, kind: int, code: int = 0):
+        # event_logのイベント1件を反映する
+        if kind == EMIT:
+            self.kana_count += code
+        elif kind == MISTAKE:
+            self.mistakes += 1
+        elif kind == START:
+            self.reset()
+            return
+        else:
+            return
+        self._update()
+
+    def _update(self):
+        score = raw_score(self.kana_count, self.mistakes)
+        if score == self._score:
+            return
+        self._score = score
+        # 等級の境界をまたいだときだけ計算し直す
+        if score >= self._next_threshold or score < self._floor:
+            self._level = level_of(score, self.s0, self.p)
+            self._floor = level_threshold(self._level, self.s0, self.p)
+            self._next_threshold = level_threshold(self._level + 1, self.s0, self.p)
+
+    @property
+    def score(self) -> int:
+        return self._score
+
+    @property
+    def level(self) -> int:
+        return self._level
+
+    @property
+    def next_level_score(self) -> int:
+        # 次の等級に必要なスコア
+        return self._next_threshold
+
+    # ---- 目標スコア ----
+
+    def set_target(self, score: int, duration_ns: int = 0):
+        # 目標(自己ベストなど)。duration_nsを渡すと経過時間に応じた按分と比べる
+        self._target = max(0, score)
+        self._target_duration_ns = max(0, duration_ns)
+
+    @property
+    def target(self) -> int:
+        return self._target
+
+    def target_delta(self, elapsed_ns: Optional[int] = None) -> int:
+        # 目標との差(正なら目標より上)
+        target = self._target
+        if elapsed_ns is not None and self._target_duration_ns:
+            target = target * min(elapsed_ns, self._target_duration_ns) // self._target_duration_ns
+        return self._score - target
+
+
+def score_events(events: Events, s0: float = S0, p: float = P) -> ScoreKeeper:
+    # 保存済みのイベント列からスコアを計算し直す
+    keeper = ScoreKeeper(s0, p)
+    apply = keeper.apply
+    for kind, code in zip(events.kind, events.code):
+        apply(kind, code)
+    return keeper
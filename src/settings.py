@@ -44,6 +44,24 @@ class SettingsWindow(QWidget):
         line_length_apply_button.clicked.connect(self.on_line_length_apply)
         layout.addWidget(line_length_apply_button)
 
+        # 苦手お題のしきい値設定
+        # タイトル
+        self.label = QLabel("苦手お題のしきい値(スコア1点あたりのms)")
+        layout.addWidget(self.label)
+        # 現在のしきい値表示
+        self.current_weak_threshold = QLabel(str(self._current_weak_threshold()))
+        layout.addWidget(self.current_weak_threshold)
+        # スピンボックス
+        self.weak_threshold_spin = QSpinBox()
+        self.weak_threshold_spin.setRange(50, 5000)
+        self.weak_threshold_spin.setSingleStep(10)
+        self.weak_threshold_spin.setValue(self._current_weak_threshold())
+        layout.addWidget(self.weak_threshold_spin)
+        # しきい値を変更するのを決定するボタン
+        weak_threshold_apply_button = QPushButton("適用")
+        weak_threshold_apply_button.clicked.connect(self.on_weak_threshold_apply)
+        layout.addWidget(weak_threshold_apply_button)
+
         # 設定ウィンドウを閉じるボタン
         close_button = QPushButton("閉じる")
         close_button.clicked.connect(self.close)
@@ -72,6 +90,27 @@ class SettingsWindow(QWidget):
                     return 20
         return 20
     
+    def _prompt_widgets(self) -> list:
+        # トップレベルウィジェットとその子からPromptWidgetを集める
+        try:
+            from prompt_widget import PromptWidget
+        except Exception:
+            return []
+        widgets = []
+        for widget in QApplication.topLevelWidgets():
+            if isinstance(widget, PromptWidget):
+                widgets.append(widget)
+            else:
+                widgets.extend(widget.findChildren(PromptWidget))
+        return widgets
+
+    def _current_weak_threshold(self) -> int:
+        for widget in self._prompt_widgets():
+            threshold = int(widget.weak_threshold)
+            if threshold > 0:
+                return threshold
+        return 300
+
     def on_font_size_apply(self):
         new_size = int(self.font_size_spin.value())
         # 現在のフォントサイズのラベル更新
@@ -117,4 +156,11 @@ class SettingsWindow(QWidget):
         for widget in QApplication.topLevelWidgets():
             widget.updateGeometry()
             widget.adjustSize()
-            widget.repaint()
\ No newline at end of file
+            widget.repaint()
+
+    def on_weak_threshold_apply(self):
+        new_threshold = int(self.weak_threshold_spin.value())
+        # ラベル更新
+        self.current_weak_threshold.setText(str(new_threshold))
+        for widget in self._prompt_widgets():
+            widget.weak_threshold = new_threshold
@@ -0,0 +1,149 @@
+import sys
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from PyQt6.QtCore import QObject, QEvent, QTimer, pyqtSignal
+
+# 段階的な起動
+#
+# 窓を先に出し、重いもの(フォントの登録、ルール表、お題、記録とその集計)は最初の描画の後に
+# 1段ずつ読み込んでウィジェットに差し込む。段と段の間はイベントループに戻るので、その間も窓は動く。
+# UIスレッドでなくてよいもの(フォントの登録など)は別スレッドで行い、結果だけをUIスレッドで受け取る。
+# StartupProfileは段ごとの所要時間と起動からの経過時間を持ち、--profile-startupのときに出す
+
+
+class StartupProfile:
+    def __init__(self, enabled: bool = False, origin: Optional[float] = None):
+        self.enabled = enabled
+        # 起動の時刻(perf_counter)。省略時は作った時点
+        self.origin = origin if origin is not None else time.perf_counter()
+        self._last = self.origin
+        # (段の名前, 所要ms, 終わった時点の起動からのms)
+        self.phases: list[tuple[str, float, float]] = []
+        # 失敗した段 (段の名前, エラー)
+        self.failures: list[tuple[str, str]] = []
+
+    def mark(self, name: str):
+        # 前のmarkからここまでをnameの段とする
+        now = time.perf_counter()
+        self.add(name, self._last, now)
+        self._last = now
+
+    def add(self, name: str, start: float, end: float):
+        # ほかの段と重なってよい段(別スレッドなど)
+        self.phases.append((name, (end - start) * 1000, (end - self.origin) * 1000))
+
+    def fail(self, name: str, error: BaseException):
+        # 段が失敗した(ほかの段はそのまま続ける)
+        self.failures.append((name, f"{type(error).__name__}: {error}"))
+        print(f"起動時の読み込みに失敗しました({name}): {error}", file=sys.stderr)
+
+    def watch_first_paint(self, widget, callback: Optional[Callable[[], None]] = None):
+        # widgetが最初に描かれた時点を記録し、callback()を呼ぶ
+        profile = self
+
+        class _FirstPaint(QObject):
+            def eventFilter(self, obj, event):
+                if event.type() == QEvent.Type.Paint:
+                    widget.removeEventFilter(self)
+                    profile.mark("first paint")
+                    if callback is not None:
+                        # 描き終えてから
+                        QTimer.singleShot(0, callback)
+                return False
+
+        self._first_paint = _FirstPaint(widget)
+        widget.installEventFilter(self._first_paint)
+
+    def report(self, file=None):
+        if not self.enabled:
+            return
+        file = file or sys.stderr
+        print("startup profile (ms)        spent    at", file=file)
+        for name, spent, at in sorted(self.phases, key=lambda phase: phase[2]):
+            print(f"  {name:24} {spent:8.1f} {at:8.1f}", file=file)
+        for name, error in self.failures:
+            print(f"  {name:24} failed: {error}", file=file)
+
+
+class StagedStartup(QObject):
+    # 登録した段をイベントループに戻りながら順に実行する。すべて終わったらfinishedを出す
+    # 別スレッドの段もstart()まで始めない(窓を先に出す)。失敗した段は飛ばして次へ進む
+    finished = pyqtSignal()
+    _background_done = pyqtSignal(object)
+
+    def __init__(self, profile: StartupProfile, parent=None):
+        super().__init__(parent)
+        self.profile = profile
+        self._phases: deque[tuple[str, Callable[[], None]]] = deque()
+        self._background: list[threading.Thread] = []
+        self._running = 0
+        self._started = False
+        self._done = False
+        self._background_done.connect(self._on_background_done)
+
+    def add(self, name: str, action: Callable[[], None]):
+        # UIスレッドで行う段
+        self._phases.append((name, action))
+
+    def add_background(self, name: str, work: Callable[[], object], done: Callable[[object], None]):
+        # work()を別スレッドで行い、結果をUIスレッドでdone(result)に渡す
+        self._running += 1
+        profile = self.profile
+
+        def run():
+            start = time.perf_counter()
+            try:
+                result = work()
+            except Exception as e:
+                profile.fail(name, e)
+                result = None
+            profile.add(name, start, time.perf_counter())
+            self._background_done.emit((name, done, result))
+
+        thread = threading.Thread(target=run, name=f"startup-{name}", daemon=True)
+        if self._started:
+            thread.start()
+        else:
+            self._background.append(thread)
+
+    def start(self):
+        # 今のイベントを処理し終えてから最初の段へ(2回目以降は何もしない)
+        if self._started or self._done:
+            return
+        self._started = True
+        for thread in self._background:
+            thread.start()
+        self._background.clear()
+        QTimer.singleShot(0, self._next)
+
+    def _next(self):
+        if not self._phases:
+            self._check_finished()
+            return
+        name, action = self._phases.popleft()
+        start = time.perf_counter()
+        try:
+            action()
+        except Exception as e:
+            self.profile.fail(name, e)
+        self.profile.add(name, start, time.perf_counter())
+        QTimer.singleShot(0, self._next)
+
+    def _on_background_done(self, payload):
+        name, done, result = payload
+        if result is not None:
+            try:
+                done(result)
+            except Exception as e:
+                self.profile.fail(name, e)
+        self._running -= 1
+        self._check_finished()
+
+    def _check_finished(self):
+        if self._started and not self._phases and self._running == 0:
+            self._started = False
+            self._done = True
+            self.finished.emit()
@@ -0,0 +1,304 @@
+import contextlib
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from activity import ActivityRollup
+from analytics import SessionAnalysis, analyze
+from event_log import Events
+from matcher import ROMAJI
+from prompt_store import Prompt
+from replay import Replay, encode
+import tracing
+
+DEFAULT_DB_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "data", "records.sqlite3"))
+
+# 計測モード(ランキングは1分/1時間の公式のみ)
+MODE_1MIN = "1min"
+MODE_1HOUR = "1hour"
+MODE_CUSTOM = "custom"
+RANKED_MODES = (MODE_1MIN, MODE_1HOUR)
+
+RANKING_SIZE = 15
+HISTORY_PAGE = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,        -- 開始時刻(UNIX秒)
+    mode TEXT NOT NULL,
+    duration_ns INTEGER NOT NULL,    -- 実際に計測した長さ
+    score INTEGER NOT NULL,
+    mistakes INTEGER NOT NULL,
+    kana_count INTEGER NOT NULL,     -- 確定したかなの数
+    keystrokes INTEGER NOT NULL,     -- 受理した打鍵数
+    laps BLOB NOT NULL,              -- ラップごとの確定かな数(int32の配列)
+    input_method TEXT NOT NULL DEFAULT 'romaji',  -- 入力方式(matcher.METHODS)
+    conversion INTEGER NOT NULL DEFAULT 0         -- 変換ありで打ったか
+);
+CREATE TABLE IF NOT EXISTS session_events (
+    session_id INTEGER PRIMARY KEY REFERENCES sessions(id) ON DELETE CASCADE,
+    events BLOB NOT NULL             -- リプレイ(replay.encode)
+);
+CREATE INDEX IF NOT EXISTS sessions_started_at ON sessions(started_at);
+"""
+
+# 入力方式・変換の有無の列が無かった頃の記録はローマ字・変換なしとする
+_MIGRATIONS = (
+    ("input_method", "ALTER TABLE sessions ADD COLUMN input_method TEXT NOT NULL DEFAULT 'romaji'"),
+    ("conversion", "ALTER TABLE sessions ADD COLUMN conversion INTEGER NOT NULL DEFAULT 0"),
+)
+
+# ランキングは計測モード・入力方式・変換の有無ごと(漢直はミスを数えないので混ぜない)
+_INDEXES = """
+DROP INDEX IF EXISTS sessions_mode_score;
+CREATE INDEX IF NOT EXISTS sessions_ranking ON sessions(mode, input_method, conversion, score DESC, started_at);
+"""
+
+_SUMMARY_COLUMNS = ("id, started_at, mode, duration_ns, score, mistakes, kana_count, keystrokes, laps,"
+                    " input_method, conversion")
+
+
+@dataclass
+class SessionRecord:
+    # 1回の計測の記録
+    started_at: float
+    mode: str
+    duration_ns: int
+    score: int
+    mistakes: int
+    kana_count: int
+    keystrokes: int
+    laps: array = field(default_factory=lambda: array("i"))
+    events: Optional[Events] = None
+    prompts: list[Prompt] = field(default_factory=list)  # リプレイに入れる、打ったお題
+    id: Optional[int] = None
+    input_method: str = ROMAJI
+    conversion: bool = False
+
+    @classmethod
+    def from_events(cls, events: Events, mode: str, started_at: Optional[float] = None,
+                    analysis: Optional[SessionAnalysis] = None, prompts: Iterable[Prompt] = (),
+                    input_method: str = ROMAJI, conversion: bool = False) -> "SessionRecord":
+        # イベント列から集計する(解析済みならそれを使う)
+        if analysis is None:
+            analysis = analyze(events)
+        if started_at is None:
+            started_at = time.time() - analysis.duration_ns / 1e9
+        return cls(started_at, mode, analysis.duration_ns, analysis.score, analysis.mistakes,
+                   analysis.kana_count, analysis.keystrokes, analysis.lap_kana, events, list(prompts),
+                   input_method=input_method, conversion=conversion)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # 書き込みは別スレッド、読み出しはUIスレッドで同時に行えるようにする
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+def _row_to_record(row) -> SessionRecord:
+    laps = array("i")
+    laps.frombytes(row[8])
+    return SessionRecord(row[1], row[2], row[3], row[4], row[5], row[6], row[7], laps, None, [], row[0],
+                         row[9], bool(row[10]))
+
+
+def _migrate(conn: sqlite3.Connection):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+    with conn:
+        for column, statement in _MIGRATIONS:
+            if column not in columns:
+                conn.execute(statement)
+    conn.executescript(_INDEXES)
+
+
+class SessionStore:
+    # 計測記録の保存先(SQLite)
+    # 書き込みはsubmitでキューに積むだけで、専用スレッドが溜まった分を1トランザクションで書く。
+    # 読み出し(ランキング・履歴)は索引だけで済むのでUIスレッドから直接行う
+    def __init__(self, path: str = DEFAULT_DB_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = _connect(path)
+        self._conn.executescript(_SCHEMA)
+        _migrate(self._conn)
+        # 日別・月別の集計(書き込みと同じトランザクションで足す。集計していない記録があればここで足す)
+        self.activity = ActivityRollup(self._conn)
+        # 記録の書き込みと同じトランザクションで集計を更新するもの(on_commit(conn, events, prompts)で表を更新し、
+        # コミットできたらafter_commit()、ロールバックしたらafter_rollback()で手元の集計を揃える)
+        self._observers = []
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="session-store-writer", daemon=True)
+        self._writer.start()
+        self._closed = False
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # UIスレッド用の接続(読み出しと、起動時の集計の読み込み用)
+        return self._conn
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    # ---- 書き込み ----
+
+    def submit(self, record: SessionRecord, callback=None):
+        # 記録を書き込み待ちにする。callback(record)は書き込み後に書き込みスレッドから呼ばれる
+        if self._closed:
+            return
+        self._queue.put((record, callback))
+        tracing.counter("storage.queue", self._queue.qsize(), "storage")
+
+    def flush(self):
+        # 書き込み待ちがなくなるまで待つ
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        self._conn.close()
+
+    def _write_loop(self):
+        conn = _connect(self.path)
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                # 溜まっている分はまとめて書く
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                pending = [entry for entry in batch if entry is not None]
+                # どんな例外でもスレッドを落とさない。落ちるとtask_doneされずflush()が戻らなくなる
+                try:
+                    if pending:
+                        try:
+                            with tracing.span("storage.write", "storage", {"records": len(pending)}):
+                                self._write_batch(conn, [record for record, _ in pending])
+                        except Exception as e:
+                            with contextlib.suppress(sqlite3.Error):
+                                conn.rollback()
+                            print(f"記録の保存に失敗しました: {e!r}", file=sys.stderr)
+                        else:
+                            for record, callback in pending:
+                                if callback is None:
+                                    continue
+                                try:
+                                    callback(record)
+                                except Exception as e:
+                                    print(f"保存後の処理に失敗しました: {e!r}", file=sys.stderr)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+                if len(pending) != len(batch):
+                    return
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, records: list[SessionRecord]):
+        try:
+            self._write_records(conn, records)
+        except BaseException:
+            for observer in self._observers:
+                observer.after_rollback()
+            raise
+        for observer in self._observers:
+            observer.after_commit()
+
+    def _write_records(self, conn: sqlite3.Connection, records: list[SessionRecord]):
+        with conn:
+            for record in records:
+                cursor = conn.execute(
+                    "INSERT INTO sessions (started_at, mode, duration_ns, score, mistakes, kana_count, keystrokes, laps,"
+                    " input_method, conversion) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (record.started_at, record.mode, record.duration_ns, record.score, record.mistakes,
+                     record.kana_count, record.keystrokes, record.laps.tobytes(), record.input_method,
+                     int(record.conversion)))
+                record.id = cursor.lastrowid
+                if record.events is not None:
+                    conn.execute("INSERT INTO session_events (session_id, events) VALUES (?, ?)",
+                                 (record.id, encode(record.events, record.prompts, input_method=record.input_method,
+                                                     conversion=record.conversion)))
+                for observer in self._observers:
+                    with tracing.span(f"{type(observer).__name__}.on_commit", "storage"):
+                        observer.on_commit(conn, record.events, record.prompts)
+            with tracing.span("ActivityRollup.catch_up", "storage"):
+                self.activity.catch_up(conn)
+
+    def record_launch(self):
+        # 起動を記録する(日別・月別の起動回数)
+        try:
+            self.activity.record_launch()
+        except sqlite3.Error as e:
+            print(f"起動の記録に失敗しました: {e}", file=sys.stderr)
+
+    def rebuild_activity(self):
+        # 日別・月別の集計を元の記録から作り直す
+        self.flush()
+        self.activity.rebuild()
+
+    # ---- 読み出し ----
+
+    def top_sessions(self, mode: str, limit: int = RANKING_SIZE, order: str = "score",
+                     input_method: str = ROMAJI, conversion: bool = False) -> list[SessionRecord]:
+        # スコア上位limit件(計測モード・入力方式・変換の有無ごと)。order="time"ならその中を新しい順に並べる
+        rows = self._conn.execute(
+            f"SELECT {_SUMMARY_COLUMNS} FROM sessions WHERE mode = ? AND input_method = ? AND conversion = ?"
+            " ORDER BY score DESC, started_at LIMIT ?",
+            (mode, input_method, int(conversion), limit)).fetchall()
+        records = [_row_to_record(row) for row in rows]
+        if order == "time":
+            records.sort(key=lambda record: record.started_at, reverse=True)
+        return records
+
+    def best_session(self, mode: str, input_method: str = ROMAJI, conversion: bool = False) -> Optional[SessionRecord]:
+        records = self.top_sessions(mode, 1, input_method=input_method, conversion=conversion)
+        return records[0] if records else None
+
+    def history(self, limit: int = HISTORY_PAGE, before: Optional[float] = None,
+                mode: Optional[str] = None, input_method: Optional[str] = None) -> list[SessionRecord]:
+        # 新しい順の履歴。続きはbefore(前のページの最後のstarted_at)で取る
+        where, params = [], []
+        if before is not None:
+            where.append("started_at < ?")
+            params.append(before)
+        if mode is not None:
+            where.append("mode = ?")
+            params.append(mode)
+        if input_method is not None:
+            where.append("input_method = ?")
+            params.append(input_method)
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        rows = self._conn.execute(
+            f"SELECT {_SUMMARY_COLUMNS} FROM sessions{clause} ORDER BY started_at DESC LIMIT ?",
+            (*params, limit)).fetchall()
+        return [_row_to_record(row) for row in rows]
+
+    def session_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def load_replay(self, session_id: int) -> Optional[Replay]:
+        row = self._conn.execute("SELECT events FROM session_events WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        return Replay.decode(row[0])
+
+    def load_events(self, session_id: int) -> Optional[Events]:
+        replay = self.load_replay(session_id)
+        return replay.to_events() if replay is not None else None
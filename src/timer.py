@@ -1,50 +1,124 @@
-from PyQt6.QtCore import QObject, QTimer
+import time
+from PyQt6.QtCore import QObject, QTimer, Qt
+from PyQt6.QtGui import QGuiApplication
 from typing import Optional, Callable
 
+NS_PER_SECOND = 1_000_000_000
+NS_PER_MS = 1_000_000
+
+# 画面のリフレッシュレートが取れないときの表示更新間隔
+DEFAULT_REFRESH_HZ = 60.0
+
+
+def display_refresh_interval_ms() -> int:
+    # 表示の更新はディスプレイのリフレッシュ間隔にまとめる(それ以上速く更新しても見えない)
+    app = QGuiApplication.instance()
+    screen = app.primaryScreen() if app is not None else None
+    rate = screen.refreshRate() if screen is not None else 0.0
+    if not rate or rate <= 0:
+        rate = DEFAULT_REFRESH_HZ
+    return max(1, int(1000 / rate))
+
+
 class TimerController(QObject):
+    # 締め切り(perf_counter_ns)を基準にしたタイマー
+    # 残り時間は毎回実時間から計算するので、表示の更新(tick)が遅れたり間引かれたりしても
+    # ずれない。表示の更新間隔は精度と関係なくUI側で決められる
     def __init__(self, parent=None,
                  tick_callback: Optional[Callable[[int], None]] = None,
-                 finished_callback: Optional[Callable[[], None]] = None):
+                 finished_callback: Optional[Callable[[], None]] = None,
+                 refresh_interval_ms: Optional[int] = None):
         super().__init__(parent)
+        # 表示更新用(残りナノ秒をtick_callbackに渡す)
         self._timer = QTimer(self)
-        self._timer.setInterval(1000)
+        self._timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._timer.setInterval(refresh_interval_ms or display_refresh_interval_ms())
         self._timer.timeout.connect(self._on_timeout)
-        self._remaining = 0
+        # 終了用。締め切りちょうどに1回だけ発火させる
+        self._deadline_timer = QTimer(self)
+        self._deadline_timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self._deadline_timer.setSingleShot(True)
+        self._deadline_timer.timeout.connect(self._on_deadline)
+        self._start_ns = 0
+        self._deadline_ns = 0
         self._running = False
         self._tick_callback = tick_callback
         self._finished_callback = finished_callback
 
-    def start(self, seconds: int):
-        self._remaining = int(seconds)
+    def set_refresh_interval(self, ms: int):
+        # 表示の更新間隔を変える(計測の精度には影響しない)
+        self._timer.setInterval(max(1, int(ms)))
+
+    def start(self, seconds: float, start_ns: Optional[int] = None):
+        # start_nsを渡すとその時刻(過去でもよい)から計測したことにする
+        self._start_ns = start_ns if start_ns is not None else time.perf_counter_ns()
+        self._deadline_ns = self._start_ns + int(seconds * NS_PER_SECOND)
         self._running = True
         # 即時に現在残りを通知
         if self._tick_callback:
-            self._tick_callback(self._remaining)
+            self._tick_callback(self.remaining_ns())
         self._timer.start()
+        self._schedule_deadline()
 
     def stop(self):
         self._timer.stop()
+        self._deadline_timer.stop()
         self._running = False
-        self._remaining = 0
-    
+
+    def _schedule_deadline(self):
+        # QTimerはミリ秒単位で早めに起きることもあるので、残りを切り上げて待つ
+        remaining = self._deadline_ns - time.perf_counter_ns()
+        self._deadline_timer.start(max(0, -(-remaining // NS_PER_MS)))
+
     def _on_timeout(self):
-        if self._remaining > 0:
-            self._remaining -= 1
-            if self._tick_callback:
-                self._tick_callback(self._remaining)
-            if self._remaining == 0:
-                self._timer.stop()
-                self._running = False
-                if self._finished_callback:
-                    self._finished_callback()
-        else:
+        if not self._running:
             self._timer.stop()
-            self._running = False
-            if self._finished_callback:
-                self._finished_callback()
-    
-    def remainng(self) -> int:
-        return int(self._remaining)
-    
+            return
+        remaining = self.remaining_ns()
+        if self._tick_callback:
+            self._tick_callback(remaining)
+        if remaining <= 0:
+            self._finish()
+
+    def _on_deadline(self):
+        if not self._running:
+            return
+        if time.perf_counter_ns() < self._deadline_ns:
+            # 早く起きすぎたら残りを待ち直す
+            self._schedule_deadline()
+            return
+        if self._tick_callback:
+            self._tick_callback(0)
+        self._finish()
+
+    def _finish(self):
+        self.stop()
+        if self._finished_callback:
+            self._finished_callback()
+
+    def remaining_ns(self) -> int:
+        if not self._running:
+            return 0
+        return max(0, self._deadline_ns - time.perf_counter_ns())
+
+    def remaining(self) -> float:
+        # 残り秒数(小数)
+        return self.remaining_ns() / NS_PER_SECOND
+
+    def elapsed_ns(self) -> int:
+        if not self._running:
+            return 0
+        return min(time.perf_counter_ns(), self._deadline_ns) - self._start_ns
+
+    @property
+    def start_ns(self) -> int:
+        return self._start_ns
+
+    @property
+    def deadline_ns(self) -> int:
+        # 計測終了の時刻。これ以降の打鍵は計測に含めない
+        return self._deadline_ns
+
     def is_running(self) -> bool:
-        return bool(self._running)
\ No newline at end of file
+        # 締め切りを過ぎていれば終了の通知前でも計測中とはみなさない
+        return self._running and time.perf_counter_ns() < self._deadline_ns
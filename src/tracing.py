@@ -0,0 +1,194 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+# 計測用のトレース
+#
+# 打鍵の処理、変換器、描画、保存などの区間(span)と、値の移り変わり(counter)、出来事(instant)を
+# 記録して、Chromeのトレース形式(chrome://tracing や Perfetto で開けるJSON)に書き出す。
+# 有効にしていなければ何も記録せず、spanは何もしない共通のオブジェクトを返すだけなので、
+# 打鍵ごとの処理に入れたままでよい。有効にするのは --trace PATH か環境変数 ATW_TRACE=PATH。
+# 記録はメモリ上のリストに足すだけで(スレッドをまたいでも足すだけなのでロックは要らない)、
+# 書き出しは終了時にまとめて行う
+
+ENV_VAR = "ATW_TRACE"
+# これ以上は記録せずに数える(1時間の計測でも収まる量)
+DEFAULT_CAPACITY = 2_000_000
+
+
+class _Recorder:
+    def __init__(self, path: Optional[str], capacity: int):
+        self.path = path
+        self.capacity = capacity
+        self.origin_ns = time.perf_counter_ns()
+        # (ph, 名前, 分類, 開始ns, 長さns, スレッド, args)
+        self.events: list[tuple] = []
+        self.dropped = 0
+        self.threads: dict[int, str] = {}
+
+    def add(self, ph: str, name: str, cat: str, start_ns: int, duration_ns: int, args: Optional[dict]):
+        if len(self.events) >= self.capacity:
+            self.dropped += 1
+            return
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        self.events.append((ph, name, cat, start_ns, duration_ns, tid, args))
+
+
+_recorder: Optional[_Recorder] = None
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "cat", "args", "start")
+
+    def __init__(self, recorder: _Recorder, name: str, cat: str, args: Optional[dict]):
+        self.recorder = recorder
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.recorder.add("X", self.name, self.cat, self.start, end - self.start, self.args)
+        return False
+
+
+def enabled() -> bool:
+    return _recorder is not None
+
+
+def enable(path: Optional[str] = None, capacity: int = DEFAULT_CAPACITY):
+    # 記録を始める(すでに記録中なら書き出し先だけ変える)
+    global _recorder
+    if _recorder is None:
+        _recorder = _Recorder(path, capacity)
+    elif path is not None:
+        _recorder.path = path
+
+
+def enable_from_env():
+    path = os.environ.get(ENV_VAR)
+    if path:
+        enable(path)
+
+
+def disable():
+    global _recorder
+    _recorder = None
+
+
+@contextlib.contextmanager
+def suspended():
+    # この間だけ記録しない(記録したものは残す)
+    global _recorder
+    recorder, _recorder = _recorder, None
+    try:
+        yield
+    finally:
+        _recorder = recorder
+
+
+def span(name: str, cat: str = "app", args: Optional[dict] = None):
+    # with tracing.span("名前"): ... の区間を記録する
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return _Span(recorder, name, cat, args)
+
+
+def call(name: str, cat: str, func: Callable, *args):
+    # func(*args)をspanにして呼ぶ。打鍵ごとの細かい処理用(無効なときはwithより安い)
+    recorder = _recorder
+    if recorder is None:
+        return func(*args)
+    with _Span(recorder, name, cat, None):
+        return func(*args)
+
+
+def traced(name: Optional[str] = None, cat: str = "app"):
+    # 関数全体をspanにするデコレータ
+    def decorate(func: Callable):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None:
+                return func(*args, **kwargs)
+            with _Span(recorder, label, cat, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instant(name: str, cat: str = "app", args: Optional[dict] = None):
+    # その時点の出来事(以前printしていたもの)
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add("i", name, cat, time.perf_counter_ns(), 0, args)
+
+
+def counter(name: str, value: float, cat: str = "app"):
+    # 値の移り変わり(トレース上では折れ線になる)
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add("C", name, cat, time.perf_counter_ns(), 0, {name: value})
+
+
+def export(path: Optional[str] = None) -> Optional[str]:
+    # 記録したものをChromeのトレース形式で書き出し、書き出したパスを返す
+    recorder = _recorder
+    if recorder is None:
+        return None
+    path = path or recorder.path
+    if not path:
+        return None
+    pid = os.getpid()
+    origin = recorder.origin_ns
+    # 記録中に別スレッドが足していても、ここまでの分だけを書く
+    events = recorder.events[:]
+    out = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+           for tid, name in list(recorder.threads.items())]
+    for ph, name, cat, start_ns, duration_ns, tid, args in events:
+        event = {"name": name, "cat": cat, "ph": ph, "ts": (start_ns - origin) / 1000, "pid": pid, "tid": tid}
+        if ph == "X":
+            event["dur"] = duration_ns / 1000
+        elif ph == "i":
+            event["s"] = "t"
+        if args:
+            event["args"] = args
+        out.append(event)
+    directory = os.path.dirname(path)
+    try:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": out, "displayTimeUnit": "ms",
+                       "otherData": {"dropped": recorder.dropped}}, file, ensure_ascii=False)
+    except OSError as e:
+        print(f"トレースを書き出せませんでした: {e}", file=sys.stderr)
+        return None
+    return path
@@ -0,0 +1,99 @@
+from bisect import bisect_left, bisect_right
+
+
+def _is_kana(ch: str) -> bool:
+    # ひらがな・カタカナ(長音含む)。これらはkanaにそのまま現れるので対応付けの手がかりにする
+    return "ぁ" <= ch <= "ゟ" or "ァ" <= ch <= "ー"
+
+
+def _normalize(ch: str) -> str:
+    # カタカナはひらがなとして比べる
+    if "ァ" <= ch <= "ヶ":
+        return chr(ord(ch) - 0x60)
+    return ch
+
+
+def align_text_kana(text: str, kana: str) -> list[int]:
+    # textの各文字の境界がkanaのどこに当たるかを返す(長さ len(text)+1、単調増加)
+    # textに含まれるかなをkanaの同じ文字に対応させ、その間の漢字などの並びは間のkanaに割り当てる
+    # 対応が取れないお題は文字数の比で割り振る
+    runs: list[tuple[bool, int, int]] = []
+    i = 0
+    while i < len(text):
+        kana_run = _is_kana(text[i])
+        j = i
+        while j < len(text) and _is_kana(text[j]) == kana_run:
+            j += 1
+        runs.append((kana_run, i, j))
+        i = j
+
+    placements = _place_kana_runs(text, kana, runs)
+    if placements is None:
+        n = len(text)
+        return [round(k * len(kana) / n) if n else 0 for k in range(n + 1)]
+
+    bounds = [0] * (len(text) + 1)
+    kana_pos = 0
+    for index, (kana_run, start, end) in enumerate(runs):
+        if kana_run:
+            pos = placements[index]
+            for k in range(start, end + 1):
+                bounds[k] = pos + (k - start)
+            kana_pos = pos + (end - start)
+        else:
+            # 次のかなの並びの位置(無ければ末尾)までを文字数で按分する
+            next_pos = placements[index + 1] if index + 1 < len(runs) else len(kana)
+            span = next_pos - kana_pos
+            for k in range(start, end + 1):
+                bounds[k] = kana_pos + (span * (k - start)) // (end - start)
+            kana_pos = next_pos
+    bounds[len(text)] = len(kana)
+    return bounds
+
+
+def _place_kana_runs(text: str, kana: str, runs: list[tuple[bool, int, int]]):
+    # textのかなの並びを、順序を保ってkana上の同じ並びに置く
+    # 置き方は前から決めていき、各並びごとに到達できる終了位置を持っておく
+    normalized_kana = "".join(_normalize(ch) for ch in kana)
+    reachable: dict[int, list[int]] = {0: []}
+    for index, (kana_run, start, end) in enumerate(runs):
+        if not kana_run:
+            continue
+        needle = "".join(_normalize(ch) for ch in text[start:end])
+        occurrences = []
+        pos = normalized_kana.find(needle)
+        while pos != -1:
+            occurrences.append(pos)
+            pos = normalized_kana.find(needle, pos + 1)
+        free_before = index > 0 and not runs[index - 1][0]
+        next_reachable: dict[int, list[int]] = {}
+        for prev_end in sorted(reachable):
+            placed = reachable[prev_end]
+            if free_before:
+                # 漢字などの並びには読みを割り当てる(記号など読みの無いものもあるので空も許す)
+                candidates = occurrences[bisect_left(occurrences, prev_end):]
+            else:
+                candidates = [prev_end] if normalized_kana.startswith(needle, prev_end) else []
+            for pos in candidates:
+                end_pos = pos + len(needle)
+                if end_pos not in next_reachable:
+                    next_reachable[end_pos] = placed + [pos]
+        if not next_reachable:
+            return None
+        reachable = next_reachable
+
+    # 末尾が漢字などの並びなら残りのkanaをそこに割り当てる(読みがある方を優先)
+    trailing_free = bool(runs) and not runs[-1][0]
+    if trailing_free:
+        ends = [end for end in sorted(reachable) if end < len(kana)] + [end for end in reachable if end == len(kana)]
+    else:
+        ends = [end for end in reachable if end == len(kana)]
+    if not ends:
+        return None
+    it = iter(reachable[ends[0]])
+    return {index: next(it) for index, (kana_run, _, _) in enumerate(runs) if kana_run}
+
+
+def text_progress(bounds: list[int], kana_pos: int) -> int:
+    # kanaをkana_pos文字打ったときに打ち終わったtextの文字数
+    return bisect_right(bounds, kana_pos) - 1
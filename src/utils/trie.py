@@ -0,0 +1,89 @@
+from typing import Generic, Iterator, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class TrieNode(Generic[V]):
+    __slots__ = ("children", "value", "depth")
+
+    def __init__(self, depth: int = 0):
+        self.children: dict[str, "TrieNode[V]"] = {}
+        self.value: Optional[V] = None
+        self.depth = depth
+
+
+class Trie(Generic[V]):
+    # 文字列キー -> 値 の単純なTrie
+    # composerのルール構築(コンパイル前)に使うので、探索速度より扱いやすさを優先している
+    def __init__(self):
+        self.root: TrieNode[V] = TrieNode()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, key: str, value: V) -> None:
+        node = self.root
+        for ch in key:
+            child = node.children.get(ch)
+            if child is None:
+                child = TrieNode(node.depth + 1)
+                node.children[ch] = child
+            node = child
+        if node.value is None:
+            self._size += 1
+        node.value = value
+
+    def find_node(self, key: str) -> Optional[TrieNode[V]]:
+        node = self.root
+        for ch in key:
+            node = node.children.get(ch)
+            if node is None:
+                return None
+        return node
+
+    def get(self, key: str, default: Optional[V] = None) -> Optional[V]:
+        node = self.find_node(key)
+        if node is None or node.value is None:
+            return default
+        return node.value
+
+    def __contains__(self, key: str) -> bool:
+        node = self.find_node(key)
+        return node is not None and node.value is not None
+
+    def has_prefix(self, prefix: str) -> bool:
+        return self.find_node(prefix) is not None
+
+    def longest_prefix(self, s: str) -> tuple[int, Optional[V]]:
+        # sの接頭辞のうち値を持つ最長のものの (長さ, 値) を返す
+        node = self.root
+        best_len, best = 0, None
+        for i, ch in enumerate(s):
+            node = node.children.get(ch)
+            if node is None:
+                break
+            if node.value is not None:
+                best_len, best = i + 1, node.value
+        return best_len, best
+
+    def items(self) -> Iterator[tuple[str, V]]:
+        # 深さ優先でキー順(挿入順)に列挙する
+        stack: list[tuple[str, TrieNode[V]]] = [("", self.root)]
+        while stack:
+            key, node = stack.pop()
+            if node.value is not None:
+                yield key, node.value
+            for ch, child in reversed(list(node.children.items())):
+                stack.append((key + ch, child))
+
+    def nodes_bfs(self) -> Iterator[tuple[str, TrieNode[V]]]:
+        # 幅優先で (キー, ノード) を列挙する。根が最初に来る
+        queue: list[tuple[str, TrieNode[V]]] = [("", self.root)]
+        head = 0
+        while head < len(queue):
+            key, node = queue[head]
+            head += 1
+            yield key, node
+            for ch, child in node.children.items():
+                queue.append((key + ch, child))
@@ -0,0 +1,334 @@
+import heapq
+import random
+import sqlite3
+import threading
+from typing import Iterable, Optional
+
+from event_log import EMIT, MISTAKE, PROMPT, Events
+from prompt_store import Prompt
+
+# 苦手お題・苦手なかなの並びの抽出
+#
+# お題ごと・かな2文字(bigram)ごとに「1かなあたりの時間」と「1かなあたりのミス数」を
+# 計測ごとの指数移動平均(と分散)で持つ。記録の保存時に打った分だけ更新するので、
+# 履歴がいくら増えても起動時に全部を読み直すことはない。
+# 苦手さ = 平均時間 * (1 + 平均ミス率)。ミス1回でかな1文字分のスコアを失うので、
+# 「スコア1点を得るのにかかる時間(ms)」になる。これがしきい値以上なら苦手とする
+
+# 直近何回分を重く見るか(指数移動平均の係数は 2 / (N + 1))
+DEFAULT_WINDOW = 10
+DEFAULT_THRESHOLD_MS = 300.0
+# これより少ないかなしか打たなかったお題は集計しない
+_MIN_KANA = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS prompt_stats (
+    prompt_id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL,
+    pace_mean REAL NOT NULL,   -- 1かなあたりの時間(ms)
+    pace_var REAL NOT NULL,
+    miss_mean REAL NOT NULL,   -- 1かなあたりのミス数
+    miss_var REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bigram_stats (
+    bigram TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    pace_mean REAL NOT NULL,
+    pace_var REAL NOT NULL,
+    miss_mean REAL NOT NULL,
+    miss_var REAL NOT NULL
+);
+"""
+
+
+class DecayedStat:
+    # 指数移動平均と指数移動分散
+    __slots__ = ("count", "pace_mean", "pace_var", "miss_mean", "miss_var")
+
+    def __init__(self, count: int = 0, pace_mean: float = 0.0, pace_var: float = 0.0,
+                 miss_mean: float = 0.0, miss_var: float = 0.0):
+        self.count = count
+        self.pace_mean = pace_mean
+        self.pace_var = pace_var
+        self.miss_mean = miss_mean
+        self.miss_var = miss_var
+
+    def update(self, pace: float, miss: float, alpha: float):
+        if self.count == 0:
+            self.pace_mean, self.miss_mean = pace, miss
+            self.pace_var = self.miss_var = 0.0
+        else:
+            diff = pace - self.pace_mean
+            self.pace_mean += alpha * diff
+            self.pace_var = (1 - alpha) * (self.pace_var + alpha * diff * diff)
+            diff = miss - self.miss_mean
+            self.miss_mean += alpha * diff
+            self.miss_var = (1 - alpha) * (self.miss_var + alpha * diff * diff)
+        self.count += 1
+
+    @property
+    def weakness(self) -> float:
+        return self.pace_mean * (1.0 + self.miss_mean)
+
+    def row(self) -> tuple:
+        return self.count, self.pace_mean, self.pace_var, self.miss_mean, self.miss_var
+
+
+class _Fenwick:
+    # 重みの部分和(更新と、累積重みからの位置の検索がO(log n))
+    def __init__(self, size: int = 0):
+        self._tree = [0.0] * (size + 1)
+        self._weights = [0.0] * size
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    def grow(self, size: int):
+        weights = self._weights + [0.0] * (size - len(self._weights))
+        self._tree = [0.0] * (size + 1)
+        self._weights = [0.0] * size
+        for i, weight in enumerate(weights):
+            if weight:
+                self.set(i, weight)
+
+    def set(self, index: int, weight: float):
+        delta = weight - self._weights[index]
+        if not delta:
+            return
+        self._weights[index] = weight
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def total(self) -> float:
+        total = 0.0
+        i = len(self._weights)
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value: float) -> int:
+        # 累積重みがvalueを超える最初の位置
+        pos = 0
+        step = 1 << (len(self._weights).bit_length())
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= value:
+                pos = nxt
+                value -= self._tree[nxt]
+            step >>= 1
+        return min(pos, len(self._weights) - 1)
+
+
+class RankedStats:
+    # キー(お題idやbigram)ごとの集計と、苦手さの順の索引、苦手なものだけの重み付き抽選
+    #
+    # 苦手さの順は (-苦手さ, キー, 版) のヒープで持つ。更新は新しい版を積むだけ(O(log n))で、
+    # 古い版は取り出したときに捨てる。古い版が溜まりすぎたら積み直す
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD_MS):
+        self.stats: dict = {}
+        self._heap: list[tuple[float, object, int]] = []
+        self._versions: dict = {}
+        self._version = 0
+        self._weak = 0  # しきい値以上の数
+        self._slots: dict = {}
+        self._keys: list = []
+        self._fenwick = _Fenwick()
+        self._threshold = threshold
+
+    def __len__(self) -> int:
+        return len(self.stats)
+
+    def put(self, key, stat: DecayedStat):
+        old = self.stats.get(key)
+        if old is not None and old.weakness >= self._threshold:
+            self._weak -= 1
+        if stat.weakness >= self._threshold:
+            self._weak += 1
+        self.stats[key] = stat
+        self._version += 1
+        self._versions[key] = self._version
+        heapq.heappush(self._heap, (-stat.weakness, key, self._version))
+        if len(self._heap) > 2 * len(self.stats) + 16:
+            self._heap = [(-stat.weakness, key, self._versions[key]) for key, stat in self.stats.items()]
+            heapq.heapify(self._heap)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = len(self._keys)
+            self._slots[key] = slot
+            self._keys.append(key)
+            if slot >= len(self._fenwick):
+                self._fenwick.grow(max(16, 2 * len(self._fenwick)))
+        self._fenwick.set(slot, self._weight(stat))
+
+    def _weight(self, stat: DecayedStat) -> float:
+        # しきい値を超えた分だけ出やすくする(しきい値未満は出さない)
+        weakness = stat.weakness
+        return weakness - self._threshold + 1.0 if weakness >= self._threshold else 0.0
+
+    @property
+    def threshold(self) -> float:
+        return self._threshold
+
+    def set_threshold(self, threshold: float):
+        self._threshold = threshold
+        self._weak = 0
+        for key, stat in self.stats.items():
+            self._fenwick.set(self._slots[key], self._weight(stat))
+            if stat.weakness >= threshold:
+                self._weak += 1
+
+    def weak_count(self) -> int:
+        return self._weak
+
+    def weakest(self, count: int = 10) -> list[tuple[object, float]]:
+        # 苦手さの大きい順にcount件(上から取り出して、古い版は捨て、今の版は積み戻す)
+        found = []
+        while self._heap and len(found) < count:
+            entry = heapq.heappop(self._heap)
+            if self._versions.get(entry[1]) == entry[2]:
+                found.append(entry)
+        for entry in found:
+            heapq.heappush(self._heap, entry)
+        return [(key, -weakness) for weakness, key, _ in found]
+
+    def sample(self, rng: random.Random, exclude=None):
+        # 苦手なもの(しきい値以上)から苦手さに応じて1つ選ぶ。無ければNone
+        total = self._fenwick.total()
+        if total <= 0:
+            return None
+        for _ in range(8):
+            key = self._keys[self._fenwick.find(rng.random() * total)]
+            if key != exclude or self.weak_count() <= 1:
+                return key
+        return key
+
+
+def session_samples(events: Events, prompts: dict[int, Prompt]):
+    # 1回の計測のイベント列から、お題ごと・bigramごとの (1かなあたりの時間ms, 1かなあたりのミス数)
+    per_prompt: dict[int, list] = {}   # id -> [かな数, ミス数, 最初の時刻, 最後の確定時刻]
+    per_bigram: dict[str, list] = {}   # bigram -> [回数, 時間の合計ns, ミス数]
+    kana = ""
+    current = None
+    last_emit = None
+    for t_ns, kind, code, index in events:
+        if kind == PROMPT:
+            prompt = prompts.get(index)
+            current = None
+            last_emit = None
+            if prompt is None:
+                kana = ""
+                continue
+            kana = (" " if code else "") + prompt.kana
+            current = per_prompt.setdefault(index, [0, 0, t_ns, t_ns])
+            current[2] = min(current[2], t_ns)
+            last_emit = t_ns
+        elif current is None:
+            continue
+        elif kind == EMIT:
+            current[0] += code
+            current[3] = t_ns
+            # 1文字ずつ確定したときだけ直前の文字との間隔をbigramに数える
+            if code == 1 and index >= 2 and last_emit is not None:
+                bigram = kana[index - 2:index]
+                if " " not in bigram:
+                    entry = per_bigram.setdefault(bigram, [0, 0, 0])
+                    entry[0] += 1
+                    entry[1] += t_ns - last_emit
+            last_emit = t_ns
+        elif kind == MISTAKE:
+            current[1] += 1
+            # ミスは次に打つかなとその前のかなの並びに数える
+            if 1 <= index < len(kana):
+                bigram = kana[index - 1:index + 1]
+                if " " not in bigram:
+                    per_bigram.setdefault(bigram, [0, 0, 0])[2] += 1
+    prompt_samples = {prompt_id: (((last - first) / 1e6) / typed, mistakes / typed)
+                      for prompt_id, (typed, mistakes, first, last) in per_prompt.items() if typed >= _MIN_KANA}
+    bigram_samples = {bigram: ((total / 1e6) / count, mistakes / count)
+                      for bigram, (count, total, mistakes) in per_bigram.items() if count}
+    return prompt_samples, bigram_samples
+
+
+class WeaknessTracker:
+    # 苦手お題の集計。SessionStoreの書き込みと同じトランザクションで表を更新し(on_commit)、
+    # コミットできてから手元の集計に反映する(after_commit)。集計を書き換えるのは書き込みスレッドだけ
+    def __init__(self, conn: sqlite3.Connection, window: int = DEFAULT_WINDOW,
+                 threshold: float = DEFAULT_THRESHOLD_MS):
+        self.alpha = 2.0 / (window + 1)
+        self.prompts = RankedStats(threshold)
+        self.bigrams = RankedStats(threshold)
+        # コミット待ちの更新(キー -> 更新後の集計)
+        self._staged_prompts: dict = {}
+        self._staged_bigrams: dict = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        conn.executescript(_SCHEMA)
+        for row in conn.execute("SELECT prompt_id, count, pace_mean, pace_var, miss_mean, miss_var FROM prompt_stats"):
+            self.prompts.put(row[0], DecayedStat(*row[1:]))
+        for row in conn.execute("SELECT bigram, count, pace_mean, pace_var, miss_mean, miss_var FROM bigram_stats"):
+            self.bigrams.put(row[0], DecayedStat(*row[1:]))
+
+    def on_commit(self, conn: sqlite3.Connection, events: Optional[Events], prompts: Iterable[Prompt]):
+        # 書き込みスレッドから呼ばれる(connはトランザクション中)
+        if events is None:
+            return
+        prompt_samples, bigram_samples = session_samples(events, {prompt.id: prompt for prompt in prompts})
+        prompt_rows = [(key, *self._update(self.prompts, self._staged_prompts, key, sample))
+                       for key, sample in prompt_samples.items()]
+        bigram_rows = [(key, *self._update(self.bigrams, self._staged_bigrams, key, sample))
+                       for key, sample in bigram_samples.items()]
+        conn.executemany("INSERT OR REPLACE INTO prompt_stats VALUES (?, ?, ?, ?, ?, ?)", prompt_rows)
+        conn.executemany("INSERT OR REPLACE INTO bigram_stats VALUES (?, ?, ?, ?, ?, ?)", bigram_rows)
+
+    def after_commit(self):
+        # 書き込みスレッドから呼ばれる(コミットできた分を手元の集計に反映する)
+        with self._lock:
+            for ranked, staged in ((self.prompts, self._staged_prompts), (self.bigrams, self._staged_bigrams)):
+                for key, stat in staged.items():
+                    ranked.put(key, stat)
+        self._staged_prompts.clear()
+        self._staged_bigrams.clear()
+
+    def after_rollback(self):
+        # 書き込みスレッドから呼ばれる(ロールバックした分は捨てる)
+        self._staged_prompts.clear()
+        self._staged_bigrams.clear()
+
+    def _update(self, ranked: RankedStats, staged: dict, key, sample: tuple[float, float]) -> tuple:
+        # 同じトランザクションで先に更新した分があればそれに重ねる
+        old = staged.get(key) or ranked.stats.get(key)
+        stat = DecayedStat(*old.row()) if old is not None else DecayedStat()
+        stat.update(sample[0], sample[1], self.alpha)
+        staged[key] = stat
+        return stat.row()
+
+    # ---- 問い合わせ(UIスレッド) ----
+
+    @property
+    def threshold(self) -> float:
+        return self.prompts.threshold
+
+    def set_threshold(self, threshold: float):
+        with self._lock:
+            self.prompts.set_threshold(threshold)
+            self.bigrams.set_threshold(threshold)
+
+    def weak_prompt_count(self) -> int:
+        with self._lock:
+            return self.prompts.weak_count()
+
+    def weakest_prompts(self, count: int = 10) -> list[tuple[int, float]]:
+        with self._lock:
+            return self.prompts.weakest(count)
+
+    def weakest_bigrams(self, count: int = 10) -> list[tuple[str, float]]:
+        with self._lock:
+            return self.bigrams.weakest(count)
+
+    def sample_prompt(self, exclude: Optional[int] = None) -> Optional[int]:
+        # 苦手お題の練習用に1つ選ぶ(苦手なほど出やすい)
+        with self._lock:
+            return self.prompts.sample(self._random, exclude)